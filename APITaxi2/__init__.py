@@ -1,5 +1,4 @@
 import importlib
-import json
 import os
 import pkgutil
 import sys
@@ -21,9 +20,12 @@ from werkzeug.exceptions import BadRequest
 from APITaxi_models2 import db, Role, User
 
 from . import commands
+from . import redis_clients
+from . import reference_data
 from . import views
 from .middlewares import ForceJSONContentTypeMiddleware
 from .security import auth
+from .serializers import JSONProvider
 
 
 def handler_401():
@@ -90,8 +92,16 @@ def error_handler(status_code):
     return handler_401()
 
 
+# Endpoints reading newline-delimited JSON from the request stream
+NDJSON_ENDPOINTS = {'geotaxi.geotaxi_bulk'}
+
+
 def check_content_type():
     if request.method in ('POST', 'PUT', 'PATCH'):
+        # Don't read the whole body of streamed requests
+        if request.endpoint in NDJSON_ENDPOINTS and request.mimetype == 'application/x-ndjson':
+            return None
+
         if 'application/json' not in request.headers.get('Content-Type', ''):
             return jsonify({
                 'errors': {
@@ -124,6 +134,7 @@ def redis_init_app(app):
     if not app.config.get('REDIS_URL', '').startswith('unix://'):
         redis_kwargs['socket_keepalive'] = True
     app.redis = FlaskRedis(app, **redis_kwargs)
+    redis_clients.init_app(app)
 
 
 def celery_init_app(app):
@@ -163,6 +174,7 @@ def celery_init_app(app):
 def create_app():
     app = Flask(__name__, static_folder=None)
     app.wsgi_app = ForceJSONContentTypeMiddleware(app.wsgi_app)
+    app.json = JSONProvider(app)
 
     # Disable CORS
     CORS(app, resources={r'*': {"origins": "*"}})
@@ -259,7 +271,7 @@ def create_app():
 
     @app.route('/swagger.json')
     def swagger():
-        return json.dumps(app.apispec.to_dict(), indent=2)
+        return reference_data.get_swagger_json(app)
 
     if os.environ.get('DEBUG_REQUESTS') in ('t', 'y', 'yes', 'true', '1') or app.config.get('DEBUG_REQUESTS'):
         @app.after_request
@@ -276,4 +288,6 @@ def create_app():
             sys.stderr.write('\n')
             return response
 
+    reference_data.init_app(app)
+
     return app
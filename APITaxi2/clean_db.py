@@ -29,10 +29,11 @@ def blur_geotaxi():
 
     for count, update in enumerate(redis_backend.list_taxis(0, threshold.timestamp()), 1):
         # Same structure and data as geotaxi, just zeroing the location
-        pipeline.hset(
-            f"taxi:{update.taxi_id}",
+        redis_backend.set_taxi_position(
+            pipeline,
+            update.taxi_id,
             update.operator,
-            f"{update.timestamp} 0.0 0.0 free phone 2",
+            redis_backend.format_taxi_position(update.timestamp, 0.0, 0.0),
         )
 
     pipeline.execute()
@@ -223,9 +224,8 @@ def delete_old_taxis():
         )
     }
     # Confirmation from Redis of taxis not updated for over a year
-    old_redis_ids = {
-        update.taxi_id for update in redis_backend.list_taxis(0, threshold.timestamp())
-    }
+    old_redis_updates = redis_backend.list_taxis(0, threshold.timestamp())
+    old_redis_ids = {update.taxi_id for update in old_redis_updates}
     all_redis_ids = set(redis_backend.list_taxi_ids())
     # Taxis confirmed by Redis to be not updated for over a year, plus taxis unknown
     candidates = (old_taxi_ids & old_redis_ids) | (old_taxi_ids - all_redis_ids)
@@ -236,16 +236,33 @@ def delete_old_taxis():
 
     # Then delete them in Redis
     pipeline = current_app.redis.pipeline()
-    for taxi_id in candidates:
-        pipeline.delete(f"taxi:{taxi_id}")
 
     # Delete orphan taxis dandling in Redis
     all_taxis_ids = {taxi_id for taxi_id, in db.session.query(Taxi.id)}
     orphan_ids = old_redis_ids - candidates - all_taxis_ids
-    for orphan_id in orphan_ids:
-        pipeline.delete(f"taxi:{orphan_id}")
+
+    deleted_updates = [
+        update for update in old_redis_updates
+        if update.taxi_id in candidates or update.taxi_id in orphan_ids
+    ]
+    redis_backend.delete_taxi_positions(
+        pipeline,
+        candidates | orphan_ids,
+        [(update.taxi_id, update.operator) for update in deleted_updates],
+    )
+
+    # And from the index of last location updates
+    for update in deleted_updates:
+        pipeline.zrem('last_seen', f"{update.taxi_id}:{update.operator}")
 
     pipeline.execute()
+    redis_backend.delete_geoindex_insee_members(
+        (update.taxi_id, update.operator) for update in deleted_updates
+    )
+
+    # Deleted taxis can't report their location anymore
+    redis_backend.clear_owned_taxi_ids()
+    redis_backend.clear_taxis_search_metadata()
     return count
 
 
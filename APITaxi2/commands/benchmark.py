@@ -0,0 +1,408 @@
+"""
+Micro-benchmarks of the hot paths of the API.
+
+Benchmarks write into redis: run them against a disposable server with
+--redis-url, never against production. The benchmark of the exclusion zones
+only reads the database, and the benchmark of the serializers doesn't use
+either.
+"""
+import asyncio
+from datetime import datetime
+import json
+import random
+import socket
+import statistics
+import time
+
+import click
+from flask import Blueprint, current_app
+from flask.json.provider import DefaultJSONProvider
+import numpy as np
+from prettytable import PrettyTable
+import redis
+import shapely
+from shapely.geometry import Point
+
+from APITaxi2 import geotaxi_receiver, location_store, redis_backend, redis_scripts, schemas
+from APITaxi2.exclusions import ExclusionHelper
+
+
+blueprint = Blueprint('commands_benchmark', __name__, cli_group=None)
+
+BENCHMARK_OPERATOR = 'benchmark@le.taxi'
+
+redis_url_option = click.option(
+    '--redis-url',
+    help='URL of the redis server to benchmark, defaults to REDIS_URL. Data is written to this server.'
+)
+
+
+def _get_redis_client(redis_url):
+    return redis.Redis.from_url(redis_url or current_app.config['REDIS_URL'])
+
+
+def _random_positions(count, prefix='bench'):
+    """Positions around Paris, with taxi IDs "<prefix><n>"."""
+    return [
+        {
+            'taxi_id': f'{prefix}{i}',
+            'lon': round(2.35 + random.uniform(-0.05, 0.05), 6),
+            'lat': round(48.86 + random.uniform(-0.05, 0.05), 6),
+        } for i in range(count)
+    ]
+
+
+def _measure(func, iterations):
+    """Call func() `iterations` times, return the list of durations in
+    milliseconds."""
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def _display(results):
+    """`results` is a list of (label, timings in milliseconds)."""
+    table = PrettyTable()
+    table.field_names = ['Benchmark', 'Mean (ms)', 'Median (ms)', 'p99 (ms)']
+    table.align['Benchmark'] = 'l'
+    for label, timings in results:
+        p99 = sorted(timings)[min(len(timings) - 1, int(len(timings) * 0.99))]
+        table.add_row([
+            label,
+            f'{statistics.mean(timings):.3f}',
+            f'{statistics.median(timings):.3f}',
+            f'{p99:.3f}',
+        ])
+    print(table)
+
+
+def _cleanup_positions(client, positions, operator):
+    pipeline = client.pipeline()
+    redis_backend.delete_taxi_positions(
+        pipeline,
+        [position['taxi_id'] for position in positions],
+        [(position['taxi_id'], operator) for position in positions],
+    )
+    for position in positions:
+        taxi_id = position['taxi_id']
+        pipeline.zrem('geoindex', taxi_id)
+        pipeline.zrem('geoindex_2', f'{taxi_id}:{operator}')
+        pipeline.zrem('timestamps', f'{taxi_id}:{operator}')
+        pipeline.zrem('timestamps_id', taxi_id)
+        pipeline.zrem('last_seen', f'{taxi_id}:{operator}')
+    pipeline.hdel('geotaxi_coalesced', operator)
+    pipeline.execute()
+
+
+def _update_positions_pipeline(client, positions, operator):
+    """Reference implementation: queue the five commands of each position in a
+    pipeline, as POST /geotaxi did before redis_backend.update_taxi_positions."""
+    now = int(time.time())
+    pipeline = client.pipeline()
+    for position in positions:
+        taxi_id = position['taxi_id']
+        pipeline.hset(f'taxi:{taxi_id}', operator, f"{now} {position['lat']} {position['lon']} free phone 2")
+        pipeline.geoadd('geoindex', [position['lon'], position['lat'], taxi_id])
+        pipeline.geoadd('geoindex_2', [position['lon'], position['lat'], f'{taxi_id}:{operator}'])
+        pipeline.zadd('timestamps', {f'{taxi_id}:{operator}': now})
+        pipeline.zadd('timestamps_id', {taxi_id: now})
+    pipeline.execute()
+
+
+def _taxis_locations_by_operator_zscore(client, lon, lat, distance):
+    """Reference implementation: GEORADIUS then one ZSCORE per member, as
+    redis_backend.taxis_locations_by_operator did before
+    redis_scripts.GEOSEARCH_WITH_TIMESTAMPS."""
+    data = client.georadius('geoindex_2', lon, lat, distance, unit='m', withdist=True, withcoord=True, sort='ASC')
+    return [(row, client.zscore('timestamps', row[0])) for row in data]
+
+
+@blueprint.cli.group()
+def benchmark():
+    """Micro-benchmarks, to run against a disposable redis server"""
+
+
+@benchmark.command()
+@redis_url_option
+@click.option('--batch-size', type=int, multiple=True, default=[1, 50, 500], show_default=True)
+@click.option('--iterations', type=int, default=200, show_default=True)
+def geotaxi(redis_url, batch_size, iterations):
+    """Compare the pipeline and the Lua script to store positions."""
+    client = _get_redis_client(redis_url)
+
+    results = []
+    for size in batch_size:
+        positions = _random_positions(size)
+        results.append((
+            f'pipeline, {size} positions',
+            _measure(lambda: _update_positions_pipeline(client, positions, BENCHMARK_OPERATOR), iterations)
+        ))
+        results.append((
+            f'script, {size} positions',
+            _measure(lambda: redis_backend.update_taxi_positions(positions, BENCHMARK_OPERATOR, client=client), iterations)
+        ))
+        _cleanup_positions(client, positions, BENCHMARK_OPERATOR)
+
+    _display(results)
+
+
+@benchmark.command()
+@redis_url_option
+@click.option('--datagrams', type=int, default=100000, show_default=True)
+@click.option('--taxis', type=int, default=5000, show_default=True)
+@click.option('--flush-interval', type=float, default=geotaxi_receiver.FLUSH_INTERVAL, show_default=True)
+def geotaxi_receiver_load(redis_url, datagrams, taxis, flush_interval):
+    """Load test of the UDP receiver of `flask geotaxi serve`.
+
+    A receiver listens on a random local port, and datagrams signed for a fake
+    operator are sent as fast as possible. As UDP is not reliable, datagrams
+    dropped by the kernel are reported as lost.
+    """
+    client = _get_redis_client(redis_url)
+    apikey = 'benchmark-apikey'
+    operator = geotaxi_receiver.Operator(0, BENCHMARK_OPERATOR, apikey)
+    positions = _random_positions(taxis, prefix='udp')
+
+    messages = []
+    for i in range(datagrams):
+        position = positions[i % taxis]
+        message = {
+            'timestamp': int(time.time()),
+            'operator': BENCHMARK_OPERATOR,
+            'taxi': position['taxi_id'],
+            'lat': position['lat'],
+            'lon': position['lon'],
+            'device': 'phone',
+            'status': 'free',
+            'version': '2',
+        }
+        message['hash'] = geotaxi_receiver.compute_hash(message, apikey)
+        messages.append(json.dumps(message).encode('utf8'))
+
+    def send(port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for message in messages:
+            sock.sendto(message, ('127.0.0.1', port))
+        sock.close()
+
+    async def run():
+        receiver = geotaxi_receiver.GeotaxiReceiver(
+            current_app._get_current_object(),
+            operators={BENCHMARK_OPERATOR: operator},
+            # The fake operator doesn't exist in the database
+            check_ownership=False,
+            flush_interval=flush_interval,
+            redis_client=client,
+        )
+        transport = await receiver.start('127.0.0.1', 0)
+        port = transport.get_extra_info('sockname')[1]
+
+        start = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(None, send, port)
+        # Let the receiver read the datagrams still in the socket buffer
+        await asyncio.sleep(0.5)
+        transport.close()
+        await receiver.drain()
+        return receiver.stats, time.perf_counter() - start - 0.5
+
+    stats, duration = asyncio.run(run())
+
+    # Check the positions are readable with the configured key layout
+    pipeline = client.pipeline(transaction=False)
+    for position in positions:
+        pipeline.hexists(*redis_backend.get_taxi_position_key(position['taxi_id'], BENCHMARK_OPERATOR))
+    stored_taxis = sum(pipeline.execute())
+    _cleanup_positions(client, positions, BENCHMARK_OPERATOR)
+
+    table = PrettyTable()
+    table.field_names = ['Sent', 'Received', 'Lost', 'Redis writes', 'Taxis in redis', 'Duration (s)', 'Datagrams/s']
+    table.add_row([
+        datagrams,
+        stats['received'],
+        datagrams - stats['received'],
+        stats['stored'],
+        f'{stored_taxis}/{taxis}',
+        f'{duration:.2f}',
+        f'{stats["received"] / duration:.0f}',
+    ])
+    print(table)
+
+
+@benchmark.command()
+@redis_url_option
+@click.option('--members', type=int, multiple=True, default=[1000, 5000, 10000], show_default=True)
+@click.option('--iterations', type=int, default=50, show_default=True)
+@click.option('--search-count', type=int, default=40, show_default=True,
+              help='COUNT of the search, ?limit=10 with the default over-fetch factor')
+def taxis_locations(redis_url, members, iterations, search_count):
+    """Latency of the search in geoindex_2 as the number of taxis in the radius
+    grows."""
+    client = _get_redis_client(redis_url)
+    # All the positions generated by _random_positions() are within this
+    # radius of the center of Paris.
+    lon, lat, distance = 2.35, 48.86, 10000
+
+    results = []
+    for count in members:
+        positions = _random_positions(count)
+        redis_backend.update_taxi_positions(positions, BENCHMARK_OPERATOR, client=client)
+        results.append((
+            f'GEORADIUS + ZSCORE, {count} taxis',
+            _measure(lambda: _taxis_locations_by_operator_zscore(client, lon, lat, distance), iterations)
+        ))
+        results.append((
+            f'script, {count} taxis',
+            _measure(lambda: redis_scripts.run(
+                redis_scripts.GEOSEARCH_WITH_TIMESTAMPS,
+                ['timestamps', 'geoindex_2'],
+                [lon, lat, distance, 0],
+                client=client
+            ), iterations)
+        ))
+        results.append((
+            f'script COUNT {search_count}, {count} taxis',
+            _measure(lambda: redis_scripts.run(
+                redis_scripts.GEOSEARCH_WITH_TIMESTAMPS,
+                ['timestamps', 'geoindex_2'],
+                [lon, lat, distance, search_count],
+                client=client
+            ), iterations)
+        ))
+        memory_store = location_store.MemoryLocationStore()
+        memory_store.update(positions, BENCHMARK_OPERATOR, time.time())
+        results.append((
+            f'in-memory store, {count} taxis',
+            _measure(lambda: memory_store.search(lon, lat, distance), iterations)
+        ))
+        results.append((
+            f'in-memory store COUNT {search_count}, {count} taxis',
+            _measure(lambda: memory_store.search(lon, lat, distance, count=search_count), iterations)
+        ))
+        _cleanup_positions(client, positions, BENCHMARK_OPERATOR)
+
+    _display(results)
+
+
+@benchmark.command()
+@click.option('--points', type=int, multiple=True, default=[1, 100, 10000], show_default=True)
+@click.option('--iterations', type=int, default=20, show_default=True)
+def exclusions(points, iterations):
+    """Exclusion zones tests, with all the zones of the database, one point at
+    a time or vectorized. Only reads the database."""
+    helper = ExclusionHelper()
+    tree = helper._tree
+    if not len(tree.geometries):
+        raise click.ClickException('No exclusion zone in the database')
+
+    # Random points around the zones, half of them within the bounding box of
+    # a zone
+    min_lon, min_lat, max_lon, max_lat = shapely.total_bounds(tree.geometries)
+    bounds = shapely.bounds(tree.geometries)
+
+    results = []
+    for count in points:
+        zones = bounds[np.random.randint(len(bounds), size=count)]
+        near = np.random.rand(count) < 0.5
+        lons = np.where(
+            near,
+            np.random.uniform(zones[:, 0], zones[:, 2]),
+            np.random.uniform(min_lon - 0.1, max_lon + 0.1, size=count)
+        )
+        lats = np.where(
+            near,
+            np.random.uniform(zones[:, 1], zones[:, 3]),
+            np.random.uniform(min_lat - 0.1, max_lat + 0.1, size=count)
+        )
+        coordinates = list(zip(lons.tolist(), lats.tolist()))
+
+        results.append((
+            f'loop, bounding boxes only, {count} points',
+            _measure(lambda: [bool(tree.query(Point(lon, lat)).size) for lon, lat in coordinates], iterations)
+        ))
+        results.append((
+            f'loop, is_at_excluded_zone, {count} points',
+            _measure(lambda: [helper.is_at_excluded_zone(lon, lat) for lon, lat in coordinates], iterations)
+        ))
+        results.append((
+            f'batch, are_at_excluded_zones, {count} points',
+            _measure(lambda: helper.are_at_excluded_zones(lons, lats), iterations)
+        ))
+
+    print(f'{len(tree.geometries)} exclusion zones')
+    _display(results)
+
+
+class _MarshmallowSearchTaxiSchema(schemas.SearchTaxiSchema):
+    """SearchTaxiSchema dumped by marshmallow, the baseline of the compiled
+    schema."""
+    compiled_dump = False
+
+
+def _marshmallow_search_taxi_schema():
+    schema = schemas.data_schema_wrapper(_MarshmallowSearchTaxiSchema())()
+    schema.compiled_dump = False
+    return schema
+
+
+@benchmark.command()
+@click.option('--objects', type=int, multiple=True, default=[10, 100, 1000], show_default=True)
+@click.option('--iterations', type=int, default=50, show_default=True)
+def serializers(objects, iterations):
+    """Serialization of the results of GET /taxis, by marshmallow or the
+    compiled schemas, encoded by the json module or orjson."""
+    app = current_app._get_current_object()
+    json_provider = DefaultJSONProvider(app)
+
+    def response(schema, obj, provider):
+        return provider.response(schema.dump(obj)).get_data()
+
+    results = []
+    # No user is logged in, the view of an anonymous moteur
+    with app.test_request_context():
+        for count in objects:
+            obj = {'data': [
+                (
+                    redis_backend.TaxiSearchMetadata(
+                        taxi_id=position['taxi_id'],
+                        operator=BENCHMARK_OPERATOR,
+                        status='free',
+                        radius=150,
+                        insee='75056',
+                        last_update_at=datetime.now(),
+                        licence_plate='AB-123-CD',
+                        model='Model',
+                        constructor='Constructor',
+                        nb_seats=4,
+                        engine='Électrique',
+                        characteristics=['pet_accepted', 'baby_seat'],
+                    ),
+                    redis_backend.Location(
+                        lon=position['lon'], lat=position['lat'], distance=random.uniform(0, 500),
+                        update_date=datetime.now(),
+                    ),
+                ) for position in _random_positions(count)
+            ]}
+            schema = schemas.DataSearchTaxiSchema()
+            baseline_schema = _marshmallow_search_taxi_schema()
+
+            results.append((
+                f'marshmallow, {count} taxis',
+                _measure(lambda: baseline_schema.dump(obj), iterations)
+            ))
+            results.append((
+                f'marshmallow + json, {count} taxis',
+                _measure(lambda: response(baseline_schema, obj, json_provider), iterations)
+            ))
+            results.append((
+                f'compiled, {count} taxis',
+                _measure(lambda: schema.dump(obj), iterations)
+            ))
+            results.append((
+                f'compiled + orjson, {count} taxis',
+                _measure(lambda: response(schema, obj, app.json), iterations)
+            ))
+
+    _display(results)
@@ -6,7 +6,7 @@ from flask import Blueprint, current_app
 from geoalchemy2.shape import from_shape
 from shapely.geometry import shape, MultiPolygon
 
-from APITaxi2 import exclusions
+from APITaxi2 import exclusions, reference_data
 from APITaxi_models2 import db, Exclusion
 
 
@@ -49,6 +49,7 @@ def add(geojson_file):
     db.session.commit()
 
     exclusions.ExclusionHelper().reset()
+    reference_data.publish_reload()
 
 
 @exclusion.command()
@@ -64,9 +65,12 @@ def remove(exclusion_id):
         db.session.commit()
 
     exclusions.ExclusionHelper().reset()
+    reference_data.publish_reload()
 
 
 @exclusion.command()
 def reset():
-    """Reset cache of excluded zones"""
+    """Reset cache of excluded zones, in this process and in the workers of
+    the API"""
     exclusions.ExclusionHelper().reset()
+    reference_data.publish_reload()
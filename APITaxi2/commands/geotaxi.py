@@ -0,0 +1,133 @@
+import asyncio
+
+import click
+from flask import Blueprint, current_app
+from prettytable import PrettyTable
+
+from APITaxi2 import geotaxi_receiver, redis_backend
+
+
+blueprint = Blueprint('commands_geotaxi', __name__, cli_group=None)
+
+
+@blueprint.cli.group()
+def geotaxi():
+    """Receive taxi positions outside of the API workers"""
+
+
+@geotaxi.command()
+@click.option('--host', help='Defaults to GEOTAXI_HOST, or 0.0.0.0')
+@click.option('--port', type=int, help='Defaults to GEOTAXI_PORT, or 8080')
+@click.option(
+    '--flush-interval', type=float, default=geotaxi_receiver.FLUSH_INTERVAL, show_default=True,
+    help='Delay in seconds to batch positions before storing them'
+)
+def serve(host, port, flush_interval):
+    """Listen for positions sent over UDP with the legacy geotaxi protocol."""
+    host = host or current_app.config.get('GEOTAXI_HOST', '0.0.0.0')
+    port = port or current_app.config.get('GEOTAXI_PORT', 8080)
+    asyncio.run(geotaxi_receiver.serve(current_app._get_current_object(), host, port, flush_interval))
+
+
+@geotaxi.command()
+def coalesced():
+    """Number of positions of taxis which didn't move, by operator."""
+    table = PrettyTable()
+    table.field_names = ['Operator', 'Positions coalesced', 'Writes saved']
+    table.align['Operator'] = 'l'
+    for operator, count in sorted(redis_backend.get_coalesced_positions().items()):
+        # HSET taxi:<id>, GEOADD geoindex and GEOADD geoindex_2
+        table.add_row([operator, count, count * 3])
+    print(table)
+
+
+@geotaxi.command()
+def backfill_last_seen():
+    """Index the locations stored before the zset last_seen existed."""
+    count = redis_backend.backfill_last_seen()
+    print(f'{count} locations indexed')
+
+
+@geotaxi.command()
+@click.option('--batch-size', type=int, default=500, show_default=True)
+@click.option('--sample', type=int, default=1000, show_default=True,
+              help='Number of hashes to measure with MEMORY USAGE')
+def pack_positions(batch_size, sample):
+    """Convert the hashes taxi:<id> and taxis:<bucket> to the packed format.
+
+    The conversion can be interrupted and run again. Set GEOTAXI_PACKED_POSITIONS
+    first, otherwise positions received in the meantime are stored in the text
+    format again.
+    """
+    if not current_app.config.get('GEOTAXI_PACKED_POSITIONS'):
+        print('Warning: GEOTAXI_PACKED_POSITIONS is not set, new positions are still stored as text')
+
+    keys_count = converted = 0
+    memory_before = memory_after = sampled = 0
+
+    def _convert(keys):
+        nonlocal converted, memory_before, memory_after, sampled
+        measured = keys[:max(sample - sampled, 0)]
+        if measured:
+            pipeline = current_app.redis.pipeline(transaction=False)
+            for key in measured:
+                pipeline.memory_usage(key, samples=0)
+            memory_before += sum(usage or 0 for usage in pipeline.execute())
+
+        converted += redis_backend.pack_taxi_positions(keys)
+
+        if measured:
+            pipeline = current_app.redis.pipeline(transaction=False)
+            for key in measured:
+                pipeline.memory_usage(key, samples=0)
+            memory_after += sum(usage or 0 for usage in pipeline.execute())
+            sampled += len(measured)
+
+    keys = []
+    for key in redis_backend.scan_taxi_position_keys(count=batch_size):
+        keys.append(key)
+        keys_count += 1
+        if len(keys) >= batch_size:
+            _convert(keys)
+            keys = []
+    if keys:
+        _convert(keys)
+
+    table = PrettyTable()
+    table.field_names = ['Hashes', 'Values converted', 'Sampled', 'Bytes before', 'Bytes after', 'Estimated saving (MB)']
+    table.add_row([
+        keys_count,
+        converted,
+        sampled,
+        memory_before,
+        memory_after,
+        f'{(memory_before - memory_after) / sampled * keys_count / 1024 / 1024:.1f}' if sampled else '-',
+    ])
+    print(table)
+
+
+@geotaxi.command()
+@click.option('--batch-size', type=int, default=500, show_default=True)
+def migrate_buckets(batch_size):
+    """Move the hashes taxi:<id> to the buckets taxis:<bucket>.
+
+    Set GEOTAXI_BUCKETS first: new positions are then written to the buckets,
+    and positions not moved yet are still readable. The migration can be
+    interrupted and run again.
+    """
+    if not redis_backend.get_taxi_buckets():
+        print('GEOTAXI_BUCKETS is not set, nothing to do')
+        return
+
+    keys_count = moved = 0
+    keys = []
+    for key in current_app.redis.scan_iter('taxi:*', count=batch_size):
+        keys.append(key)
+        keys_count += 1
+        if len(keys) >= batch_size:
+            moved += redis_backend.move_taxi_positions_to_buckets(keys)
+            keys = []
+    if keys:
+        moved += redis_backend.move_taxi_positions_to_buckets(keys)
+
+    print(f'{keys_count} hashes deleted, {moved} positions moved')
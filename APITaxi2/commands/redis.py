@@ -7,8 +7,9 @@ import click
 from flask import Blueprint, current_app
 from flask.cli import with_appcontext
 
+from APITaxi2 import redis_backend
 from APITaxi2.utils import get_short_uuid
-from APITaxi_models2 import db, Hail, User, Customer
+from APITaxi_models2 import db, Hail, HailLog, User, Customer
 
 
 blueprint = Blueprint('commands_redis', __name__, cli_group=None)
@@ -16,11 +17,12 @@ blueprint = Blueprint('commands_redis', __name__, cli_group=None)
 
 def _decode_body(body):
     """When a hail is first logged at creation, the payloads are dicts
-    but then all subsequent payloads are logged as serialized"""
-    body = json.loads(body)
+    but then all subsequent payloads were logged as serialized"""
+    if isinstance(body, (str, bytes)):
+        body = json.loads(body)
     if isinstance(body['payload'], str):
         body['payload'] = json.loads(body['payload'])
-    if isinstance(body['return'], str):
+    if isinstance(body.get('return'), str):
         try:
             body['return'] = json.loads(body['return'])
         except json.JSONDecodeError:
@@ -28,6 +30,25 @@ def _decode_body(body):
     return body
 
 
+def _list_hail_bodies(hail_id):
+    """Bodies logged for the hail, oldest first: archived in the table
+    hail_log, then not archived yet in the stream hail_log, then still in the
+    former key hail:<hail_id>."""
+    archived = db.session.query(HailLog).filter(HailLog.hail_id == hail_id).order_by(HailLog.time).all()
+    archived_ids = {log.id for log in archived}
+    bodies = [(log.time.timestamp(), log.data) for log in archived]
+    bodies.extend(
+        (entry.time.timestamp(), entry.data)
+        for entry in redis_backend.list_hail_logs(hail_id)
+        if entry.id not in archived_ids
+    )
+    bodies.extend(
+        (timestamp, body)
+        for body, timestamp in current_app.redis.zrange(f'hail:{hail_id}', 0, -1, withscores=True)
+    )
+    return [_decode_body(body) for _, body in sorted(bodies, key=lambda row: row[0])]
+
+
 @with_appcontext
 def hail_exists(value):
     """Validates hail ID."""
@@ -39,8 +60,7 @@ def hail_exists(value):
 @blueprint.cli.command()
 @click.argument('hail_id', required=True, type=hail_exists)
 def dump_hail(hail_id):
-    for body in current_app.redis.zrange(f'hail:{hail_id}', 0, -1):
-        body = _decode_body(body)
+    for body in _list_hail_bodies(hail_id):
         print(json.dumps(body, indent=2))
         print('---')
 
@@ -56,8 +76,10 @@ def hail_not_exists(value):
 @blueprint.cli.command()
 @click.argument('hail_id', required=True, type=hail_not_exists)
 def restore_hail(hail_id):
-    body = current_app.redis.zrange(f'hail:{hail_id}', -1, -1)[0]
-    body = _decode_body(body)
+    bodies = _list_hail_bodies(hail_id)
+    if not bodies:
+        raise click.ClickException('No request logged for hail %s' % hail_id)
+    body = bodies[-1]
     data = body['return']['data'][0]
     moteur_id = db.session.query(Customer.added_by_id).filter(Customer.id == data['customer_id']).scalar()
     operateur_id = db.session.query(User.id).filter(User.email == data['operateur']).scalar()
@@ -1,68 +1,74 @@
 import click
 from flask import Blueprint, current_app
 from sqlalchemy import func, cast
-from sqlalchemy.orm import joinedload
 
 from APITaxi_models2 import (
     db,
     ADS,
     Taxi,
-    Town,
-    ZUPC,
 )
 from APITaxi_models2.gare import GareVoyageur, CentreVille
 
+from APITaxi2 import town_index
 from APITaxi2.exclusions import ExclusionHelper
 
 
 blueprint = Blueprint('commands_service', __name__, cli_group=None)
 
 
-def _taxis_search(lon, lat, exclusions=False):
-    """Get the number of taxis potentially available at a location.
+def _taxis_search(points, exclusions=False):
+    """Get the number of taxis potentially available at each (lon, lat) of
+    `points`.
 
     Doesn't take into account current avaibility but all registred taxis allowed at this location.
     From their ADS alone, or from belonging to a ZUPC.
 
     If "exclusions" is true, take into account the exclusion rules.
+
+    The towns of all the points are found at once, and the taxis of all the
+    towns allowed are counted with a single query, like POST /taxis/search.
     """
+    lons = [lon for lon, _ in points]
+    lats = [lat for _, lat in points]
+
     # Prior to searching taxis, is the client in a zone where cruising is allowed?
     if exclusions:
-        exclusion_helper = ExclusionHelper()
-        if exclusion_helper.is_at_excluded_zone(lon, lat):
-            return 0
-
-    # First ask in what town the location is
-    towns = Town.query.filter(
-        func.ST_Intersects(Town.shape, f'POINT({lon} {lat})'),
-    ).all()  # Shouldn't happen but in case geometries overlap on OSM
-    if not towns:
-        return 0
-    town = towns[0]
-    current_app.logger.debug('town=%s', town)
-
-    # Now ask the potential ZUPCs the town is part of
-    # There may be several: union of towns, airport, TGV station...
-    zupcs = ZUPC.query.options(
-        joinedload(ZUPC.allowed)
-    ).filter(
-        ZUPC.allowed.contains(town)
-    ).all()
-
-    # Now we know the taxis allowed at this position are the ones from this town
-    # plus the potential other taxis from the ZUPC
-    allowed_insee_codes = {town.insee, *(town.insee for zupc in zupcs for town in zupc.allowed)}
-    current_app.logger.debug('allowed_insee_codes=%s', allowed_insee_codes)
-
-    # Fetch all Taxi and VehicleDescriptions objects related to "locations".
-    query = db.session.query(Taxi).join(
+        excluded = ExclusionHelper().are_at_excluded_zones(lons, lats)
+    else:
+        excluded = [False] * len(points)
+
+    # First ask in what town each location is
+    index = town_index.get_town_index()
+    allowed_insee_codes = []
+    for point_excluded, towns in zip(excluded, index.get_towns_at_points(lons, lats)):
+        if point_excluded or not towns:
+            allowed_insee_codes.append(frozenset())
+            continue
+        town = towns[0]  # Shouldn't happen but in case geometries overlap on OSM
+        current_app.logger.debug('town=%s', town)
+
+        # Now we know the taxis allowed at this position are the ones from this town
+        # plus the potential other taxis from the ZUPC (union of towns, airport, TGV station...)
+        allowed_insee_codes.append(index.get_allowed_insee_codes(town))
+        current_app.logger.debug('allowed_insee_codes=%s', allowed_insee_codes[-1])
+
+    # Count the taxis of each town allowed somewhere, each taxi has one ADS.
+    query = db.session.query(
+        ADS.insee, func.count(Taxi.id)
+    ).join(
         ADS
     ).filter(
-        ADS.insee.in_(allowed_insee_codes)
+        ADS.insee.in_(frozenset().union(*allowed_insee_codes))
+    ).group_by(
+        ADS.insee
     )
     current_app.logger.debug('query=%s', query)
+    taxis_by_insee = dict(query.all())
 
-    return query.count()
+    return [
+        sum(taxis_by_insee.get(insee, 0) for insee in insee_codes)
+        for insee_codes in allowed_insee_codes
+    ]
 
 
 @blueprint.cli.group()
@@ -97,13 +103,15 @@ def gares(drg):
             func.lower(GareVoyageur.segmentdrg_libelle) == drg
         )
 
-    for gare, population, distance in query:
+    rows = query.all()
+    counts = _taxis_search([
+        (gare.longitude_entreeprincipale_wgs84, gare.latitude_entreeprincipale_wgs84)
+        for gare, _, _ in rows
+    ])
+    for (gare, population, distance), count in zip(rows, counts):
         print(
             gare.gare_alias_libelle_noncontraint,
-            _taxis_search(
-                gare.longitude_entreeprincipale_wgs84,
-                gare.latitude_entreeprincipale_wgs84,
-            ),
+            count,
             population,
             round(distance / 1000, 1),
             sep='\t'
@@ -13,6 +13,8 @@ import shapefile
 
 from APITaxi_models2 import db, ADS, Town, ZUPC
 
+from APITaxi2 import redis_backend, reference_data, town_index
+
 
 blueprint = Blueprint('commands_towns', __name__, cli_group=None)
 
@@ -98,6 +100,11 @@ def update_ads_new_insee_codes(zupc_repo):
             current_app.logger.info('Reassigning INSEE code %s to %s', old_insee, new_insee)
 
     db.session.commit()
+    town_index.bump_version()
+    reference_data.publish_reload()
+    # Taxis of the updated ADS must be stored in the geo indexes of their new INSEE code
+    redis_backend.clear_taxis_insee()
+    redis_backend.clear_taxis_search_metadata()
     print("Done, probably safer to review and reimport ZUPC with the new INSEE codes.")
 
 
@@ -136,6 +143,8 @@ def update_towns_from_contours(shape_filename):
         db.session.delete(old_town)
 
     db.session.commit()
+    town_index.bump_version()
+    reference_data.publish_reload()
     print("Done")
 
 
@@ -9,6 +9,8 @@ from sqlalchemy import func
 from APITaxi_models2 import db, Town, ZUPC
 from APITaxi_models2.zupc import town_zupc
 
+from APITaxi2 import reference_data, town_index
+
 
 blueprint = Blueprint('commands_zupc', __name__, cli_group=None)
 
@@ -90,6 +92,8 @@ def fill_zupc_table_from_arretes(zupc_repo):
         # Skip train and airport stations for now
 
     db.session.commit()
+    town_index.bump_version()
+    reference_data.publish_reload()
 
 
 class PathlibPath(click.Path):
@@ -173,6 +177,8 @@ def add(zupc_dir):
     """Add or update a single ZUPC from a directory containing the descriptive zone.yaml"""
     fill_zupc_union(zupc_dir)
     db.session.commit()
+    town_index.bump_version()
+    reference_data.publish_reload()
 
 
 @zupc.command()
@@ -187,3 +193,5 @@ def remove(zupc_id):
     if click.confirm("Delete?"):
         db.session.delete(zupc)
         db.session.commit()
+        town_index.bump_version()
+        reference_data.publish_reload()
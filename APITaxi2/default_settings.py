@@ -16,10 +16,15 @@ _ONE_DAY = _ONE_HOUR * 24
 _SEVEN_DAYS = _ONE_DAY * 7
 
 CELERY_BEAT_SCHEDULE = {
-    'clean-geoindex-timestamps': {
-        'task': 'clean_geoindex_timestamps',
-        # Every 10 minutes
-        'schedule': _ONE_MINUTE * 10
+    'expire-positions': {
+        'task': 'expire_positions',
+        # Every 5 seconds
+        'schedule': 5
+    },
+
+    'archive-hail-logs': {
+        'task': 'archive_hail_logs',
+        'schedule': _ONE_MINUTE,
     },
 
     # Every minute, store the list of taxis available the last minute.
@@ -52,6 +57,10 @@ CELERY_BEAT_SCHEDULE = {
 
     # crontab
 
+    'clean-geoindex-timestamps': {
+        'task': 'clean_geoindex_timestamps',
+        'schedule': crontab(hour=3, minute=0),
+    },
     'blur-geotaxi': {
         'task': 'blur_geotaxi',
         'schedule': crontab(hour=4, minute=0),
@@ -143,6 +152,27 @@ for _env_var, _alt_name, _env_type in (
     ('NEUTRAL_OPERATOR', None, parse_env_bool),
     ('FAKE_TAXI_ID', None, parse_env_bool),
     ('HAIL_TAXI_VEHICLE_DETAILS', None, parse_env_list(int)),
+    ('GEOTAXI_BULK_MAX_POSITIONS', None, int),
+    ('GEOTAXI_MOVE_THRESHOLD', None, float),
+    ('GEOTAXI_PACKED_POSITIONS', None, parse_env_bool),
+    ('GEOTAXI_BUCKETS', None, int),
+    ('TAXIS_SEARCH_OVER_FETCH', None, int),
+    ('LOCATION_STORE', None, str),
+    ('LOCATION_STORE_SYNC', None, parse_env_bool),
+    ('SEARCH_CACHE_TTL', None, float),
+    ('SEARCH_CACHE_GRID', None, float),
+    ('REDIS_GEO_SHARDS', None, parse_env_list(str)),
+    ('REDIS_GEO_WRITE_MAX_CONNECTIONS', None, int),
+    ('REDIS_GEO_WRITE_SOCKET_TIMEOUT', None, float),
+    ('REDIS_GEO_READ_URL', None, str),
+    ('REDIS_GEO_READ_MAX_CONNECTIONS', None, int),
+    ('REDIS_GEO_READ_SOCKET_TIMEOUT', None, float),
+    ('REDIS_AUDIT_URL', None, str),
+    ('REDIS_AUDIT_MAX_CONNECTIONS', None, int),
+    ('REDIS_AUDIT_SOCKET_TIMEOUT', None, float),
+    ('REDIS_BACKGROUND_URL', None, str),
+    ('REDIS_BACKGROUND_MAX_CONNECTIONS', None, int),
+    ('REDIS_BACKGROUND_SOCKET_TIMEOUT', None, float),
 ):
     _val = os.getenv(_alt_name) if _alt_name else os.getenv(_env_var)
     if not _val:
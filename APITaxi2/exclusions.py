@@ -1,6 +1,8 @@
 from functools import lru_cache
 
 from geoalchemy2.shape import to_shape
+import numpy as np
+import shapely
 from shapely.geometry import Point
 from shapely.strtree import STRtree
 
@@ -11,6 +13,8 @@ from APITaxi_models2 import db, Exclusion
 @lru_cache()
 def _load_exclusion_tree():
     shapes = [to_shape(shape) for shape, in db.session.query(Exclusion.shape)]
+    # Prepared geometries make the exact tests below much faster
+    shapely.prepare(shapes)
     # We don't need to keep track of which zone, just it exists
     return STRtree(shapes)
 
@@ -28,8 +32,25 @@ class ExclusionHelper:
         if lon == 0.0 and lat == 0.0:  # Seen in production
             return None
         point = Point(lon, lat)
+        # The bounding boxes of the tree are only a first filter, the
+        # predicate tests the shapes themselves.
         # __bool__ is not implemented on the resulting array itself...
-        return bool(self._tree.query(point).size)
+        return bool(self._tree.query(point, predicate='intersects').size)
+
+    def are_at_excluded_zones(self, lons, lats):
+        """Vectorized is_at_excluded_zone(): return an array of booleans,
+        whether each point of the arrays `lons` and `lats` is in an excluded
+        zone."""
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        excluded = np.zeros(lons.shape, dtype=bool)
+        # A single query of the tree for all the points returns the pairs
+        # (index of the point, index of the zone) which intersect
+        point_indices, _ = self._tree.query(shapely.points(lons, lats), predicate='intersects')
+        excluded[point_indices] = True
+        # Seen in production
+        excluded[(lons == 0.0) & (lats == 0.0)] = False
+        return excluded
 
     def reset(self):
         _load_exclusion_tree.cache_clear()
@@ -0,0 +1,95 @@
+"""Temporary taxi IDs returned by the search when the setting FAKE_TAXI_ID is
+set, so clients can't follow a taxi from one search to another.
+
+A fake ID is the real taxi ID encrypted and authenticated with keys derived
+from SECRET_KEY and the email of the client, along with the time it was
+issued. It is decoded without storing anything, instead of a mapping in
+redis written by each search.
+
+Only the standard library is used: the encryption XORs the taxi ID with a
+keystream of HMAC-SHA256 blocks, and the result is authenticated with
+another HMAC-SHA256, truncated.
+"""
+
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import struct
+import time
+
+from flask import current_app
+
+
+# Fake IDs expire after this delay (in seconds), like the former mapping in
+# redis, waiting for one of the taxis of the search to be hailed.
+FAKE_TAXI_ID_TTL = 3600
+# Fake IDs are issued in time buckets of this duration (in seconds)
+TIME_BUCKET = 60
+
+_VERSION = 1
+# version, time bucket, random nonce
+_HEADER = struct.Struct('>BII')
+_TAG_SIZE = 8
+
+
+def _get_keys(user):
+    secret_key = current_app.config['SECRET_KEY'].encode('utf8')
+    email = user.email.encode('utf8')
+    return (
+        hmac.new(secret_key, b'fake_taxi_id:encryption:' + email, hashlib.sha256).digest(),
+        hmac.new(secret_key, b'fake_taxi_id:authentication:' + email, hashlib.sha256).digest(),
+    )
+
+
+def _xor_keystream(encryption_key, header, data):
+    keystream = b''.join(
+        hmac.new(encryption_key, header + struct.pack('>I', counter), hashlib.sha256).digest()
+        for counter in range(len(data) // hashlib.sha256().digest_size + 1)
+    )
+    return bytes(a ^ b for a, b in zip(data, keystream))
+
+
+def _tag(authentication_key, data):
+    return hmac.new(authentication_key, data, hashlib.sha256).digest()[:_TAG_SIZE]
+
+
+def encode(user, taxi_id):
+    """Return a fake ID of `taxi_id`, which can only be decoded for `user`."""
+    encryption_key, authentication_key = _get_keys(user)
+    header = _HEADER.pack(
+        _VERSION,
+        int(time.time()) // TIME_BUCKET,
+        struct.unpack('>I', os.urandom(4))[0],
+    )
+    data = header + _xor_keystream(encryption_key, header, taxi_id.encode('utf8'))
+    return base64.urlsafe_b64encode(data + _tag(authentication_key, data)).decode('ascii').rstrip('=')
+
+
+def decode(user, fake_taxi_id):
+    """Return the taxi ID encoded by encode() for `user`, or None if
+    `fake_taxi_id` is not a valid fake ID for `user`, or has expired."""
+    try:
+        raw = base64.urlsafe_b64decode(fake_taxi_id + '=' * (-len(fake_taxi_id) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    if len(raw) <= _HEADER.size + _TAG_SIZE:
+        return None
+
+    data, tag = raw[:-_TAG_SIZE], raw[-_TAG_SIZE:]
+    encryption_key, authentication_key = _get_keys(user)
+    if not hmac.compare_digest(tag, _tag(authentication_key, data)):
+        return None
+
+    version, time_bucket, _ = _HEADER.unpack(data[:_HEADER.size])
+    if version != _VERSION:
+        return None
+    if int(time.time()) // TIME_BUCKET - time_bucket > FAKE_TAXI_ID_TTL // TIME_BUCKET:
+        return None
+
+    header = data[:_HEADER.size]
+    try:
+        return _xor_keystream(encryption_key, header, data[_HEADER.size:]).decode('utf8')
+    except UnicodeDecodeError:
+        return None
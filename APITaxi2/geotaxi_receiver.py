@@ -0,0 +1,246 @@
+"""Asynchronous receiver of taxi positions, compatible with the protocol of the
+legacy geotaxi worker.
+
+Each UDP datagram is a JSON object such as:
+
+>>> {
+...     "timestamp": 1430076493,
+...     "operator": "<operator email>",
+...     "taxi": "<taxi id>",
+...     "lat": 48.86,
+...     "lon": 2.35,
+...     "device": "phone",
+...     "status": "free",
+...     "version": "2",
+...     "hash": "<sha1>"
+... }
+
+where "hash" is the SHA1 hex digest of the fields timestamp, operator, taxi,
+lat, lon, device, status and version concatenated, followed by the API key of
+the operator.
+
+Datagrams are buffered for a few milliseconds, then flushed to redis by batch
+with redis_backend.update_taxi_positions(), like POST /geotaxi. Flushes run in
+a dedicated thread so the event loop never waits for redis or PostgreSQL.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+
+from APITaxi_models2 import db, Role, User
+
+from . import processes, redis_backend
+
+
+HASH_FIELDS = ('timestamp', 'operator', 'taxi', 'lat', 'lon', 'device', 'status', 'version')
+
+# Flush received positions after this delay (in seconds)...
+FLUSH_INTERVAL = 0.005
+# ... or as soon as this number of positions is received.
+MAX_BATCH_SIZE = 1000
+
+# Reload operators and their API keys from the database after this delay (in seconds)
+OPERATORS_REFRESH_INTERVAL = 60
+
+Operator = collections.namedtuple('Operator', ['id', 'email', 'apikey'])
+
+
+def load_operators():
+    """Return the dictionary {email: Operator} of the users allowed to report
+    taxi positions."""
+    query = db.session.query(User.id, User.email, User.apikey).filter(
+        User.roles.any(Role.name.in_(['admin', 'operateur']))
+    )
+    return {email: Operator(id_, email, apikey) for id_, email, apikey in query}
+
+
+def compute_hash(message, apikey):
+    value = ''.join(str(message[field]) for field in HASH_FIELDS) + apikey
+    return hashlib.sha1(value.encode('utf8')).hexdigest()
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def datagram_received(self, data, addr):
+        self.receiver.handle_datagram(data)
+
+
+class GeotaxiReceiver:
+    """Receive positions with handle_datagram(), and store them by batch.
+
+    `operators` is the dictionary {email: Operator} used to authenticate
+    messages. If `load_operators_func` is set, it is called periodically in
+    the flush thread to refresh `operators`.
+
+    If `check_ownership` is False, positions of taxis not owned by the
+    operator are stored anyway, like the legacy geotaxi worker did.
+    """
+    def __init__(self, app, operators=None, load_operators_func=None, check_ownership=True,
+                 flush_interval=FLUSH_INTERVAL, max_batch_size=MAX_BATCH_SIZE, redis_client=None):
+        self.app = app
+        self.operators = operators or {}
+        self.load_operators_func = load_operators_func
+        self.check_ownership = check_ownership
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.redis_client = redis_client
+
+        self.stats = collections.Counter()
+
+        # {operator email: {taxi_id: position}}, only the last position of a
+        # taxi is kept
+        self._pending = collections.defaultdict(dict)
+        self._pending_count = 0
+        self._flush_handle = None
+        self._flushes = set()
+        # A single thread, so batches are stored in the order they are received
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='geotaxi')
+
+    async def start(self, host, port):
+        """Listen on host:port, return the asyncio transport."""
+        loop = asyncio.get_running_loop()
+        if self.load_operators_func:
+            await self.refresh_operators()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DatagramProtocol(self), local_addr=(host, port)
+        )
+        return transport
+
+    async def refresh_operators(self):
+        self.operators = await self._run_in_executor(self.load_operators_func)
+
+    async def refresh_operators_forever(self, interval=OPERATORS_REFRESH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh_operators()
+            except Exception:
+                self.app.logger.exception('Unable to refresh the list of operators')
+
+    def parse_message(self, data):
+        """Return the tuple (operator email, position) if the datagram is valid
+        and authenticated, or None."""
+        try:
+            message = json.loads(data)
+            operator = self.operators.get(message['operator'])
+            if not operator:
+                self.stats['unauthorized'] += 1
+                return None
+            if compute_hash(message, operator.apikey) != message['hash']:
+                self.stats['unauthorized'] += 1
+                return None
+            lon, lat = float(message['lon']), float(message['lat'])
+            taxi_id = str(message['taxi'])
+        except (ValueError, TypeError, KeyError):
+            self.stats['invalid'] += 1
+            return None
+
+        # Same validation as schemas.PositionMixin
+        if not -180 <= lon <= 180 or not -85.05112878 <= lat <= 85.05112878:
+            self.stats['invalid'] += 1
+            return None
+
+        return operator.email, {'taxi_id': taxi_id, 'lon': lon, 'lat': lat}
+
+    def handle_datagram(self, data):
+        self.stats['received'] += 1
+        parsed = self.parse_message(data)
+        if not parsed:
+            return
+
+        operator_email, position = parsed
+        self._pending[operator_email][position['taxi_id']] = position
+        self._pending_count += 1
+
+        if self._pending_count >= self.max_batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Send pending positions to the flush thread."""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+
+        batch, self._pending, self._pending_count = self._pending, collections.defaultdict(dict), 0
+        future = self._run_in_executor(self._store, batch)
+        self._flushes.add(future)
+        future.add_done_callback(self._flush_done)
+
+    def _flush_done(self, future):
+        self._flushes.discard(future)
+        if future.exception():
+            self.app.logger.error('Unable to store positions', exc_info=future.exception())
+
+    async def drain(self):
+        """Flush pending positions and wait until they are stored."""
+        self.flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def _run_in_executor(self, func, *args):
+        """Call func(*args) in the flush thread, within an application
+        context. Return an asyncio future."""
+        loop = asyncio.get_running_loop()
+
+        # Like Celery tasks (see celery_init_app), don't open another
+        # application context during tests, otherwise objects created by test
+        # factories are not visible.
+        if self.app.testing:
+            future = loop.create_future()
+            try:
+                future.set_result(func(*args))
+            except Exception as exc:
+                future.set_exception(exc)
+            return future
+
+        return loop.run_in_executor(self._executor, self._in_app_context, func, *args)
+
+    def _in_app_context(self, func, *args):
+        with self.app.app_context():
+            return func(*args)
+
+    def _store(self, batch):
+        for operator_email, positions in batch.items():
+            if self.check_ownership:
+                operator = self.operators.get(operator_email)
+                # Removed while the positions were pending
+                if not operator:
+                    continue
+                unknown_taxi_ids = processes.get_unknown_taxi_ids(operator, positions)
+                if unknown_taxi_ids:
+                    self.stats['unknown_taxi'] += len(unknown_taxi_ids)
+                    positions = {
+                        taxi_id: position for taxi_id, position in positions.items()
+                        if taxi_id not in unknown_taxi_ids
+                    }
+            self.stats['stored'] += redis_backend.update_taxi_positions(
+                positions.values(), operator_email, client=self.redis_client,
+                taxis_insee=processes.get_taxis_insee(positions)
+            )
+
+
+async def serve(app, host, port, flush_interval=FLUSH_INTERVAL, stats_interval=60):
+    """Run the receiver forever, and log statistics every `stats_interval`
+    seconds."""
+    receiver = GeotaxiReceiver(app, load_operators_func=load_operators, flush_interval=flush_interval)
+    transport = await receiver.start(host, port)
+    app.logger.info('Listening for positions on %s:%s', host, port)
+
+    refresh_task = asyncio.create_task(receiver.refresh_operators_forever())
+    try:
+        while True:
+            await asyncio.sleep(stats_interval)
+            app.logger.info('Geotaxi receiver stats: %s', dict(receiver.stats))
+    finally:
+        refresh_task.cancel()
+        transport.close()
+        await receiver.drain()
@@ -0,0 +1,335 @@
+"""Stores of the taxi locations searched by GET /taxis.
+
+The setting LOCATION_STORE selects the implementation:
+
+- "redis" (default): the geo indexes of redis, see
+  redis_backend.taxis_locations_by_operator()
+- "memory": an index in the memory of each process, kept in sync from the
+  stream of positions written by redis_backend.update_taxi_positions(). Each
+  process holds all the locations, and searches don't make any network
+  round-trip. Meant for single node deployments and benchmarks.
+
+Both implementations return the same results, see
+tests/test_location_store.py.
+"""
+
+import abc
+import collections
+from datetime import datetime
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from flask import current_app
+import numpy as np
+import redis
+
+from . import redis_backend, redis_clients
+from .tasks.clean import POSITION_MAX_AGE
+
+
+logger = logging.getLogger(__name__)
+
+# Radius of the earth used by redis to compute distances
+EARTH_RADIUS = 6372797.560856
+
+# Size (in degrees) of the cells of the grid of the in-memory index, about
+# 1.1km x 0.75km in metropolitan France.
+MEMORY_CELL_SIZE = 0.01
+
+# Maximum number of entries of the stream of positions read at once
+SYNC_BATCH_SIZE = 1000
+# Time (in milliseconds) the subscriber waits for new positions
+SYNC_BLOCK = 1000
+# Locations older than POSITION_MAX_AGE are removed every EXPIRE_INTERVAL
+# seconds, like the task expire_positions does for redis.
+EXPIRE_INTERVAL = 5
+
+
+class LocationStore(abc.ABC):
+    """Interface of the stores of taxi locations."""
+
+    @abc.abstractmethod
+    def search(self, lon, lat, distance, insee_codes=None, count=None):
+        """Return the locations within `distance` meters of (lon, lat), with
+        the same arguments and result as
+        redis_backend.taxis_locations_by_operator()."""
+
+    def is_truncated(self, locations, count):
+        """Whether the result of search() with `count` might have left out
+        taxis within the distance, see redis_backend.is_truncated()."""
+        return redis_backend.is_truncated(locations, count)
+
+
+class RedisLocationStore(LocationStore):
+    """Locations searched in the geo indexes of redis, written by
+    redis_backend.update_taxi_positions()."""
+
+    def search(self, lon, lat, distance, insee_codes=None, count=None):
+        return redis_backend.taxis_locations_by_operator(lon, lat, distance, insee_codes=insee_codes, count=count)
+
+
+class MemoryLocationStore(LocationStore):
+    """Locations stored in NumPy arrays, one slot per taxi_id:operator, and
+    indexed by a grid of MEMORY_CELL_SIZE degrees. A search only computes the
+    distances of the slots of the cells within the radius, vectorized.
+
+    The store is filled with load() from the geo indexes of redis, then kept in
+    sync with sync() from the stream redis_backend.POSITIONS_STREAM. The
+    entries written between load() and the first sync() are read by both, and
+    applied twice.
+
+    Searches run concurrently with the updates of the subscriber thread,
+    hence the lock.
+    """
+
+    def __init__(self, capacity=1024):
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._members = []
+        self._insee = []
+        self._cell = []
+        self._free = []
+        self._cells = collections.defaultdict(set)
+        self._lon = np.zeros(capacity)
+        self._lat = np.zeros(capacity)
+        self._timestamp = np.zeros(capacity)
+        self.last_id = '0-0'
+
+    def __len__(self):
+        return len(self._slots)
+
+    @staticmethod
+    def _get_cell(lon, lat):
+        return (math.floor(lon / MEMORY_CELL_SIZE), math.floor(lat / MEMORY_CELL_SIZE))
+
+    def _allocate(self, member):
+        if self._free:
+            slot = self._free.pop()
+            self._members[slot] = member
+            return slot
+
+        slot = len(self._members)
+        if slot >= len(self._lon):
+            size = len(self._lon) * 2
+            self._lon = np.resize(self._lon, size)
+            self._lat = np.resize(self._lat, size)
+            self._timestamp = np.resize(self._timestamp, size)
+        self._members.append(member)
+        self._insee.append('')
+        self._cell.append(None)
+        return slot
+
+    def update(self, positions, operator_name, timestamp, taxis_insee=None):
+        """Store the positions of an operator, with the same arguments as
+        redis_backend.update_taxi_positions(). Positions older than the
+        location already stored are ignored."""
+        taxis_insee = taxis_insee or {}
+        with self._lock:
+            for position in positions:
+                member = f'{position["taxi_id"]}:{operator_name}'
+                slot = self._slots.get(member)
+                if slot is None:
+                    slot = self._slots[member] = self._allocate(member)
+                elif self._timestamp[slot] > timestamp:
+                    continue
+
+                lon, lat = float(position['lon']), float(position['lat'])
+                cell = self._get_cell(lon, lat)
+                if cell != self._cell[slot]:
+                    if self._cell[slot] is not None:
+                        self._cells[self._cell[slot]].discard(slot)
+                    self._cells[cell].add(slot)
+                    self._cell[slot] = cell
+
+                self._lon[slot] = lon
+                self._lat[slot] = lat
+                self._timestamp[slot] = timestamp
+                # Like the geo indexes geoindex_insee:<insee>, a location stays
+                # in the index of its former town if the INSEE code is unknown
+                self._insee[slot] = taxis_insee.get(position['taxi_id']) or self._insee[slot]
+
+    def expire(self, max_time):
+        """Remove the locations stored before `max_time`, like the task
+        expire_positions. Return the number of locations removed."""
+        with self._lock:
+            used = np.fromiter(self._slots.values(), dtype=np.int64, count=len(self._slots))
+            expired = used[self._timestamp[used] <= max_time]
+            for slot in expired.tolist():
+                del self._slots[self._members[slot]]
+                self._cells[self._cell[slot]].discard(slot)
+                if not self._cells[self._cell[slot]]:
+                    del self._cells[self._cell[slot]]
+                self._members[slot] = None
+                self._insee[slot] = ''
+                self._cell[slot] = None
+                self._free.append(slot)
+            return len(expired)
+
+    def _get_slots_within(self, lon, lat, distance):
+        # Degrees of latitude and longitude within the distance. Longitudes
+        # are wider near the poles, stop at 89 degrees.
+        delta_lat = math.degrees(distance / EARTH_RADIUS)
+        delta_lon = delta_lat / math.cos(math.radians(min(abs(lat) + delta_lat, 89)))
+        min_x, min_y = self._get_cell(lon - delta_lon, lat - delta_lat)
+        max_x, max_y = self._get_cell(lon + delta_lon, lat + delta_lat)
+
+        slots = []
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                slots.extend(self._cells.get((x, y), ()))
+        return np.array(slots, dtype=np.int64)
+
+    def search(self, lon, lat, distance, insee_codes=None, count=None):
+        with self._lock:
+            slots = self._get_slots_within(lon, lat, distance)
+            if insee_codes is not None:
+                slots = slots[[self._insee[slot] in insee_codes for slot in slots.tolist()]]
+
+            # Haversine distance, the same formula as redis
+            lon1, lat1 = math.radians(lon), math.radians(lat)
+            lon2, lat2 = np.radians(self._lon[slots]), np.radians(self._lat[slots])
+            u = np.sin((lat2 - lat1) / 2)
+            v = np.sin((lon2 - lon1) / 2)
+            distances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(u * u + math.cos(lat1) * np.cos(lat2) * v * v))
+
+            within = distances <= distance
+            slots, distances = slots[within], distances[within]
+            order = np.argsort(distances, kind='stable')
+            if count:
+                order = order[:count]
+
+            rows = [
+                (self._members[slot], self._lon[slot], self._lat[slot], distance, self._timestamp[slot])
+                for slot, distance in zip(slots[order].tolist(), distances[order].tolist())
+            ]
+
+        locations = {}
+        for member, location_lon, location_lat, location_distance, timestamp in rows:
+            taxi_id, operator = member.split(':')
+            locations.setdefault(taxi_id, {})[operator] = redis_backend.Location(
+                lon=float(location_lon),
+                lat=float(location_lat),
+                distance=location_distance,
+                update_date=datetime.fromtimestamp(float(timestamp)),
+            )
+        return locations
+
+    def load(self):
+        """Fill the store with the locations of the geo indexes of redis. The
+        stream will be read from the last entry written before."""
+        client = redis_clients.get('geo_write')
+        last_entries = client.xrevrange(redis_backend.POSITIONS_STREAM, count=1)
+        last_id = last_entries[0][0].decode('utf8') if last_entries else '0-0'
+
+        for shard in redis_backend.get_geo_shards():
+            insee_by_member = {}
+            for key in redis_backend.list_geoindex_insee_keys(shard):
+                insee = key.decode('utf8').split(':', 1)[1]
+                for member in shard.zrange(key, 0, -1):
+                    insee_by_member[member] = insee
+
+            timestamps = shard.zrange('timestamps', 0, -1, withscores=True)
+            for start in range(0, len(timestamps), SYNC_BATCH_SIZE):
+                batch = timestamps[start:start + SYNC_BATCH_SIZE]
+                coordinates = shard.geopos('geoindex_2', *(member for member, _ in batch))
+                for (member, timestamp), coordinate in zip(batch, coordinates):
+                    if not coordinate:
+                        continue
+                    taxi_id, operator = member.decode('utf8').split(':')
+                    self.update(
+                        [{'taxi_id': taxi_id, 'lon': coordinate[0], 'lat': coordinate[1]}],
+                        operator,
+                        timestamp,
+                        {taxi_id: insee_by_member[member]} if member in insee_by_member else None
+                    )
+
+        self.last_id = last_id
+
+    def sync(self, block=None):
+        """Apply the positions written to the stream since the last call.
+        If `block` is given, wait up to `block` milliseconds for new
+        positions. Return the number of entries read."""
+        client = redis_clients.get('geo_write')
+        read = 0
+        while True:
+            response = client.xread({redis_backend.POSITIONS_STREAM: self.last_id}, count=SYNC_BATCH_SIZE, block=block)
+            entries = response[0][1] if response else []
+            for entry_id, fields in entries:
+                data = json.loads(fields[b'data'])
+                self.update(
+                    [{'taxi_id': taxi_id, 'lon': lon, 'lat': lat} for taxi_id, lon, lat, _ in data['positions']],
+                    data['operator'],
+                    data['timestamp'],
+                    {taxi_id: insee for taxi_id, _, _, insee in data['positions'] if insee}
+                )
+                self.last_id = entry_id.decode('utf8')
+            read += len(entries)
+            if len(entries) < SYNC_BATCH_SIZE:
+                return read
+            block = None
+
+
+class MemoryLocationStoreSubscriber(threading.Thread):
+    """Thread loading the store, then applying the positions of the stream as
+    soon as they are written, and expiring the old locations."""
+
+    def __init__(self, app, store):
+        super().__init__(name='location-store-subscriber', daemon=True)
+        self.app = app
+        self.store = store
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """Stop the thread, once the stream has been read for up to
+        SYNC_BLOCK milliseconds."""
+        self._stopped.set()
+
+    def run(self):
+        with self.app.app_context():
+            while not self._stopped.is_set():
+                try:
+                    self.store.load()
+                    last_expire = time.time()
+                    while not self._stopped.is_set():
+                        self.store.sync(block=SYNC_BLOCK)
+                        if time.time() - last_expire >= EXPIRE_INTERVAL:
+                            last_expire = time.time()
+                            self.store.expire(last_expire - POSITION_MAX_AGE)
+                except redis.exceptions.RedisError:
+                    # Positions written while redis was unreachable may have
+                    # been trimmed from the stream, load everything again.
+                    logger.exception('Unable to read the stream of positions, retrying')
+                    self._stopped.wait(SYNC_BLOCK / 1000)
+
+
+def get_location_store():
+    """Return the store selected by the setting LOCATION_STORE.
+
+    The in-memory store is created on the first call of each process, so
+    workers forked by the application server don't share it. It is kept in
+    sync by a MemoryLocationStoreSubscriber thread, or, if the setting
+    LOCATION_STORE_SYNC is set, by reading the stream synchronously before
+    each search, as tests do.
+    """
+    name = current_app.config.get('LOCATION_STORE') or 'redis'
+    if name == 'redis':
+        return RedisLocationStore()
+    if name != 'memory':
+        raise ValueError(f'Invalid setting LOCATION_STORE={name!r}, expected "redis" or "memory"')
+
+    sync = current_app.config.get('LOCATION_STORE_SYNC')
+    store, pid = current_app.extensions.get('memory_location_store', (None, None))
+    if store is None or pid != os.getpid():
+        store = MemoryLocationStore()
+        current_app.extensions['memory_location_store'] = (store, os.getpid())
+        if sync:
+            store.load()
+        else:
+            MemoryLocationStoreSubscriber(current_app._get_current_object(), store).start()
+    if sync:
+        store.sync()
+    return store
@@ -1 +1,2 @@
 from .hails import change_status  # noqa
+from .positions import get_taxis_insee, get_unknown_taxi_ids  # noqa
@@ -0,0 +1,53 @@
+from APITaxi_models2 import db, ADS, Taxi, Vehicle, VehicleDescription
+
+from .. import redis_backend
+
+
+def _query_owned_taxi_ids(operator, taxi_ids=None):
+    query = db.session.query(Taxi.id).join(Vehicle).join(VehicleDescription).filter(
+        # For taxis registered with several operators, filter on the description,
+        # not the Taxi.added_by
+        VehicleDescription.added_by_id == operator.id
+    )
+    if taxi_ids is not None:
+        query = query.filter(Taxi.id.in_(taxi_ids))
+    return {id_ for id_, in query}
+
+
+def get_unknown_taxi_ids(operator, taxi_ids):
+    """Return the subset of `taxi_ids` not owned by `operator`, which is a User
+    or any object with the attributes "id" and "email".
+
+    Ownership is checked against the redis set of taxis of the operator, which
+    is loaded from the database the first time, and then after it expires.
+    """
+    owned_taxi_ids = redis_backend.filter_owned_taxi_ids(operator.email, taxi_ids)
+    if owned_taxi_ids is None:
+        all_owned_taxi_ids = _query_owned_taxi_ids(operator)
+        redis_backend.set_owned_taxi_ids(operator.email, all_owned_taxi_ids)
+        owned_taxi_ids = all_owned_taxi_ids & set(taxi_ids)
+
+    unknown_taxi_ids = set(taxi_ids) - owned_taxi_ids
+    if unknown_taxi_ids:
+        # The set may be outdated, confirm with the database before rejecting
+        confirmed_taxi_ids = _query_owned_taxi_ids(operator, unknown_taxi_ids)
+        redis_backend.add_owned_taxi_ids(operator.email, confirmed_taxi_ids)
+        unknown_taxi_ids -= confirmed_taxi_ids
+    return unknown_taxi_ids
+
+
+def get_taxis_insee(taxi_ids):
+    """Return the dictionary {taxi_id: INSEE code of the ADS} of `taxi_ids`.
+
+    INSEE codes are read from the redis cache, and taxis not cached yet are
+    loaded from the database. Taxis not found are not returned.
+    """
+    taxi_ids = set(taxi_ids)
+    taxis_insee = redis_backend.get_taxis_insee(taxi_ids)
+    missing_taxi_ids = taxi_ids - taxis_insee.keys()
+    if missing_taxi_ids:
+        query = db.session.query(Taxi.id, ADS.insee).join(Taxi.ads).filter(Taxi.id.in_(missing_taxi_ids))
+        missing_taxis_insee = {taxi_id: insee for taxi_id, insee in query}
+        redis_backend.set_taxis_insee(missing_taxis_insee)
+        taxis_insee.update(missing_taxis_insee)
+    return taxis_insee
@@ -1,22 +1,149 @@
 """This module gathers functions to access data stored in redis."""
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 import json
+import math
+import struct
 import time
+import zlib
 
 from flask import current_app
+import redis
 
+from . import redis_clients, redis_scripts
 
-@dataclass
+
+# The set of taxis owned by an operator is refreshed from the database after
+# this delay
+OWNED_TAXI_IDS_TTL = timedelta(hours=1)
+
+# When GEOTAXI_MOVE_THRESHOLD is set, positions of taxis which didn't move are
+# still fully stored after this delay (in seconds). Must be lower than the two
+# minutes after which expire_positions expires the geo indexes.
+COALESCE_MAX_AGE = 60
+
+# Size (in degrees) of the cells of the grid used to shard the geo indexes,
+# about 110km x 75km in metropolitan France.
+GEO_SHARD_CELL_SIZE = 1.0
+
+
+def get_geo_shards():
+    """Return the list of redis clients storing the geo indexes geoindex,
+    geoindex_2, timestamps and timestamps_id.
+
+    If the setting REDIS_GEO_SHARDS (a list of redis URLs) is not set, the geo
+    indexes are stored with everything else on the default redis client.
+    Otherwise, the world is split in a grid of GEO_SHARD_CELL_SIZE degrees,
+    and each cell is stored on one of the shards, see get_geo_shard().
+
+    Other keys, such as taxi:<taxi_id> or last_seen, are never sharded.
+    """
+    urls = current_app.config.get('REDIS_GEO_SHARDS')
+    if not urls:
+        return [current_app.redis]
+
+    shards = current_app.extensions.get('redis_geo_shards')
+    if shards is None:
+        shards = current_app.extensions['redis_geo_shards'] = [redis.Redis.from_url(url) for url in urls]
+    return shards
+
+
+def _geo_shard_index(cell_x, cell_y, shards_count):
+    if shards_count == 1:
+        return 0
+    return zlib.crc32(b'%d:%d' % (cell_x, cell_y)) % shards_count
+
+
+def get_geo_shard(lon, lat):
+    """Return the shard storing the location (lon, lat)."""
+    shards = get_geo_shards()
+    cell_x, cell_y = math.floor(lon / GEO_SHARD_CELL_SIZE), math.floor(lat / GEO_SHARD_CELL_SIZE)
+    return shards[_geo_shard_index(cell_x, cell_y, len(shards))]
+
+
+def get_geo_shards_within(lon, lat, distance):
+    """Return the shards storing the locations within `distance` meters of
+    (lon, lat). Near the border of a cell, the shards of the neighbouring cells
+    are returned too.
+
+    If the geo indexes are not sharded, return the client geo_read, which can
+    be a replica."""
+    if not current_app.config.get('REDIS_GEO_SHARDS'):
+        return [redis_clients.get('geo_read')]
+    shards = get_geo_shards()
+    if len(shards) == 1:
+        return shards
+
+    # Bounding box of the circle, same approximation as redis_scripts.UPDATE_POSITIONS
+    delta_lat = distance / 110540
+    delta_lon = distance / (111320 * max(math.cos(math.radians(lat)), 0.01))
+
+    indexes = set()
+    for cell_x in range(math.floor((lon - delta_lon) / GEO_SHARD_CELL_SIZE),
+                        math.floor((lon + delta_lon) / GEO_SHARD_CELL_SIZE) + 1):
+        for cell_y in range(math.floor((lat - delta_lat) / GEO_SHARD_CELL_SIZE),
+                            math.floor((lat + delta_lat) / GEO_SHARD_CELL_SIZE) + 1):
+            indexes.add(_geo_shard_index(cell_x, cell_y, len(shards)))
+    return [shards[index] for index in sorted(indexes)]
+
+
+# Packed format of the values of the hashes taxi:<taxi_id>: a version byte,
+# then the timestamp and the coordinates multiplied by PACKED_COORDINATES_SCALE,
+# as little-endian signed 32 bits integers. 13 bytes, instead of about 40 for
+# "<timestamp> <lat> <lon> free phone 2".
+PACKED_POSITION = struct.Struct('<Biii')
+PACKED_POSITION_VERSION = 1
+PACKED_COORDINATES_SCALE = 1000000
+
+
+@dataclass(slots=True)
 class _Taxi:
     timestamp: int
     lat: float
     lon: float
     # The following fields are deprecated
-    status: str  # light status, unused
-    device: str  # usually "phone" or "mobile", unused
-    version: int  # should be "2", unused
+    status: str = 'free'  # light status, unused
+    device: str = 'phone'  # usually "phone" or "mobile", unused
+    version: int = 2  # should be "2", unused
+
+
+def pack_taxi_position(timestamp, lat, lon):
+    return PACKED_POSITION.pack(
+        PACKED_POSITION_VERSION,
+        int(timestamp),
+        round(lat * PACKED_COORDINATES_SCALE),
+        round(lon * PACKED_COORDINATES_SCALE),
+    )
+
+
+def format_taxi_position(timestamp, lat, lon):
+    """Return the value to store in the hash taxi:<taxi_id>, packed if the
+    setting GEOTAXI_PACKED_POSITIONS is set."""
+    if current_app.config.get('GEOTAXI_PACKED_POSITIONS'):
+        return pack_taxi_position(timestamp, lat, lon)
+    return f'{timestamp} {lat} {lon} free phone 2'
+
+
+def parse_taxi_position(value):
+    """Parse a value of the hash taxi:<taxi_id>, in either format."""
+    if len(value) == PACKED_POSITION.size and value[0] == PACKED_POSITION_VERSION:
+        _, timestamp, lat, lon = PACKED_POSITION.unpack(value)
+        return _Taxi(
+            timestamp=timestamp,
+            lat=lat / PACKED_COORDINATES_SCALE,
+            lon=lon / PACKED_COORDINATES_SCALE,
+        )
+
+    timestamp, lat, lon, status, device, version = value.decode('utf8').split()
+    return _Taxi(
+        timestamp=int(float(timestamp)),
+        lat=float(lat),
+        lon=float(lon),
+        status=status,
+        device=device,
+        version=int(version)
+    )
 
 
 def get_taxi(taxi_id, operator_name):
@@ -24,21 +151,331 @@ def get_taxi(taxi_id, operator_name):
     function executes the redis call `HGET taxi:user` which returns:
 
     >>> b'<timestamp> <lat> <lon> <taxi_status> <device name> <version>'
+
+    or the same position packed, see pack_taxi_position().
+
+    If the setting GEOTAXI_MOVE_THRESHOLD is set, the hash is only rewritten
+    every COALESCE_MAX_AGE seconds for a taxi which doesn't move, so the
+    timestamp returned is the one of the zset last_seen, refreshed by every
+    position.
     """
-    res = current_app.redis.hget('taxi:%s' % taxi_id, operator_name)
+    buckets = get_taxi_buckets()
+    pipeline = current_app.redis.pipeline(transaction=False)
+    pipeline.zscore('last_seen', f'{taxi_id}:{operator_name}')
+    if not buckets:
+        pipeline.hget('taxi:%s' % taxi_id, operator_name)
+        last_seen, res = pipeline.execute()
+    else:
+        # Positions not moved yet to the bucket are still in taxi:<taxi_id>
+        pipeline.hget(_taxi_bucket_key(taxi_id, buckets), f'{taxi_id}:{operator_name}')
+        pipeline.hget('taxi:%s' % taxi_id, operator_name)
+        last_seen, bucket_res, legacy_res = pipeline.execute()
+        res = bucket_res or legacy_res
     if not res:
         return None
+    taxi = parse_taxi_position(res)
+    if last_seen:
+        taxi.timestamp = max(taxi.timestamp, int(last_seen))
+    return taxi
 
-    timestamp, lat, lon, status, device, version = res.decode('utf8').split()
-    return _Taxi(
-        timestamp=int(timestamp),
-        lat=float(lat),
-        lon=float(lon),
-        status=status,
-        device=device,
-        version=int(version)
+
+# Positions are stored either in one hash per taxi, taxi:<taxi_id>, with one
+# field per operator, or, if the setting GEOTAXI_BUCKETS is set, in a fixed
+# number of hashes taxis:<bucket> with one field per <taxi_id>:<operator>.
+# Redis encodes small hashes as listpacks, which take a fraction of the memory
+# of a key per taxi. GEOTAXI_BUCKETS must be high enough for the buckets to
+# stay under the setting hash-max-listpack-entries of the redis server.
+TAXI_BUCKET_KEY_PREFIX = 'taxis:'
+
+
+def get_taxi_buckets():
+    """Number of buckets taxis:<bucket>, or 0 if positions are stored in
+    taxi:<taxi_id>."""
+    return current_app.config.get('GEOTAXI_BUCKETS') or 0
+
+
+def _taxi_bucket_key(taxi_id, buckets):
+    return '%s%d' % (TAXI_BUCKET_KEY_PREFIX, zlib.crc32(taxi_id.encode('utf8')) % buckets)
+
+
+def get_taxi_position_key(taxi_id, operator_name):
+    """Return the tuple (hash, field) storing the position of the taxi reported
+    by the operator, with the configured layout."""
+    buckets = get_taxi_buckets()
+    if not buckets:
+        return 'taxi:%s' % taxi_id, operator_name
+    return _taxi_bucket_key(taxi_id, buckets), f'{taxi_id}:{operator_name}'
+
+
+def set_taxi_position(pipeline, taxi_id, operator_name, value):
+    """Queue in `pipeline` the write of the position `value` (see
+    format_taxi_position()) with the configured layout. If positions are
+    stored in buckets, the position possibly left in taxi:<taxi_id> is
+    removed so it can't be read again."""
+    key, field = get_taxi_position_key(taxi_id, operator_name)
+    pipeline.hset(key, field, value)
+    if get_taxi_buckets():
+        pipeline.hdel('taxi:%s' % taxi_id, operator_name)
+
+
+def delete_taxi_positions(pipeline, taxi_ids, taxi_operators=()):
+    """Queue in `pipeline` the deletion of the hashes taxi:<taxi_id> of
+    `taxi_ids` and, if positions are stored in buckets, of the fields of
+    `taxi_operators`, an iterable of (taxi_id, operator)."""
+    for taxi_id in taxi_ids:
+        pipeline.delete('taxi:%s' % taxi_id)
+    buckets = get_taxi_buckets()
+    if buckets:
+        for taxi_id, operator_name in taxi_operators:
+            pipeline.hdel(_taxi_bucket_key(taxi_id, buckets), f'{taxi_id}:{operator_name}')
+
+
+def scan_taxi_position_keys(count=1000):
+    """Iterate over the keys of the hashes storing positions, in both
+    layouts."""
+    yield from redis_clients.get('background').scan_iter('taxi:*', count=count)
+    yield from redis_clients.get('background').scan_iter(TAXI_BUCKET_KEY_PREFIX + '*', count=count)
+
+
+def move_taxi_positions_to_buckets(keys):
+    """Move the positions of the hashes `keys` (taxi:<taxi_id>) to the
+    buckets taxis:<bucket>, and delete the hashes. Return the number of
+    positions moved."""
+    buckets = get_taxi_buckets()
+    if not buckets or not keys:
+        return 0
+    script_keys, args = [], []
+    for key in keys:
+        taxi_id = (key.decode('utf8') if isinstance(key, bytes) else key)[len('taxi:'):]
+        script_keys.extend((key, _taxi_bucket_key(taxi_id, buckets)))
+        args.append(taxi_id)
+    return redis_scripts.run(redis_scripts.MOVE_TAXI_POSITIONS_TO_BUCKETS, script_keys, args)
+
+
+def pack_taxi_positions(keys):
+    """Convert the values of the hashes `keys` (taxi:<taxi_id> or
+    taxis:<bucket>) to the packed format. Return the number of values converted."""
+    if not keys:
+        return 0
+    return redis_scripts.run(redis_scripts.PACK_TAXI_POSITIONS, list(keys), [])
+
+
+def update_taxi_positions(positions, operator_name, client=None, taxis_insee=None):
+    """Store a batch of positions reported by an operator. `positions` is an
+    iterable of dictionaries with the keys "taxi_id", "lon" and "lat".
+    `taxis_insee` is the dictionary {taxi_id: INSEE code of the ADS} returned
+    by processes.get_taxis_insee().
+
+    All the indexes are updated server-side in a single EVALSHA call (see
+    redis_scripts.UPDATE_POSITIONS) instead of five commands per position:
+
+    - HSET taxi:<taxi_id> <operator> "<timestamp> <lat> <lon> free phone 2",
+      or the packed value if the setting GEOTAXI_PACKED_POSITIONS is set, or
+      HSET taxis:<bucket> <taxi_id:operator> if the setting GEOTAXI_BUCKETS is
+      set
+    - GEOADD geoindex <lon> <lat> <taxi_id>
+    - GEOADD geoindex_2 <lon> <lat> <taxi_id:operator>
+    - ZADD timestamps <timestamp> <taxi_id:operator>
+    - ZADD timestamps_id <timestamp> <taxi_id>
+    - ZADD last_seen <timestamp> <taxi_id:operator>
+    - GEOADD geoindex_insee:<insee> <lon> <lat> <taxi_id:operator>, if the
+      INSEE code of the taxi is in `taxis_insee`. If it changed, the member is
+      removed from the index of the previous INSEE code, stored in the hash
+      geoindex_insee_members.
+
+    geoindex, geoindex_2, geoindex_insee:<insee>, timestamps and timestamps_id
+    are expired after two minutes by the task expire_positions. last_seen is
+    permanent, see list_taxis().
+
+    If the setting GEOTAXI_MOVE_THRESHOLD (in meters) is set, taxis which
+    didn't move more than the threshold only have timestamps, timestamps_id
+    and last_seen refreshed, so search results are the same. The hash
+    taxi:<taxi_id> is still rewritten every COALESCE_MAX_AGE seconds, so the
+    geo indexes are never expired.
+
+    If the setting LOCATION_STORE is "memory", the batch is also added to the
+    stream POSITIONS_STREAM, read by the in-memory location stores.
+
+    If the geo indexes are sharded (see get_geo_shards()), the script only
+    writes taxi:<taxi_id> and last_seen. The geo indexes are then written
+    with a pipeline on the shard of each position. Positions are always
+    written to the geo indexes of the shard, because a taxi which didn't move
+    might still have crossed the border of a cell.
+    """
+    sharded = len(get_geo_shards()) > 1
+    buckets = get_taxi_buckets()
+    now = int(time.time())
+    keys = [
+        'geoindex', 'geoindex_2', 'timestamps', 'timestamps_id', 'geotaxi_coalesced', 'last_seen',
+        GEOINDEX_INSEE_MEMBERS_KEY,
+    ]
+    args = [
+        operator_name,
+        now,
+        current_app.config.get('GEOTAXI_MOVE_THRESHOLD', 0),
+        COALESCE_MAX_AGE,
+        0 if sharded else 1,
+        1 if current_app.config.get('GEOTAXI_PACKED_POSITIONS') else 0,
+        1 if buckets else 0,
+    ]
+    taxis_insee = taxis_insee or {}
+    positions = list(positions)
+    for position in positions:
+        insee = taxis_insee.get(position['taxi_id'], '')
+        key, _ = get_taxi_position_key(position['taxi_id'], operator_name)
+        keys.extend((key, _geoindex_insee_key(insee)))
+        args.extend((position['taxi_id'], position['lon'], position['lat'], insee))
+
+    if not positions:
+        return 0
+
+    ret = redis_scripts.run(redis_scripts.UPDATE_POSITIONS, keys, args, client=client or redis_clients.get('geo_write'))
+    if sharded:
+        _update_geo_shards(positions, operator_name, now, taxis_insee)
+    if current_app.config.get('LOCATION_STORE') == 'memory':
+        _add_to_positions_stream(positions, operator_name, now, taxis_insee, client=client)
+    return ret
+
+
+# Stream of the positions stored by update_taxi_positions(), read by the
+# in-memory location stores (see location_store.MemoryLocationStore) when the
+# setting LOCATION_STORE is "memory". Positions are expired after two minutes
+# anyway, so older entries are trimmed.
+POSITIONS_STREAM = 'positions'
+POSITIONS_STREAM_RETENTION = timedelta(minutes=2)
+
+
+def _add_to_positions_stream(positions, operator_name, timestamp, taxis_insee, client=None):
+    data = {
+        'operator': operator_name,
+        'timestamp': timestamp,
+        'positions': [
+            [position['taxi_id'], position['lon'], position['lat'], taxis_insee.get(position['taxi_id'], '')]
+            for position in positions
+        ],
+    }
+    min_id = int((time.time() - POSITIONS_STREAM_RETENTION.total_seconds()) * 1000)
+    (client or redis_clients.get('geo_write')).xadd(
+        POSITIONS_STREAM,
+        {'data': json.dumps(data, separators=(',', ':'))},
+        minid=min_id,
+        approximate=True,
+    )
+
+
+def _update_geo_shards(positions, operator_name, timestamp, taxis_insee):
+    pipelines = {}
+    for position in positions:
+        taxi_id, lon, lat = position['taxi_id'], position['lon'], position['lat']
+        shard = get_geo_shard(lon, lat)
+        if id(shard) not in pipelines:
+            pipelines[id(shard)] = shard.pipeline(transaction=False)
+        pipeline = pipelines[id(shard)]
+        pipeline.geoadd('geoindex', [lon, lat, taxi_id])
+        pipeline.geoadd('geoindex_2', [lon, lat, f'{taxi_id}:{operator_name}'])
+        if taxi_id in taxis_insee:
+            redis_scripts.run(
+                redis_scripts.GEOADD_INSEE,
+                [GEOINDEX_INSEE_MEMBERS_KEY, _geoindex_insee_key(taxis_insee[taxi_id])],
+                [f'{taxi_id}:{operator_name}', lon, lat, taxis_insee[taxi_id]],
+                client=pipeline
+            )
+        pipeline.zadd('timestamps', {f'{taxi_id}:{operator_name}': timestamp})
+        pipeline.zadd('timestamps_id', {taxi_id: timestamp})
+    for pipeline in pipelines.values():
+        pipeline.execute()
+
+
+def _geoindex_insee_key(insee):
+    return f'geoindex_insee:{insee}'
+
+
+# Hash {taxi_id:operator: INSEE code of the geo index storing the member},
+# stored with the geo indexes, so a taxi whose INSEE code changed is removed
+# from the index of the previous one, see redis_scripts.UPDATE_POSITIONS.
+# Entries are removed when positions expire and when taxis are deleted.
+GEOINDEX_INSEE_MEMBERS_KEY = 'geoindex_insee_members'
+
+
+def delete_geoindex_insee_members(taxi_operators):
+    """Remove the entries of `taxi_operators`, an iterable of (taxi_id,
+    operator), from the hash GEOINDEX_INSEE_MEMBERS_KEY of each shard."""
+    members = [f'{taxi_id}:{operator}' for taxi_id, operator in taxi_operators]
+    if not members:
+        return
+    for shard in get_geo_shards():
+        shard.hdel(GEOINDEX_INSEE_MEMBERS_KEY, *members)
+
+
+def list_geoindex_insee_keys(client):
+    """List the geo indexes by INSEE code stored by `client`."""
+    return list(client.scan_iter(_geoindex_insee_key('*')))
+
+
+def get_taxis_insee(taxi_ids):
+    """The hash "taxi_insee" caches the INSEE code of the ADS of each taxi, to
+    store positions in the geo indexes "geoindex_insee:<insee>" without a SQL
+    query.
+
+    Return the dictionary {taxi_id: insee} of the taxis found in the hash.
+    """
+    taxi_ids = list(taxi_ids)
+    if not taxi_ids:
+        return {}
+    values = current_app.redis.hmget('taxi_insee', taxi_ids)
+    return {taxi_id: value.decode('utf8') for taxi_id, value in zip(taxi_ids, values) if value}
+
+
+def set_taxis_insee(taxis_insee):
+    """Add entries {taxi_id: insee} to the hash "taxi_insee". The INSEE code
+    of an ADS never changes, except when towns are merged, see
+    clear_taxis_insee()."""
+    if taxis_insee:
+        current_app.redis.hset('taxi_insee', mapping=taxis_insee)
+
+
+def clear_taxis_insee():
+    """Remove the hash "taxi_insee", it is loaded again from the database
+    when positions are received."""
+    current_app.redis.delete('taxi_insee')
+
+
+def expire_positions(shard, max_time, chunk_size):
+    """Remove up to `chunk_size` taxis, and up to `chunk_size` entries
+    taxi_id:operator, with a location older than `max_time` from the geo
+    indexes of `shard`. Return the number of members removed, 0 once there is
+    nothing left to expire.
+
+    Members are removed in small chunks by scripts (see
+    redis_scripts.EXPIRE_TAXI_IDS and redis_scripts.EXPIRE_TAXI_OPERATORS),
+    so redis is never blocked more than a few milliseconds.
+    """
+    removed = redis_scripts.run(
+        redis_scripts.EXPIRE_TAXI_IDS,
+        ['timestamps_id', 'geoindex'],
+        [max_time, chunk_size],
+        client=shard
     )
 
+    removed += redis_scripts.run(
+        redis_scripts.EXPIRE_TAXI_OPERATORS,
+        ['timestamps', 'geoindex_2', GEOINDEX_INSEE_MEMBERS_KEY],
+        [max_time, chunk_size],
+        client=shard
+    )
+    return removed
+
+
+def get_coalesced_positions():
+    """Return the dictionary {operator: count} of positions which only had
+    their timestamps refreshed because the taxi didn't move. Each of them
+    saved the three writes HSET taxi:<id>, GEOADD geoindex and GEOADD
+    geoindex_2."""
+    return {
+        operator.decode('utf8'): int(count)
+        for operator, count in current_app.redis.hgetall('geotaxi_coalesced').items()
+    }
+
 
 @dataclass
 class _TaxiLocationUpdate:
@@ -51,76 +488,141 @@ def get_timestamps_entries_between(start_timestamp, end_timestamp):
     """Geotaxi stores taxis updates in the zset "timestamps". This function
     returns all updates between two timestamps.
 
-    The asynchronous task clean_geoindex_timestamps removes taxis with a
+    The asynchronous task expire_positions removes taxis with a
     location older than 2 minutes, so any older entry is not guaranteed to be
-    returned."""
+    returned.
+
+    If the geo indexes are sharded, a taxi which moved to another shard is
+    returned once, with its latest update."""
+    updates = {}
+    for shard in get_geo_shards():
+        rows = shard.zrangebyscore('timestamps', start_timestamp, end_timestamp, withscores=True)
+        for taxi_operator, timestamp in rows:
+            if timestamp > updates.get(taxi_operator, 0):
+                updates[taxi_operator] = timestamp
+
     ret = []
-    rows = current_app.redis.zrangebyscore('timestamps', start_timestamp, end_timestamp, withscores=True)
-    for row in rows:
-        taxi_operator, timestamp = row
+    for taxi_operator, timestamp in updates.items():
         taxi_id, operator = taxi_operator.decode('utf8').split(':')
         ret.append(_TaxiLocationUpdate(taxi_id=taxi_id, operator=operator, timestamp=int(timestamp)))
     return ret
 
 
+# Set by backfill_last_seen() once the positions stored before the zset
+# last_seen existed are indexed in it.
+LAST_SEEN_BACKFILLED_KEY = 'last_seen_backfilled'
+
+
+def _scan_taxi_positions(batch_size):
+    """Iterate over batches of the positions stored in the hashes taxi:<taxi_id>
+    and taxis:<bucket>, as lists of tuples (taxi_id, operator, value)."""
+    client = redis_clients.get('background')
+
+    def _read(keys):
+        pipeline = client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hgetall(key)
+        positions = []
+        for key, values in zip(keys, pipeline.execute()):
+            if key.startswith(TAXI_BUCKET_KEY_PREFIX.encode('utf8')):
+                for taxi_operator, value in values.items():
+                    taxi_id, operator = taxi_operator.decode('utf8').split(':')
+                    positions.append((taxi_id, operator, value))
+            else:
+                taxi_id = key[len(b'taxi:'):].decode('utf8')
+                for operator, value in values.items():
+                    positions.append((taxi_id, operator.decode('utf8'), value))
+        return positions
+
+    keys = []
+    for key in scan_taxi_position_keys(count=batch_size):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            yield _read(keys)
+            keys = []
+    if keys:
+        yield _read(keys)
+
+
 def list_taxi_ids():
-    """Simply list all the taxi IDs known to Redis."""
-    PREFIX = len(b'taxi:')
+    """Simply list all the taxi IDs known to Redis.
 
-    for index in current_app.redis.scan_iter('taxi:*'):
-        yield index[PREFIX:].decode('utf8')
+    Until backfill_last_seen() has been run, the positions stored before the
+    zset last_seen existed are also read, otherwise these taxis would be
+    considered unknown and deleted by clean_db.delete_old_taxis()."""
+    client = redis_clients.get('background')
+    seen = set()
+    for taxi_operator, _ in client.zscan_iter('last_seen'):
+        taxi_id = taxi_operator.decode('utf8').split(':')[0]
+        if taxi_id not in seen:
+            seen.add(taxi_id)
+            yield taxi_id
 
+    if client.exists(LAST_SEEN_BACKFILLED_KEY):
+        return
 
-def list_taxis(start_timestamp, end_timestamp):
-    """Geotaxi creates the hash key "taxi:<taxi_id>" when it receives a
-    location.
+    for positions in _scan_taxi_positions(batch_size=1000):
+        for taxi_id, _, _ in positions:
+            if taxi_id not in seen:
+                seen.add(taxi_id)
+                yield taxi_id
 
-    This function:
 
-    - SCAN taxi:* to list all taxis
-    - for each entry, calls HGETALL taxi:*
-    - if the update date is between start_timestamp and end_timestamp, return
-      the result.
+def list_taxis(start_timestamp, end_timestamp):
+    """Return the location updates made between start_timestamp and
+    end_timestamp, read from the zset "last_seen".
+
+    Members of "last_seen" are "<taxi_id>:<operator>", scored by the timestamp
+    of the last location update. Unlike "timestamps", it is never expired: it
+    is written by update_taxi_positions() and only cleaned when taxis are
+    deleted (see clean_db.delete_old_taxis).
 
-    This is to keep backward compatibility, but statistics need to be
-    reworked completely. There are several problems here:
+    Positions stored before "last_seen" existed are only listed once
+    backfill_last_seen() has been run.
 
-    - executing SCAN taxi:* then HGETALL on each entry takes a lot of time, and
-      will not scale with thousands of entries.
-    - if we receive a location update for a non-existing taxi, geotaxi creates
-      an entry in redis.
-    - in the case a taxi is connected with several applications, we return
-      several entries for this taxi
+    In the case a taxi is connected with several applications, several entries
+    are returned for this taxi.
     """
-    pipeline = current_app.redis.pipeline()
-    taxi_ids = []
-    PREFIX = len(b'taxi:')
+    rows = redis_clients.get('background').zrangebyscore('last_seen', start_timestamp, end_timestamp, withscores=True)
+    ret = []
+    for taxi_operator, timestamp in rows:
+        taxi_id, operator = taxi_operator.decode('utf8').split(':')
+        ret.append(_TaxiLocationUpdate(taxi_id=taxi_id, operator=operator, timestamp=int(timestamp)))
+    return ret
 
-    # Iterate on keys taxi:*. For each entry, call HGETALL taxi:<id> in the pipeline.
-    # We use a pipeline to improve speed because listing all taxis may return many results.
-    for index in current_app.redis.scan_iter('taxi:*'):
-        taxi_id = index[PREFIX:].decode('utf8')
-        pipeline.hgetall(index)
-        taxi_ids.append(taxi_id)
 
-    ret = []
+def backfill_last_seen(batch_size=1000):
+    """Fill the zset "last_seen" from the hashes "taxi:<taxi_id>" and
+    "taxis:<bucket>" written before it existed.
 
-    # `updates` is a dict where the key is the operator name, and value a
-    # string containing the timestamp, lat, lon, status, device and version.
-    for taxi_id, updates in zip(taxi_ids, pipeline.execute()):
-        for operator, update in updates.items():
-            operator = operator.decode('utf8')
-            timestamp, lat, lon, status, device, version = update.decode('utf8').split()
-            timestamp = int(float(timestamp))
+    Executing SCAN then HGETALL on each entry takes a lot of time, but it only
+    needs to be done once. Scores are only updated if they are greater than
+    the existing ones, so positions received in the meantime are never
+    overwritten, and the function can safely be run several times.
 
-            if timestamp >= start_timestamp and timestamp <= end_timestamp:
-                ret.append(_TaxiLocationUpdate(taxi_id=taxi_id, operator=operator, timestamp=timestamp))
-    return ret
+    Once done, the key LAST_SEEN_BACKFILLED_KEY is set and list_taxi_ids()
+    only reads last_seen.
+
+    Return the number of entries read from the hashes.
+    """
+    count = 0
+    for positions in _scan_taxi_positions(batch_size):
+        last_seen = {
+            f"{taxi_id}:{operator}": parse_taxi_position(value).timestamp
+            for taxi_id, operator, value in positions
+        }
+        if last_seen:
+            current_app.redis.zadd('last_seen', last_seen, gt=True)
+        count += len(last_seen)
+    current_app.redis.set(LAST_SEEN_BACKFILLED_KEY, int(time.time()))
+    return count
 
 
 def set_taxi_availability(taxi_id, taxi_operator, available):
     """Add or remove the entry "<taxi_id>:<operator>" from the ZSET
-    "not_available"."""
+    "not_available". Only written by PUT /taxis/:id, it is not read by the
+    search: the status of TaxiSearchMetadata, also changed by hails, is the
+    one checked."""
     redis_key = 'not_available'
     key = '%s:%s' % (taxi_id, taxi_operator)
     if available:
@@ -129,9 +631,162 @@ def set_taxi_availability(taxi_id, taxi_operator, available):
         current_app.redis.zadd(redis_key, {key: 0})
 
 
+# Key prefix of the hashes taxi_search:<taxi_id>:<operator>, see
+# TaxiSearchMetadata.
+TAXI_SEARCH_METADATA_KEY_PREFIX = 'taxi_search:'
+
+# The records are written through by the endpoints and tasks changing the
+# taxis, but some changes (ADS or vehicle edited in the console, deletions...)
+# are only seen once the record expired and has been read again from the
+# database.
+TAXI_SEARCH_METADATA_TTL = timedelta(hours=1)
+
+
+@dataclass
+class TaxiSearchMetadata:
+    """Everything GET /taxis needs to know about a taxi registered by an
+    operator, denormalized from the tables taxi, ADS, vehicle and
+    vehicle_description into the hash "taxi_search:<taxi_id>:<operator>"."""
+    taxi_id: str
+    operator: str
+    status: str = None
+    radius: int = None
+    insee: str = None
+    last_update_at: datetime = None
+    licence_plate: str = None
+    model: str = None
+    constructor: str = None
+    nb_seats: int = None
+    engine: str = None
+    characteristics: list = field(default_factory=list)
+    # Not stored, set by the search when the real ID is hidden
+    fake_taxi_id: str = None
+
+    # Stored fields, and how to parse them. The script
+    # redis_scripts.SEARCH_AVAILABLE_TAXIS expects the first four.
+    FIELDS = {
+        'status': str,
+        'radius': int,
+        'last_update_at': lambda value: datetime.fromtimestamp(float(value)),
+        'insee': str,
+        'licence_plate': str,
+        'model': str,
+        'constructor': str,
+        'nb_seats': int,
+        'engine': str,
+        'characteristics': lambda value: value.split(','),
+    }
+
+    @classmethod
+    def from_models(cls, taxi, vehicle_description):
+        """Build the record from the ORM objects. The ADS and the vehicle of
+        `taxi`, and the user of `vehicle_description` must be loaded."""
+        return cls(
+            taxi_id=taxi.id,
+            operator=vehicle_description.added_by.email,
+            status=vehicle_description.status,
+            radius=vehicle_description.radius,
+            insee=taxi.ads.insee,
+            last_update_at=vehicle_description.last_update_at,
+            licence_plate=taxi.vehicle.licence_plate,
+            model=vehicle_description.model,
+            constructor=vehicle_description.constructor,
+            nb_seats=vehicle_description.nb_seats,
+            engine=vehicle_description.engine,
+            characteristics=vehicle_description.characteristics,
+        )
+
+    @classmethod
+    def encode_fields(cls, **values):
+        """Return the values as a mapping for HSET. None and empty values are
+        stored as empty strings."""
+        mapping = {}
+        for name, value in values.items():
+            if name not in cls.FIELDS:
+                raise ValueError(f'{name} is not a field of the taxi search metadata')
+            if isinstance(value, datetime):
+                value = value.timestamp()
+            elif isinstance(value, list):
+                value = ','.join(value)
+            mapping[name] = '' if value is None else value
+        return mapping
+
+    def encode(self):
+        return self.encode_fields(**{name: getattr(self, name) for name in self.FIELDS})
+
+    @classmethod
+    def decode(cls, taxi_id, operator, values):
+        """Build the record from the values of HMGET of all the FIELDS."""
+        kwargs = {}
+        for (name, parse), value in zip(cls.FIELDS.items(), values):
+            if value:
+                kwargs[name] = parse(value.decode('utf8'))
+        return cls(taxi_id=taxi_id, operator=operator, **kwargs)
+
+
+def _taxi_search_metadata_key(taxi_id, operator):
+    return f'{TAXI_SEARCH_METADATA_KEY_PREFIX}{taxi_id}:{operator}'
+
+
+def get_taxis_search_metadata(taxis_operators):
+    """Read the records of the (taxi_id, operator) pairs `taxis_operators`
+    with one pipelined HMGET per record.
+
+    Return a dictionary {(taxi_id, operator): TaxiSearchMetadata}, without the
+    pairs not found in redis.
+    """
+    taxis_operators = list(taxis_operators)
+    pipeline = current_app.redis.pipeline(transaction=False)
+    for taxi_id, operator in taxis_operators:
+        pipeline.hmget(_taxi_search_metadata_key(taxi_id, operator), list(TaxiSearchMetadata.FIELDS))
+    ret = {}
+    for (taxi_id, operator), values in zip(taxis_operators, pipeline.execute()):
+        # Stored values are strings, possibly empty, so all the values are
+        # None only if the hash doesn't exist
+        if all(value is None for value in values):
+            continue
+        ret[(taxi_id, operator)] = TaxiSearchMetadata.decode(taxi_id, operator, values)
+    return ret
+
+
+def set_taxis_search_metadata(records):
+    """Store the TaxiSearchMetadata `records`, replacing the previous ones."""
+    pipeline = current_app.redis.pipeline(transaction=False)
+    for record in records:
+        key = _taxi_search_metadata_key(record.taxi_id, record.operator)
+        pipeline.hset(key, mapping=record.encode())
+        pipeline.expire(key, TAXI_SEARCH_METADATA_TTL)
+    pipeline.execute()
+
+
+def update_taxi_search_metadata(taxi_id, operator, **values):
+    """Change some fields of the record of the taxi, only if it exists: a
+    missing record is loaded from the database by the next search."""
+    args = []
+    for name, value in TaxiSearchMetadata.encode_fields(**values).items():
+        args.extend((name, value))
+    return redis_scripts.run(
+        redis_scripts.HSET_IF_EXISTS,
+        [_taxi_search_metadata_key(taxi_id, operator)],
+        args
+    )
+
+
+def clear_taxis_search_metadata():
+    """Remove the records of all the taxis, they are loaded again from the
+    database by the next searches."""
+    pipeline = current_app.redis.pipeline()
+    for key in current_app.redis.scan_iter(f'{TAXI_SEARCH_METADATA_KEY_PREFIX}*'):
+        pipeline.delete(key)
+    pipeline.execute()
+
+
 def list_taxi_positions(taxi_ids):
     # We don't try to map a taxi to its position, just a cloud of points
-    return current_app.redis.geopos('geoindex', *taxi_ids)
+    positions = []
+    for shard in get_geo_shards():
+        positions.extend(shard.geopos('geoindex', *taxi_ids))
+    return positions
 
 
 @dataclass
@@ -142,10 +797,25 @@ class Location:
     update_date: datetime
 
 
-def taxis_locations_by_operator(lon, lat, distance):
+def taxis_locations_by_operator(lon, lat, distance, insee_codes=None, count=None):
     """Get the list of taxis positions from the redis geoindex "geoindex_2",
     which is populated by geotaxi.
 
+    If `insee_codes` is given, only the taxis with an ADS of these towns are
+    listed, from the geo indexes "geoindex_insee:<insee>" instead of
+    "geoindex_2".
+
+    The update date of each position is read from the zset "timestamps" by
+    the same script (see redis_scripts.GEOSEARCH_WITH_TIMESTAMPS), instead of
+    one ZSCORE round-trip per taxi in the radius.
+
+    If `count` is given, only the `count` closest members of each geo index
+    are returned. The caller is expected to search again with a higher count
+    if too few of them are eventually kept, see is_truncated().
+
+    If the geo indexes are sharded, the script is run on the shards of all the
+    cells within `distance`, see get_geo_shards_within().
+
     Returns a dictionary such as:
 
     >>> {
@@ -156,44 +826,175 @@ def taxis_locations_by_operator(lon, lat, distance):
     ...    }
     ... }
     """
+    if insee_codes is None:
+        geo_keys = ['geoindex_2']
+    else:
+        geo_keys = [_geoindex_insee_key(insee) for insee in sorted(insee_codes)]
+
     locations = {}
-    data = current_app.redis.georadius(
-        'geoindex_2',
-        lon,
-        lat,
-        distance,
-        unit='m',
-        withdist=True,
-        withcoord=True,
-        sort='ASC'
-    )
-    for row in data:
-        taxi_operator, distance, location = row
+    data = []
+    for shard in get_geo_shards_within(lon, lat, distance):
+        data.extend(redis_scripts.run(
+            redis_scripts.GEOSEARCH_WITH_TIMESTAMPS,
+            ['timestamps', *geo_keys],
+            [lon, lat, distance, count or 0],
+            client=shard
+        ))
+    for taxi_operator, distance, (location_lon, location_lat), update_date in data:
         taxi_id, operator = taxi_operator.decode('utf8').split(':')
 
         if taxi_id not in locations:
             locations[taxi_id] = {}
 
-        update_date = current_app.redis.zscore('timestamps', '%s:%s' % (taxi_id, operator))
         if update_date:
-            update_date = datetime.fromtimestamp(update_date)
+            update_date = datetime.fromtimestamp(float(update_date))
+
+        # Until it is expired, the previous location of a taxi which moved to
+        # another shard, or whose ADS changed, is still returned.
+        previous = locations[taxi_id].get(operator)
+        if previous and (not update_date or (previous.update_date and previous.update_date >= update_date)):
+            continue
 
         locations[taxi_id][operator] = Location(
-            lon=location[0],
-            lat=location[1],
-            distance=distance,
+            lon=float(location_lon),
+            lat=float(location_lat),
+            distance=float(distance),
             update_date=update_date
         )
     return locations
 
 
+def is_truncated(locations, count):
+    """Whether the search of taxis_locations_by_operator() with `count` might
+    have left out taxis within the distance. Conservative: with several geo
+    indexes or shards, the search is only complete if less than `count`
+    members were found overall."""
+    return count is not None and sum(len(operators) for operators in locations.values()) >= count
+
+
+@dataclass
+class AvailableTaxis:
+    # {<taxi_id>: (<TaxiSearchMetadata>, <Location>)} of the taxis in reach,
+    # sorted by distance
+    taxis: dict
+    # Locations of the taxis without metadata, as returned by
+    # taxis_locations_by_operator()
+    unresolved: dict
+    # Number of taxis available, in reach or not, and distance of the closest
+    found: int
+    closest: float
+    # Whether taxis within the distance might have been left out, see
+    # search_available_taxis()
+    truncated: bool = False
+
+
+def can_search_available_taxis():
+    """Whether search_available_taxis() can be used: the keys it reads must
+    be stored on the same server, so the geo indexes must not be sharded."""
+    return not current_app.config.get('REDIS_GEO_SHARDS')
+
+
+def _run_search_available_taxis(lon, lat, distance, insee_codes, count, min_update_date, default_radius, operator,
+                                client):
+    return redis_scripts.run(
+        redis_scripts.SEARCH_AVAILABLE_TAXIS,
+        ['timestamps', *(_geoindex_insee_key(insee) for insee in sorted(insee_codes))],
+        [
+            lon, lat, distance, count or 0, min_update_date.timestamp(), default_radius,
+            TAXI_SEARCH_METADATA_KEY_PREFIX, operator or '', *TaxiSearchMetadata.FIELDS
+        ],
+        client=client
+    )
+
+
+def _parse_available_taxis(rows):
+    """Return the AvailableTaxis of the result of the script
+    SEARCH_AVAILABLE_TAXIS."""
+    taxis_rows, unresolved_rows, found, truncated, *closest = rows
+
+    def parse_row(row):
+        taxi_id, taxi_operator = row[0].decode('utf8').split(':')
+        location_lon, location_lat = row[2]
+        location = Location(
+            lon=float(location_lon),
+            lat=float(location_lat),
+            distance=float(row[1]),
+            update_date=datetime.fromtimestamp(float(row[3]))
+        )
+        return taxi_id, taxi_operator, location
+
+    taxis = {}
+    for row in taxis_rows:
+        taxi_id, taxi_operator, location = parse_row(row)
+        taxis[taxi_id] = (TaxiSearchMetadata.decode(taxi_id, taxi_operator, row[4]), location)
+
+    unresolved = {}
+    for row in unresolved_rows:
+        taxi_id, taxi_operator, location = parse_row(row)
+        unresolved.setdefault(taxi_id, {})[taxi_operator] = location
+
+    return AvailableTaxis(
+        taxis=taxis,
+        unresolved=unresolved,
+        found=found,
+        closest=float(closest[0]) if closest else None,
+        truncated=bool(truncated),
+    )
+
+
+def search_available_taxis(lon, lat, distance, insee_codes, min_update_date, default_radius, operator=None,
+                           count=None):
+    """Search the taxis available around (lon, lat) with a single script, see
+    redis_scripts.SEARCH_AVAILABLE_TAXIS: locations within `distance` meters
+    reported after `min_update_date` by the taxis with an ADS of
+    `insee_codes`, which are free and in reach according to their radius, or
+    `default_radius` if they don't have a preference. If `operator` is given,
+    only the taxis of this operator are searched.
+
+    Taxis with an operator whose metadata is not in redis are returned in
+    AvailableTaxis.unresolved, to be filtered by the caller.
+
+    If `count` is given, only the `count` closest members of each geo index
+    are read, and AvailableTaxis.truncated tells whether the caller should
+    search again with a higher count, like taxis_locations_by_operator().
+    """
+    rows = _run_search_available_taxis(
+        lon, lat, distance, insee_codes, count, min_update_date, default_radius, operator,
+        client=redis_clients.get('geo_read')
+    )
+    return _parse_available_taxis(rows)
+
+
+def search_available_taxis_many(searches, min_update_date, default_radius, operator=None):
+    """Same as search_available_taxis() for each (lon, lat, distance,
+    insee_codes, count) of `searches`, with the scripts sent in a single
+    pipeline. Return the list of AvailableTaxis, in the order of `searches`."""
+    pipeline = redis_clients.get('geo_read').pipeline(transaction=False)
+    for lon, lat, distance, insee_codes, count in searches:
+        _run_search_available_taxis(
+            lon, lat, distance, insee_codes, count, min_update_date, default_radius, operator,
+            client=pipeline
+        )
+    return [_parse_available_taxis(rows) for rows in pipeline.execute()]
+
+
+# Stream of the requests creating or changing hails, archived in PostgreSQL
+# by the task archive_hail_logs. The stream is capped: entries older than
+# HAIL_LOG_STREAM_RETENTION are trimmed, whether they were archived or not.
+HAIL_LOG_STREAM = 'hail_log'
+HAIL_LOG_STREAM_RETENTION = timedelta(days=2)
+HAIL_LOG_ARCHIVER_GROUP = 'archiver'
+
+
 def log_hail(hail_id, http_method, request_payload, hail_initial_status,
              request_user=None, response_payload=None,
              response_status_code=None, hail_final_status=None):
     """When a request creates or changes a hail, we log it into redis. This is
     for backward compatibility purpose. It would probably be better to have a
-    generic logging module and log all modifications."""
-    key = 'hail:%s' % hail_id
+    generic logging module and log all modifications.
+
+    Payloads are preferably dictionaries, serialized once with the rest of the
+    entry."""
     data = {
         'method': http_method,
         'payload': request_payload,
@@ -209,27 +1010,143 @@ def log_hail(hail_id, http_method, request_payload, hail_initial_status,
     if hail_final_status:
         data['final_status'] = hail_final_status
 
-    current_app.redis.zadd(key, {json.dumps(data): time.time()})
-    current_app.redis.expire(key, timedelta(weeks=+6))
+    min_id = int((time.time() - HAIL_LOG_STREAM_RETENTION.total_seconds()) * 1000)
+    redis_clients.get('audit').xadd(
+        HAIL_LOG_STREAM,
+        {'hail_id': hail_id, 'data': json.dumps(data, separators=(',', ':'))},
+        minid=min_id,
+        approximate=True,
+    )
 
 
-def set_fake_taxi_ids(current_user, fake_taxi_ids):
-    """
-    Save a mapping of fake-to-real taxi IDs for the current client application.
-    This mapping was generated following a taxi search.
-    (without overwriting fake IDs for other users of the same app)
-    """
-    current_app.redis.hset(f'fake_taxi_id:{current_user.email}', mapping=fake_taxi_ids)
-    # Keep this mapping for a little time, waiting for one of the taxis in the list to be hailed
-    current_app.redis.expire(f'fake_taxi_id:{current_user.email}', timedelta(hours=1))
-    # The fake ID will then be stored on the hail itself, so no worry with expiry
+@dataclass
+class HailLogEntry:
+    id: str
+    hail_id: str
+    time: datetime
+    data: str
+
+
+def _parse_hail_log_entry(entry_id, fields):
+    entry_id = entry_id.decode('utf8')
+    return HailLogEntry(
+        id=entry_id,
+        hail_id=fields[b'hail_id'].decode('utf8'),
+        time=datetime.fromtimestamp(int(entry_id.split('-')[0]) / 1000),
+        data=fields[b'data'].decode('utf8'),
+    )
+
+
+def read_hail_logs(consumer, count):
+    """Read up to `count` entries of the stream hail_log not acknowledged yet
+    by the archiver group. Entries previously delivered to `consumer` but not
+    acknowledged, for example if the archiver crashed, are returned first."""
+    try:
+        redis_clients.get('audit').xgroup_create(HAIL_LOG_STREAM, HAIL_LOG_ARCHIVER_GROUP, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as exc:
+        if not str(exc).startswith('BUSYGROUP'):
+            raise
+
+    for stream_id in ('0', '>'):
+        res = redis_clients.get('audit').xreadgroup(
+            HAIL_LOG_ARCHIVER_GROUP, consumer, {HAIL_LOG_STREAM: stream_id}, count=count
+        )
+        entries = res[0][1] if res else []
+        if entries:
+            return [_parse_hail_log_entry(entry_id, fields) for entry_id, fields in entries]
+    return []
+
+
+def ack_hail_logs(entries):
+    """Acknowledge the entries returned by read_hail_logs() once archived."""
+    if entries:
+        redis_clients.get('audit').xack(HAIL_LOG_STREAM, HAIL_LOG_ARCHIVER_GROUP, *[entry.id for entry in entries])
+
+
+def list_hail_logs(hail_id, batch_size=1000):
+    """Entries of the hail in the stream hail_log, archived or not. The stream
+    is read entirely: only for debugging."""
+    ret = []
+    min_id = '-'
+    while True:
+        entries = redis_clients.get('audit').xrange(HAIL_LOG_STREAM, min=min_id, count=batch_size)
+        for entry_id, fields in entries:
+            entry = _parse_hail_log_entry(entry_id, fields)
+            if entry.hail_id == hail_id:
+                ret.append(entry)
+        if len(entries) < batch_size:
+            return ret
+        # Exclusive range, from the last entry read
+        min_id = '(' + entries[-1][0].decode('utf8')
 
 
 def get_real_taxi_id(current_user, fake_taxi_id):
-    """Translate the fake taxi ID given in a search result to the real taxi ID"""
+    """Translate the fake taxi ID given in a search result to the real taxi ID.
+
+    Searches used to store the mapping fake_taxi_id:<email> for an hour, now
+    fake IDs are decoded by fake_taxi_ids.decode(). Only kept for IDs issued
+    before."""
     # Redis-py returns bytes, which is impractical
     real_taxi_id = current_app.redis.hget(f'fake_taxi_id:{current_user.email}', fake_taxi_id)
     if real_taxi_id:
         return real_taxi_id.decode()
     # Assume already real taxi ID (e.g. simulator)
     return fake_taxi_id
+
+
+def _operator_taxis_key(operator_name):
+    return f'operator_taxis:{operator_name}'
+
+
+def filter_owned_taxi_ids(operator_name, taxi_ids):
+    """The set "operator_taxis:<operator>" caches the IDs of the taxis an
+    operator is allowed to report the location of, to avoid a SQL query on
+    each POST /geotaxi.
+
+    Return the subset of `taxi_ids` found in the set, or None if the set has
+    not been loaded yet (or has expired), in which case the caller is expected
+    to call set_owned_taxi_ids().
+    """
+    taxi_ids = list(taxi_ids)
+    key = _operator_taxis_key(operator_name)
+    pipeline = current_app.redis.pipeline(transaction=False)
+    pipeline.exists(key)
+    pipeline.smismember(key, taxi_ids)
+    exists, members = pipeline.execute()
+    if not exists:
+        return None
+    return {taxi_id for taxi_id, member in zip(taxi_ids, members) if member}
+
+
+def set_owned_taxi_ids(operator_name, taxi_ids):
+    """Replace the set of taxis owned by the operator. The set expires after
+    OWNED_TAXI_IDS_TTL, then it is loaded again from the database."""
+    key = _operator_taxis_key(operator_name)
+    pipeline = current_app.redis.pipeline()
+    pipeline.delete(key)
+    if taxi_ids:
+        pipeline.sadd(key, *taxi_ids)
+        pipeline.expire(key, OWNED_TAXI_IDS_TTL)
+    pipeline.execute()
+
+
+def add_owned_taxi_ids(operator_name, taxi_ids):
+    """Add taxis to the set of taxis owned by the operator, only if the set has
+    already been loaded: creating it would hide the other taxis of the
+    operator."""
+    if not taxi_ids:
+        return 0
+    return redis_scripts.run(
+        redis_scripts.SADD_IF_EXISTS,
+        [_operator_taxis_key(operator_name)],
+        list(taxi_ids)
+    )
+
+
+def clear_owned_taxi_ids():
+    """Remove the sets of all operators, they will be loaded again on the next
+    POST /geotaxi."""
+    pipeline = current_app.redis.pipeline()
+    for key in current_app.redis.scan_iter(_operator_taxis_key('*')):
+        pipeline.delete(key)
+    pipeline.execute()
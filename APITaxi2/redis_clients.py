@@ -0,0 +1,128 @@
+"""Named redis clients, one connection pool per workload, so a burst of one
+workload can't starve the others of connections:
+
+- geo_write: positions stored by POST /geotaxi, POST /geotaxi/bulk and the
+  UDP receiver
+- geo_read: geo indexes searched by GET /taxis, can be a replica
+- audit: stream of the hail logs, see redis_backend.log_hail()
+- background: read-only scans run by tasks and commands, such as
+  redis_backend.list_taxis(), can be a replica
+
+Each client is configured with the settings REDIS_<NAME>_URL,
+REDIS_<NAME>_MAX_CONNECTIONS and REDIS_<NAME>_SOCKET_TIMEOUT. A client without
+any of these settings is the default client current_app.redis.
+
+Only geo_read and background may point to a replica. The positions written
+by geo_write (taxi:<taxi_id>, last_seen, the geo indexes...) are read and
+cleaned with current_app.redis, so geo_write only has its own pool on the
+server of REDIS_URL: REDIS_GEO_WRITE_URL can't be another server.
+
+If the geo indexes are sharded (see redis_backend.get_geo_shards()), they are
+read and written on the shards, and geo_read is unused.
+"""
+
+import threading
+import time
+
+from flask import current_app
+import redis
+
+
+CLIENT_NAMES = ('geo_write', 'geo_read', 'audit', 'background')
+
+# Clients which must use the server of REDIS_URL
+SAME_SERVER_CLIENT_NAMES = ('geo_write',)
+
+# Maximum number of connections of a pool if REDIS_<NAME>_MAX_CONNECTIONS is
+# not set
+DEFAULT_MAX_CONNECTIONS = 50
+# Seconds to wait for a connection when all of them are in use
+POOL_TIMEOUT = 5
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """Connection pool which counts the connections in use and the time spent
+    waiting for a connection.
+
+    The waiting time includes the time to establish a new connection, but is
+    mostly spent in get_connection() when all the connections are in use.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.in_use = 0
+        self.acquired = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        connection = super().get_connection(*args, **kwargs)
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self.in_use += 1
+            self.acquired += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return connection
+
+    def release(self, connection):
+        with self._stats_lock:
+            self.in_use -= 1
+        return super().release(connection)
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {
+                'max_connections': self.max_connections,
+                'in_use': self.in_use,
+                'acquired': self.acquired,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+            }
+
+
+def init_app(app):
+    """Create the clients configured, the others are the default client
+    app.redis."""
+    clients = {}
+    for name in CLIENT_NAMES:
+        prefix = f'REDIS_{name.upper()}_'
+        url = app.config.get(prefix + 'URL')
+        max_connections = app.config.get(prefix + 'MAX_CONNECTIONS')
+        socket_timeout = app.config.get(prefix + 'SOCKET_TIMEOUT')
+        if not url and not max_connections and not socket_timeout:
+            continue
+
+        if url and name in SAME_SERVER_CLIENT_NAMES and url != app.config['REDIS_URL']:
+            raise ValueError(f'{prefix}URL must be the same as REDIS_URL')
+
+        url = url or app.config['REDIS_URL']
+        kwargs = {}
+        # Redis listens on a unix socket in tests, no keepalive
+        if not url.startswith('unix://'):
+            kwargs['socket_keepalive'] = True
+        pool = InstrumentedConnectionPool.from_url(
+            url,
+            max_connections=max_connections or DEFAULT_MAX_CONNECTIONS,
+            timeout=POOL_TIMEOUT,
+            socket_timeout=socket_timeout,
+            **kwargs
+        )
+        clients[name] = redis.Redis(connection_pool=pool)
+    app.extensions['redis_clients'] = clients
+
+
+def get(name):
+    """Return the redis client of the workload `name`, see CLIENT_NAMES."""
+    assert name in CLIENT_NAMES
+    return current_app.extensions.get('redis_clients', {}).get(name) or current_app.redis
+
+
+def get_stats():
+    """Return the dictionary {name: stats of the connection pool} of the
+    clients configured. Stats are per process."""
+    return {
+        name: client.connection_pool.get_stats()
+        for name, client in current_app.extensions.get('redis_clients', {}).items()
+    }
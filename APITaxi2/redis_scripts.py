@@ -0,0 +1,471 @@
+"""Lua scripts executed server-side by redis.
+
+Scripts are registered lazily, once per application, and called with EVALSHA.
+redis-py loads the script again if the server doesn't know about it (after a
+restart, or when the client points to another server).
+"""
+
+from flask import current_app
+
+
+# Lua functions to read and write the values of the hashes taxi:<taxi_id>,
+# either "<timestamp> <lat> <lon> free phone 2" or packed, see
+# redis_backend.pack_taxi_position(). Prepended to the scripts which need them.
+_TAXI_POSITION_FUNCTIONS = """
+local function is_packed(value)
+    return string.byte(value, 1) == 1 and #value == 13
+end
+
+local function pack_int32(value)
+    value = math.floor(value + 0.5)
+    if value < 0 then
+        value = value + 4294967296
+    end
+    return string.char(
+        value % 256,
+        math.floor(value / 256) % 256,
+        math.floor(value / 65536) % 256,
+        math.floor(value / 16777216) % 256
+    )
+end
+
+local function unpack_int32(data, offset)
+    local b1, b2, b3, b4 = string.byte(data, offset, offset + 3)
+    local value = b1 + b2 * 256 + b3 * 65536 + b4 * 16777216
+    if value >= 2147483648 then
+        value = value - 4294967296
+    end
+    return value
+end
+
+local function pack_position(timestamp, lat, lon)
+    return '\\1' .. pack_int32(timestamp) .. pack_int32(lat * 1000000) .. pack_int32(lon * 1000000)
+end
+
+-- Return timestamp, lat and lon, or nil if the value can't be parsed
+local function parse_position(value)
+    if is_packed(value) then
+        return unpack_int32(value, 2), unpack_int32(value, 6) / 1000000, unpack_int32(value, 10) / 1000000
+    end
+    local timestamp, lat, lon = string.match(value, '^(%S+) (%S+) (%S+)')
+    return tonumber(timestamp), tonumber(lat), tonumber(lon)
+end
+"""
+
+
+# Lua function to keep a member taxi_id:operator in the geo index of a
+# single INSEE code. The hash geoindex_insee_members stores the INSEE code of
+# the index of each member: when it changes, the member is removed from the
+# index of its previous INSEE code, which is not declared in KEYS. Return true
+# if the INSEE code changed.
+_GEOINDEX_INSEE_FUNCTIONS = """
+local function set_geoindex_insee(members_key, member, insee)
+    local previous = redis.call('HGET', members_key, member)
+    if previous == insee then
+        return false
+    end
+    if previous then
+        redis.call('ZREM', 'geoindex_insee:' .. previous, member)
+    end
+    redis.call('HSET', members_key, member, insee)
+    return true
+end
+"""
+
+
+# Store a batch of taxi positions reported by the same operator.
+#
+# KEYS: geoindex, geoindex_2, timestamps, timestamps_id, geotaxi_coalesced,
+#       last_seen, geoindex_insee_members, then the hash storing the position
+#       (taxi:<taxi_id>, or taxis:<bucket>) and geoindex_insee:<insee> for each
+#       position.
+# ARGV: operator, timestamp, move threshold (meters), max age (seconds),
+#       "1" to write the geo indexes or "0" if they are sharded, "1" to store
+#       positions in the packed format or "0" for the text format, "1" if
+#       positions are stored in buckets taxis:<bucket> with the field
+#       taxi_id:operator or "0" for taxi:<taxi_id> with the field operator, then taxi_id,
+#       lon, lat and INSEE code of the ADS (or an empty string if unknown) for
+#       each position.
+#
+# Unless positions are stored in buckets, the key layout is the same as the
+# one historically written by the geotaxi worker, see redis_backend.get_taxi() and redis_backend.taxis_locations_by_operator().
+# The zset last_seen, never expired, and the geo indexes by INSEE code
+# geoindex_insee:<insee> are specific to the API.
+#
+# If the move threshold is positive, a taxi which moved less than the
+# threshold since its last position stored less than "max age" seconds ago
+# only has its timestamps refreshed. The number of such positions is counted
+# by operator in the hash geotaxi_coalesced.
+#
+# A taxi whose INSEE code changed is removed from the geo index of its
+# previous INSEE code, see set_geoindex_insee(), and its location is written
+# even if it didn't move.
+#
+# If the geo indexes are sharded, geoindex, geoindex_2, geoindex_insee:<insee>,
+# geoindex_insee_members, timestamps and timestamps_id are not written: the
+# caller writes them on the shard of each position, see
+# redis_backend.get_geo_shard() and GEOADD_INSEE.
+UPDATE_POSITIONS = _TAXI_POSITION_FUNCTIONS + _GEOINDEX_INSEE_FUNCTIONS + """
+local operator = ARGV[1]
+local now = tonumber(ARGV[2])
+local threshold = tonumber(ARGV[3])
+local max_age = tonumber(ARGV[4])
+local write_geo = ARGV[5] == '1'
+local packed = ARGV[6] == '1'
+local bucketed = ARGV[7] == '1'
+local coalesced = 0
+
+local function has_moved(previous, lon, lat)
+    if not previous then
+        return true
+    end
+    local timestamp, previous_lat, previous_lon = parse_position(previous)
+    if not timestamp or now - timestamp >= max_age then
+        return true
+    end
+    -- Equirectangular approximation, precise enough for a few meters
+    local dx = (lon - previous_lon) * math.cos(math.rad(lat)) * 111320
+    local dy = (lat - previous_lat) * 110540
+    return dx * dx + dy * dy >= threshold * threshold
+end
+
+for i = 8, #KEYS, 2 do
+    local n = 8 + (i - 8) * 2
+    local taxi_id, lon, lat, insee = ARGV[n], ARGV[n + 1], ARGV[n + 2], ARGV[n + 3]
+    local taxi_operator = taxi_id .. ':' .. operator
+    local field = bucketed and taxi_operator or operator
+    local insee_changed = write_geo and insee ~= '' and set_geoindex_insee(KEYS[7], taxi_operator, insee)
+
+    if threshold <= 0 or insee_changed
+        or has_moved(redis.call('HGET', KEYS[i], field), tonumber(lon), tonumber(lat))
+    then
+        if packed then
+            redis.call('HSET', KEYS[i], field, pack_position(now, tonumber(lat), tonumber(lon)))
+        else
+            -- The last three fields are unused, fill them with whatever is expected
+            redis.call('HSET', KEYS[i], field, now .. ' ' .. lat .. ' ' .. lon .. ' free phone 2')
+        end
+        if write_geo then
+            redis.call('GEOADD', KEYS[1], lon, lat, taxi_id)
+            redis.call('GEOADD', KEYS[2], lon, lat, taxi_operator)
+            if insee ~= '' then
+                redis.call('GEOADD', KEYS[i + 1], lon, lat, taxi_operator)
+            end
+        end
+    else
+        coalesced = coalesced + 1
+    end
+    if write_geo then
+        redis.call('ZADD', KEYS[3], now, taxi_operator)
+        redis.call('ZADD', KEYS[4], now, taxi_id)
+    end
+    redis.call('ZADD', KEYS[6], now, taxi_operator)
+end
+
+if coalesced > 0 then
+    redis.call('HINCRBY', KEYS[5], operator, coalesced)
+end
+
+return (#KEYS - 7) / 2
+"""
+
+
+# GEOADD a location to the geo index of the INSEE code of the taxi, and remove
+# it from the index of its previous INSEE code, see set_geoindex_insee(). Used
+# on the shards, where UPDATE_POSITIONS doesn't write the geo indexes.
+#
+# KEYS: geoindex_insee_members, geoindex_insee:<insee>
+# ARGV: taxi_id:operator, lon, lat, insee
+GEOADD_INSEE = _GEOINDEX_INSEE_FUNCTIONS + """
+set_geoindex_insee(KEYS[1], ARGV[1], ARGV[4])
+return redis.call('GEOADD', KEYS[2], ARGV[2], ARGV[3], ARGV[1])
+"""
+
+
+# Convert the values of the hashes taxi:<taxi_id> from the text format to the
+# packed format.
+#
+# KEYS: taxi:<taxi_id> for each hash to convert
+#
+# Return the number of values converted.
+PACK_TAXI_POSITIONS = _TAXI_POSITION_FUNCTIONS + """
+local converted = 0
+for _, key in ipairs(KEYS) do
+    local values = redis.call('HGETALL', key)
+    for i = 1, #values, 2 do
+        if not is_packed(values[i + 1]) then
+            local timestamp, lat, lon = parse_position(values[i + 1])
+            if timestamp then
+                redis.call('HSET', key, values[i], pack_position(timestamp, lat, lon))
+                converted = converted + 1
+            end
+        end
+    end
+end
+return converted
+"""
+
+
+# Move the positions of hashes taxi:<taxi_id> to the buckets taxis:<bucket>.
+# Positions already stored in the bucket are more recent and are kept.
+#
+# KEYS: taxi:<taxi_id> and taxis:<bucket> for each hash to move
+# ARGV: taxi_id for each hash to move
+#
+# Return the number of positions moved.
+MOVE_TAXI_POSITIONS_TO_BUCKETS = """
+local moved = 0
+for i = 1, #KEYS, 2 do
+    local values = redis.call('HGETALL', KEYS[i])
+    for j = 1, #values, 2 do
+        moved = moved + redis.call('HSETNX', KEYS[i + 1], ARGV[(i + 1) / 2] .. ':' .. values[j], values[j + 1])
+    end
+    redis.call('DEL', KEYS[i])
+end
+return moved
+"""
+
+
+# List the members of one or several geo indexes within a radius, with their
+# score in a sorted set, in a single round-trip.
+#
+# KEYS: timestamps, then the geo indexes to search, usually geoindex_2 or
+#       several geoindex_insee:<insee>
+# ARGV: lon, lat, radius (meters), maximum number of members returned for
+#       each geo index, or 0 to return all of them
+#
+# Return a list of {member, distance, {lon, lat}, timestamp}, sorted by
+# distance for each geo index, where timestamp is nil if the member is not in
+# the sorted set. With a maximum number of members, only the closest ones are
+# returned (COUNT without ANY, so redis still sorts the whole radius, but
+# members beyond the count are neither returned nor looked up in the sorted
+# set).
+GEOSEARCH_WITH_TIMESTAMPS = """
+local count = tonumber(ARGV[4])
+local ret = {}
+for i = 2, #KEYS do
+    local rows
+    if count > 0 then
+        rows = redis.call('GEOSEARCH', KEYS[i], 'FROMLONLAT', ARGV[1], ARGV[2], 'BYRADIUS', ARGV[3], 'm',
+                          'ASC', 'COUNT', count, 'WITHCOORD', 'WITHDIST')
+    else
+        rows = redis.call('GEOSEARCH', KEYS[i], 'FROMLONLAT', ARGV[1], ARGV[2], 'BYRADIUS', ARGV[3], 'm',
+                          'ASC', 'WITHCOORD', 'WITHDIST')
+    end
+    for _, row in ipairs(rows) do
+        row[4] = redis.call('ZSCORE', KEYS[1], row[1])
+        ret[#ret + 1] = row
+    end
+end
+return ret
+"""
+
+
+# Search the taxis available around a location entirely server-side: the
+# locations of the geo indexes are filtered like
+# views.taxis._get_available_taxis() and _is_in_reach() do, from the hashes
+# taxi_search:<taxi_id>:<operator> (see redis_backend.TaxiSearchMetadata),
+# whose status is the only one checked. These keys are not declared: the
+# script can only be used if they are stored with the geo indexes, which are
+# not sharded.
+#
+# KEYS: timestamps, then the geo indexes to search, the
+#       geoindex_insee:<insee> of the INSEE codes allowed
+# ARGV: lon, lat, radius (meters), maximum number of members read from each
+#       geo index (0 for all of them), minimum timestamp of the locations,
+#       radius of the taxis without a preference, prefix of the metadata
+#       hashes, email of the only operator whose taxis are searched or an empty
+#       string, then the fields of the metadata hashes, starting with status,
+#       radius, last_update_at and insee
+#
+# A location is only kept from the geo index of the INSEE code of the taxi's
+# metadata, so the location left in the index of its previous ADS is ignored.
+#
+# Return {taxis, unresolved, found, truncated, closest}:
+# - taxis: the taxis available and in reach, sorted by distance, as
+#   {member, distance, {lon, lat}, timestamp, {metadata values}}. For a taxi
+#   reported by several operators, only the operator whose metadata has been
+#   updated last is kept.
+# - unresolved: the members of the taxis with an operator without metadata, as
+#   {member, distance, {lon, lat}, timestamp}, left to the caller.
+# - found: number of taxis available, in reach or not, unresolved excluded
+# - truncated: 1 if the maximum number of members was read from the geo
+#   indexes overall, so taxis within the radius might have been left out,
+#   like redis_backend.is_truncated(), 0 otherwise
+# - closest: distance of the closest of them, or nil
+SEARCH_AVAILABLE_TAXIS = """
+local count = tonumber(ARGV[4])
+local min_timestamp = tonumber(ARGV[5])
+local default_radius = tonumber(ARGV[6])
+local prefix = ARGV[7]
+local operator = ARGV[8]
+local fields = {}
+for i = 9, #ARGV do
+    fields[#fields + 1] = ARGV[i]
+end
+
+-- Rows of each taxi, and taxi IDs in the order they are found
+local candidates = {}
+local taxi_ids = {}
+local unresolved = {}
+local seen = {}
+local read = 0
+for i = 2, #KEYS do
+    local insee = string.match(KEYS[i], '^geoindex_insee:(.*)$')
+    local rows
+    if count > 0 then
+        rows = redis.call('GEOSEARCH', KEYS[i], 'FROMLONLAT', ARGV[1], ARGV[2], 'BYRADIUS', ARGV[3], 'm',
+                          'ASC', 'COUNT', count, 'WITHCOORD', 'WITHDIST')
+    else
+        rows = redis.call('GEOSEARCH', KEYS[i], 'FROMLONLAT', ARGV[1], ARGV[2], 'BYRADIUS', ARGV[3], 'm',
+                          'ASC', 'WITHCOORD', 'WITHDIST')
+    end
+    read = read + #rows
+    for _, row in ipairs(rows) do
+        local member = row[1]
+        local taxi_id, member_operator = string.match(member, '^(.-):(.*)$')
+        local timestamp = redis.call('ZSCORE', KEYS[1], member)
+        if taxi_id and not seen[member]
+            and (operator == '' or member_operator == operator)
+            and timestamp and tonumber(timestamp) >= min_timestamp
+        then
+            row[4] = timestamp
+            local metadata = redis.call('HMGET', prefix .. member, unpack(fields))
+            -- The status is always stored, possibly empty
+            if not metadata[1] then
+                seen[member] = true
+                if not candidates[taxi_id] then
+                    candidates[taxi_id] = {}
+                    taxi_ids[#taxi_ids + 1] = taxi_id
+                end
+                unresolved[taxi_id] = true
+                table.insert(candidates[taxi_id], row)
+            elseif metadata[4] == insee then
+                seen[member] = true
+                if not candidates[taxi_id] then
+                    candidates[taxi_id] = {}
+                    taxi_ids[#taxi_ids + 1] = taxi_id
+                end
+                if metadata[1] == 'free' then
+                    row[5] = metadata
+                    table.insert(candidates[taxi_id], row)
+                end
+            end
+        end
+    end
+end
+
+local taxis = {}
+local unresolved_rows = {}
+local found = 0
+local closest = nil
+for _, taxi_id in ipairs(taxi_ids) do
+    local rows = candidates[taxi_id]
+    if unresolved[taxi_id] then
+        for _, row in ipairs(rows) do
+            unresolved_rows[#unresolved_rows + 1] = {row[1], row[2], row[3], row[4]}
+        end
+    elseif #rows > 0 then
+        local best = rows[1]
+        for j = 2, #rows do
+            local best_update, update = tonumber(best[5][3]), tonumber(rows[j][5][3])
+            if not (best_update and update and best_update >= update) then
+                best = rows[j]
+            end
+        end
+        found = found + 1
+        local distance = tonumber(best[2])
+        if not closest or distance < tonumber(closest) then
+            closest = best[2]
+        end
+        local radius = tonumber(best[5][2])
+        if not radius or radius == 0 then
+            radius = default_radius
+        end
+        if distance <= radius then
+            taxis[#taxis + 1] = best
+        end
+    end
+end
+table.sort(taxis, function(a, b) return tonumber(a[2]) < tonumber(b[2]) end)
+local truncated = 0
+if count > 0 and read >= count then
+    truncated = 1
+end
+return {taxis, unresolved_rows, found, truncated, closest}
+"""
+
+
+# Remove up to "limit" taxis with a location older than "max time" from
+# geoindex and timestamps_id.
+#
+# KEYS: timestamps_id, geoindex
+# ARGV: max time, limit
+#
+# Return the number of taxis removed.
+EXPIRE_TAXI_IDS = """
+local taxi_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #taxi_ids == 0 then
+    return 0
+end
+redis.call('ZREM', KEYS[2], unpack(taxi_ids))
+redis.call('ZREM', KEYS[1], unpack(taxi_ids))
+return #taxi_ids
+"""
+
+
+# Remove up to "limit" members taxi_id:operator with a location older than
+# "max time" from timestamps, geoindex_2 and the geo index by INSEE code of
+# the member, read from the hash geoindex_insee_members (see
+# set_geoindex_insee()) and not declared in KEYS. The entry of the hash is
+# removed too.
+#
+# KEYS: timestamps, geoindex_2, geoindex_insee_members
+# ARGV: max time, limit
+#
+# Return the number of members removed.
+EXPIRE_TAXI_OPERATORS = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #members == 0 then
+    return 0
+end
+local insee_codes = redis.call('HMGET', KEYS[3], unpack(members))
+for i, member in ipairs(members) do
+    if insee_codes[i] then
+        redis.call('ZREM', 'geoindex_insee:' .. insee_codes[i], member)
+    end
+end
+redis.call('HDEL', KEYS[3], unpack(members))
+redis.call('ZREM', KEYS[2], unpack(members))
+redis.call('ZREM', KEYS[1], unpack(members))
+return #members
+"""
+
+
+# SADD members to the set KEYS[1] only if the set exists.
+SADD_IF_EXISTS = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+return redis.call('SADD', KEYS[1], unpack(ARGV))
+"""
+
+
+# HSET fields of the hash KEYS[1] only if the hash exists.
+#
+# ARGV: field, value, field, value...
+HSET_IF_EXISTS = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+return redis.call('HSET', KEYS[1], unpack(ARGV))
+"""
+
+
+def run(script, keys, args, client=None):
+    """Execute the Lua `script` with EVALSHA on `client`, or on the default
+    redis client if not provided."""
+    scripts = current_app.extensions.setdefault('redis_scripts', {})
+    if script not in scripts:
+        scripts[script] = current_app.redis.register_script(script)
+    return scripts[script](keys=keys, args=args, client=client)
@@ -0,0 +1,109 @@
+"""Read-only reference data kept in the memory of each process: exclusion
+zones, index of the towns, lists of towns and groups, and the swagger
+specification.
+
+Under uWSGI, the reference data is loaded by the master before it forks the
+workers, so the first requests are not slower and the memory is shared
+copy-on-write by all the workers. uWSGI must not be started with
+"lazy-apps", which loads the application in each worker.
+
+The commands changing the reference data call publish_reload(): each worker
+subscribes to the redis channel RELOAD_CHANNEL, and reloads everything when
+a message is published. Outside of uWSGI, the data is loaded by the first
+request which needs it, and only reloaded by the process changing it.
+"""
+
+import gc
+import json
+import logging
+import time
+
+from flask import current_app
+
+from APITaxi_models2 import db
+
+from . import exclusions, town_index
+from .views import stats as stats_views, zupc as zupc_views
+
+
+logger = logging.getLogger(__name__)
+
+RELOAD_CHANNEL = 'reference_data_reload'
+
+
+def load():
+    """Load all the reference data of the current application."""
+    exclusions.ExclusionHelper()
+    town_index.get_town_index()
+    zupc_views._dump_towns(None)
+    stats_views._get_groups(None)
+    stats_views._get_managers()
+    get_swagger_json(current_app)
+
+
+def reset():
+    """Forget the reference data of the current process, and load it again."""
+    exclusions.ExclusionHelper().reset()
+    current_app.extensions.pop('town_index', None)
+    zupc_views._dump_towns.cache_clear()
+    stats_views._get_groups.cache_clear()
+    stats_views._get_managers.cache_clear()
+    load()
+
+
+def publish_reload():
+    """Ask all the workers to reload the reference data."""
+    current_app.redis.publish(RELOAD_CHANNEL, 'reload')
+
+
+def get_swagger_json(app):
+    """Return the swagger specification of `app`, serialized once."""
+    if 'swagger_json' not in app.extensions:
+        app.extensions['swagger_json'] = json.dumps(app.apispec.to_dict(), indent=2)
+    return app.extensions['swagger_json']
+
+
+def _subscribe(app):
+    """Reload the reference data when a message is published to
+    RELOAD_CHANNEL. Return the thread reading the channel."""
+    def handle_message(message):
+        logger.info('Reload the reference data')
+        with app.app_context():
+            reset()
+
+    def handle_exception(exc, pubsub, thread):
+        # The subscription is restored when the connection is back
+        logger.warning('Unable to read the channel %s: %s', RELOAD_CHANNEL, exc)
+        time.sleep(1)
+
+    pubsub = app.redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{RELOAD_CHANNEL: handle_message})
+    return pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=handle_exception)
+
+
+def init_app(app):
+    """If the application is loaded by the master process of uWSGI, load the
+    reference data before the workers are forked, and subscribe to the reload
+    messages in each worker."""
+    try:
+        import uwsgi
+        from uwsgidecorators import postfork
+    except ImportError:
+        return
+
+    # With lazy-apps, the application is loaded by each worker after the fork
+    if uwsgi.opt.get('lazy-apps') or uwsgi.worker_id() != 0:
+        _subscribe(app)
+        return
+
+    with app.app_context():
+        load()
+        # Connections must not be shared by the workers
+        db.session.remove()
+        db.engine.dispose()
+    # Objects loaded so far are never collected: move them to the permanent
+    # generation, so the garbage collector of the workers doesn't write to
+    # their memory pages, which would copy them.
+    gc.freeze()
+
+    postfork(lambda: _subscribe(app))
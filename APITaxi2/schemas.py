@@ -35,12 +35,19 @@ from APITaxi_models2.vehicle import (
 )
 
 from .security import current_user
+from .serializers import CompiledDumpMixin
 
 
 # Range to adjust the visibility of taxis to clients
 TAXI_MIN_RADIUS = 150
 TAXI_MAX_RADIUS = 500
 
+# Maximum value of the querystring argument ?limit of GET /taxis
+TAXIS_SEARCH_MAX_LIMIT = 100
+
+# Maximum number of points searched at once by POST /taxis/search
+TAXIS_SEARCH_BATCH_MAX_POINTS = 100
+
 # Consider taxis on a neutral basis for clients
 NEUTRAL_OPERATOR = "chauffeur professionnel"
 
@@ -355,6 +362,10 @@ class TaxiPositionSchema(Schema):
 
 class ListTaxisQueryStringSchema(PositionMixin, Schema):
     """Schema for querystring arguments of GET /taxis."""
+    limit = fields.Int(required=False, validate=validate.Range(min=1, max=TAXIS_SEARCH_MAX_LIMIT), metadata={
+        'description': 'Maximum number of taxis returned, the closest first',
+    })
+
     class Meta:
         """Allow and discard unknown fields."""
         # TODO left for backwards compatibility with partners who still use them
@@ -395,7 +406,7 @@ class TownSchema(Schema):
     name = fields.String()
 
 
-class TaxiSchema(Schema):
+class TaxiSchema(CompiledDumpMixin, Schema):
     """Schema to list, create, read or update taxis"""
 
     class Meta:
@@ -494,7 +505,7 @@ class SearchVehicleSchema(Schema):
     cpam_conventionne = fields.Constant(None, metadata={'deprecated': True, 'description': "always null, kept for compatibility"})
 
 
-class SearchTaxiSchema(Schema):
+class SearchTaxiSchema(CompiledDumpMixin, Schema):
     """Fork of the full taxi schema with only the parts required for client apps."""
     id = fields.String()
     operator = fields.Constant(NEUTRAL_OPERATOR, metadata={
@@ -512,23 +523,23 @@ class SearchTaxiSchema(Schema):
     added_at = fields.Constant("1970-01-01T00:00:00", metadata={'deprecated': True})
 
     def dump(self, obj, *args, **kwargs):
-        """This function should be called with a list of tuples of three
+        """This function should be called with a list of tuples of two
         elements:
 
-        * the taxi object to dump
-        * since a taxi can have several VehicleDescription (one for each
-          operator), the second element should be the description to dump
+        * the `redis_backend.TaxiSearchMetadata` of the taxi to dump, for the
+          operator to dump
         * a `redis_backend.Location` object to display the taxi
           location and the crowfly distance between the API caller and the
           taxi.
         """
-        try:
-            taxi, vehicle_description, redis_location = obj
-        except ValueError:
-            taxi, vehicle_description = obj
-            redis_location = None
+        metadata, redis_location = obj
+        # Called for each taxi of the search, don't resolve the proxies each time
+        user = current_user._get_current_object()
+        is_admin = user.has_role('admin') if user else None
+        config = current_app.config
 
-        ret = super().dump(taxi, *args, **kwargs)
+        # The fields of the vehicle are added below
+        ret = super().dump({'id': metadata.taxi_id, 'vehicle': {}}, *args, **kwargs)
 
         # Add fields for backwards compatibility, but to remove ASAP
         ret.update({
@@ -552,9 +563,9 @@ class SearchTaxiSchema(Schema):
             },
         })
 
-        # Add fields from vehicle_description and redis_location
+        # Add fields from metadata and redis_location
         ret.update({
-            'operator': vehicle_description.added_by.email,
+            'operator': metadata.operator,
             'position': {
                 'lon': redis_location.lon if redis_location else None,
                 'lat': redis_location.lat if redis_location else None,
@@ -562,36 +573,68 @@ class SearchTaxiSchema(Schema):
             'crowfly_distance': redis_location.distance if redis_location else None
         })
         ret['vehicle'].update({
-            'model': vehicle_description.model or None,
-            'constructor': vehicle_description.constructor or None,
-            'nb_seats': vehicle_description.nb_seats,
-            'engine': vehicle_description.engine,
-            'characteristics': vehicle_description.characteristics,
+            'model': metadata.model or None,
+            'constructor': metadata.constructor or None,
+            'nb_seats': metadata.nb_seats,
+            'engine': metadata.engine,
+            'characteristics': metadata.characteristics,
             # Moved to HailVehicleSchema
             'color': "",
             # Needed for tracing down issues
-            'licence_plate': taxi.vehicle.licence_plate if current_user and current_user.has_role('admin') else "",
+            'licence_plate': metadata.licence_plate if is_admin else "",
         })
 
         # Don't expose the real taxi ID to the customer
-        if current_app.config.get('FAKE_TAXI_ID'):
-            if current_user and not current_user.has_role('admin'):
+        if config.get('FAKE_TAXI_ID'):
+            if user and not is_admin:
                 # Don't hide when our virtual operator is involved, we'll need this for the simulator
-                if current_user.email != current_app.config.get('INTEGRATION_ACCOUNT_EMAIL'):
-                    ret['id'] = taxi.fake_taxi_id
+                if user.email != config.get('INTEGRATION_ACCOUNT_EMAIL'):
+                    ret['id'] = metadata.fake_taxi_id
 
         # Consider taxis on a neutral basis for clients, including when the partner is both moteur and operateur
         # but keep the information for the admin console
-        if current_app.config.get('NEUTRAL_OPERATOR'):
-            if current_user and not current_user.has_role('admin'):
+        if config.get('NEUTRAL_OPERATOR'):
+            if user and not is_admin:
                 # We still need to tell our virtual operator apart
-                if ret['operator'] == current_app.config.get('INTEGRATION_ACCOUNT_EMAIL'):
+                if ret['operator'] == config.get('INTEGRATION_ACCOUNT_EMAIL'):
                     ret['driver']['professional_licence'] = "integration"
                 ret['operator'] = NEUTRAL_OPERATOR
 
         return ret
 
 
+class SearchPointSchema(PositionMixin, Schema):
+    """Location searched by POST /taxis/search."""
+
+
+class SearchTaxisBatchSchema(Schema):
+    """Body of POST /taxis/search"""
+    points = fields.Nested(SearchPointSchema, required=True, many=True)
+    limit = fields.Int(required=False, validate=validate.Range(min=1, max=TAXIS_SEARCH_MAX_LIMIT), metadata={
+        'description': 'Maximum number of taxis returned for each point, the closest first',
+    })
+
+    @validates('points')
+    def check_length(self, points):
+        """Reject the whole request if too many points are searched"""
+        if len(points) > TAXIS_SEARCH_BATCH_MAX_POINTS:
+            raise ValidationError(f'Up to {TAXIS_SEARCH_BATCH_MAX_POINTS} points are accepted')
+
+
+class SearchTaxisBatchPointSchema(Schema):
+    """Taxis found around a point by POST /taxis/search: "data" or "errors"
+    are the same as the response of GET /taxis at this point."""
+    lon = fields.Float()
+    lat = fields.Float()
+    data = fields.List(fields.Nested(SearchTaxiSchema))
+    errors = fields.Dict(keys=fields.Str(), values=fields.List(fields.Str()))
+
+
+class SearchTaxisBatchResultSchema(Schema):
+    """Response of POST /taxis/search, in the order of the points searched"""
+    points = fields.List(fields.Nested(SearchTaxisBatchPointSchema))
+
+
 class ListTaxisAllQuerystringSchema(Schema, PageQueryStringMixin):
     """Querystring arguments for GET /taxis/all."""
     id = fields.List(fields.String)
@@ -792,7 +835,7 @@ class HailTaxiSchema(Schema):
     driver = fields.Nested(HailDriverSchema, dump_only=True)
 
 
-class HailSchema(Schema):
+class HailSchema(CompiledDumpMixin, Schema):
     """Schema to read and update hails."""
     id = fields.String(dump_only=True)
     session_id = fields.UUID(dump_only=True)
@@ -1047,6 +1090,14 @@ class GeotaxiSchema(Schema):
             raise ValidationError('Up to 50 positions are accepted')
 
 
+class GeotaxiBulkSchema(Schema):
+    """Response of POST /geotaxi/bulk"""
+    received = fields.Integer()
+    stored = fields.Integer()
+    # Key is the line number
+    errors = fields.Dict(keys=fields.Str(), values=fields.Dict())
+
+
 class StatsMilestones(Schema):
     today = fields.Integer()
     three_months_ago = fields.Integer()
@@ -1208,7 +1259,7 @@ def data_schema_wrapper(WrappedSchema, with_pagination=False):
         def __init__(self, name, bases, attrs):
             return super().__init__(self.__name__, bases, attrs)
 
-    class DataSchema(Schema, metaclass=MCS):
+    class DataSchema(CompiledDumpMixin, Schema, metaclass=MCS):
         data = fields.List(fields.Nested(WrappedSchema), required=True)
 
         if with_pagination:
@@ -1237,6 +1288,8 @@ DataDriverSchema = data_schema_wrapper(DriverSchema())
 DataTaxiSchema = data_schema_wrapper(TaxiSchema())
 DataTaxiListSchema = data_schema_wrapper(TaxiSchema(), with_pagination=True)
 DataSearchTaxiSchema = data_schema_wrapper(SearchTaxiSchema())
+DataSearchTaxisBatchSchema = data_schema_wrapper(SearchTaxisBatchSchema())
+DataSearchTaxisBatchResultSchema = data_schema_wrapper(SearchTaxisBatchResultSchema())
 DataCreateHailSchema = data_schema_wrapper(CreateHailSchema())
 DataHailSchema = data_schema_wrapper(HailSchema())
 DataHailListSchema = data_schema_wrapper(HailListSchema(), with_pagination=True)
@@ -1247,6 +1300,7 @@ DataVehicleSchema = data_schema_wrapper(VehicleSchema())
 DataZUPCSchema = data_schema_wrapper(ZUPCSchema())
 DataZUPCGeomSchema = data_schema_wrapper(ZUPCGeomSchema())
 DataGeotaxiSchema = data_schema_wrapper(GeotaxiSchema())
+DataGeotaxiBulkSchema = data_schema_wrapper(GeotaxiBulkSchema())
 DataTownSchema = data_schema_wrapper(TownSchema())
 DataStatsTaxisSchema = data_schema_wrapper(StatsTaxisSchema())
 DataStatsHailsSchema = data_schema_wrapper(StatsHailsSchema())
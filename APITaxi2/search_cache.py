@@ -0,0 +1,162 @@
+"""Short-lived cache of the taxis found by GET /taxis.
+
+Customer apps search again every few seconds while the map is open, and many
+customers search from the same places, such as stations and airports. When
+the setting SEARCH_CACHE_TTL is set (in seconds, 1 to 3 is advised), the
+taxis available around a location are kept for this duration, and searches
+of the same user, with the same visibility and limit, in the same town and
+the same cell of a grid of SEARCH_CACHE_GRID degrees, don't search the geo
+indexes nor the database again.
+
+The distances of the cached taxis are those from the location of the first
+search of the cell, and a taxi which is no longer available is still
+returned until the entry expires.
+
+The cache is kept in the memory of each process. Hits and misses are counted
+per process, see SearchCache.get_stats(), and added up for all the processes
+in redis, see SearchCache.flush_stats() and get_global_stats().
+"""
+
+import collections
+import os
+import threading
+import time
+
+from flask import current_app
+
+
+# Size (in degrees) of the cells of the grid if SEARCH_CACHE_GRID is not set,
+# about 110m x 75m in metropolitan France.
+DEFAULT_GRID = 0.001
+
+# Maximum number of entries, the oldest ones are removed first
+MAX_ENTRIES = 10000
+
+# The hits and misses of each process are added every STATS_FLUSH_INTERVAL
+# seconds to the hash search_cache_stats:<minute>, kept STATS_RETENTION
+# seconds.
+STATS_KEY_PREFIX = 'search_cache_stats:'
+STATS_FLUSH_INTERVAL = 10
+STATS_RETENTION = 3600
+
+
+class SearchCache:
+    def __init__(self, ttl, grid):
+        self.ttl = ttl
+        self.grid = grid
+        self._lock = threading.Lock()
+        # As all the entries have the same TTL, they are in the order they
+        # expire
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._flushed_hits = 0
+        self._flushed_misses = 0
+        self._flushed_at = time.monotonic()
+
+    def make_key(self, user, only_own_taxis, insee, lon, lat, limit):
+        """Return the key of the search of `user` around (lon, lat)."""
+        return (
+            user, only_own_taxis, insee,
+            round(lon / self.grid), round(lat / self.grid),
+            limit,
+        )
+
+    def get(self, key):
+        """Return the value stored for `key`, or None if there is none or it
+        has expired."""
+        now = time.monotonic()
+        with self._lock:
+            expires_at, value = self._entries.get(key, (None, None))
+            if expires_at is None or expires_at <= now:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store `value` for `key`. It must not be modified afterwards, as it
+        is shared by the requests."""
+        now = time.monotonic()
+        with self._lock:
+            self._entries.pop(key, None)
+            # Remove the expired entries, and the oldest ones if there are
+            # still too many
+            while self._entries:
+                expires_at, _ = next(iter(self._entries.values()))
+                if expires_at > now and len(self._entries) < MAX_ENTRIES:
+                    break
+                self._entries.popitem(last=False)
+            self._entries[key] = (now + self.ttl, value)
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'ttl': self.ttl,
+                'grid': self.grid,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None,
+            }
+
+    def flush_stats(self, client, force=False):
+        """Add the hits and misses counted since the last flush to the hash
+        of the current minute stored by the redis `client`. Unless `force` is
+        true, do nothing if the last flush was less than STATS_FLUSH_INTERVAL
+        seconds ago."""
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._flushed_at < STATS_FLUSH_INTERVAL:
+                return
+            hits = self.hits - self._flushed_hits
+            misses = self.misses - self._flushed_misses
+            self._flushed_hits, self._flushed_misses, self._flushed_at = self.hits, self.misses, now
+        if not hits and not misses:
+            return
+
+        key = f'{STATS_KEY_PREFIX}{int(time.time() // 60)}'
+        pipeline = client.pipeline(transaction=False)
+        pipeline.hincrby(key, 'hits', hits)
+        pipeline.hincrby(key, 'misses', misses)
+        pipeline.expire(key, STATS_RETENTION)
+        pipeline.execute()
+
+
+def get_global_stats(client, minutes=5):
+    """Return the hits and misses of all the processes during the last
+    `minutes` minutes, as flushed by SearchCache.flush_stats() to the redis
+    `client`."""
+    current = int(time.time() // 60)
+    pipeline = client.pipeline(transaction=False)
+    for minute in range(current - minutes + 1, current + 1):
+        pipeline.hgetall(f'{STATS_KEY_PREFIX}{minute}')
+    hits = misses = 0
+    for counters in pipeline.execute():
+        hits += int(counters.get(b'hits', 0))
+        misses += int(counters.get(b'misses', 0))
+    lookups = hits + misses
+    return {
+        'minutes': minutes,
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / lookups if lookups else None,
+    }
+
+
+def get_search_cache():
+    """Return the SearchCache of the current process, or None if the setting
+    SEARCH_CACHE_TTL is not set."""
+    ttl = current_app.config.get('SEARCH_CACHE_TTL')
+    if not ttl:
+        return None
+
+    grid = current_app.config.get('SEARCH_CACHE_GRID') or DEFAULT_GRID
+    cache, pid = current_app.extensions.get('search_cache', (None, None))
+    # Created again if the settings changed, or in a forked worker
+    if cache is None or pid != os.getpid() or (cache.ttl, cache.grid) != (ttl, grid):
+        cache = SearchCache(ttl, grid)
+        current_app.extensions['search_cache'] = (cache, os.getpid())
+    cache.flush_stats(current_app.redis)
+    return cache
@@ -0,0 +1,225 @@
+"""Compiled serialization of the marshmallow schemas dumped on hot paths, such
+as the results of GET /taxis.
+
+marshmallow.Schema.dump() looks up the fields, their attribute and their
+default for each object it dumps. compile_schema() does it once per schema
+instance, and returns a function building the output dictionary directly from
+precomputed getters. The common field types (String, Integer, Float,
+Constant, List and Nested) are formatted inline; the others are still
+formatted by the field itself, so the output is always the same as
+marshmallow's, see tests/test_serializers.py.
+
+Schemas opt in with CompiledDumpMixin.
+
+The responses are encoded by orjson, see JSONProvider.
+"""
+
+from flask.json.provider import DefaultJSONProvider
+from marshmallow import fields, missing, Schema
+from marshmallow.decorators import POST_DUMP, PRE_DUMP
+import orjson
+
+
+def _get_value_for_key(obj, key):
+    """Same as marshmallow.utils._get_value_for_key()."""
+    if not hasattr(obj, '__getitem__'):
+        return getattr(obj, key, missing)
+    try:
+        return obj[key]
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return getattr(obj, key, missing)
+
+
+def _make_key_getter(key):
+    """Return a function reading `key` like _get_value_for_key(), without
+    raising KeyError for the keys missing from dictionaries."""
+    # Missing keys are read as attributes, dict.items() for "items"
+    if hasattr(dict, key):
+        return lambda obj: _get_value_for_key(obj, key)
+
+    def get(obj):
+        if obj.__class__ is dict:
+            return obj.get(key, missing)
+        return _get_value_for_key(obj, key)
+    return get
+
+
+def _make_getter(attribute):
+    """Return a function reading `attribute`, possibly a dotted path, like
+    marshmallow.utils.get_value()."""
+    if '.' not in attribute:
+        return _make_key_getter(attribute)
+
+    getters = [_make_key_getter(key) for key in attribute.split('.')]
+
+    def get(obj):
+        for get_key in getters:
+            obj = get_key(obj)
+            if obj is missing:
+                break
+        return obj
+    return get
+
+
+def _make_formatter(field_obj, attr_name):
+    """Return a function formatting a value read by the getter of
+    `field_obj`, like field_obj._serialize()."""
+    field_type = type(field_obj)
+
+    def generic(value, obj):
+        return field_obj._serialize(value, attr_name, obj)
+
+    if field_type is fields.String:
+        def format_string(value, obj):
+            if value is None or value.__class__ is str:
+                return value
+            return generic(value, obj)
+        return format_string
+
+    if field_type in (fields.Integer, fields.Float) and not field_obj.as_string:
+        num_type = field_obj.num_type
+
+        def format_number(value, obj):
+            if value is None or value.__class__ is num_type:
+                return value
+            return generic(value, obj)
+        return format_number
+
+    if field_type is fields.List:
+        format_inner = _make_formatter(field_obj.inner, attr_name)
+
+        def format_list(value, obj):
+            if value is None:
+                return None
+            return [format_inner(each, obj) for each in value]
+        return format_list
+
+    if field_type is fields.Nested and not field_obj.many:
+        def format_nested(value, obj):
+            # The nested schema is compiled when it is first dumped, as
+            # marshmallow only instantiates it when it is first used
+            nested = field_obj.schema
+            if value is None:
+                return None
+            # Unless the schema overrides dump() to add its own fields
+            if type(nested).dump in (Schema.dump, CompiledDumpMixin.dump):
+                dump = compile_schema(nested)
+                if dump is not None:
+                    return dump(value)
+            return generic(value, obj)
+        return format_nested
+
+    return generic
+
+
+def _compile_field(schema, attr_name, field_obj):
+    """Return a function returning the serialized value of the field for an
+    object, or marshmallow.missing if the field is not dumped, like
+    field_obj.serialize()."""
+    field_type = type(field_obj)
+
+    if field_type is fields.Constant:
+        constant = field_obj.constant
+        return lambda obj: constant
+
+    # Custom fields might override how the value is read or serialized
+    if (
+        not field_obj._CHECK_ATTRIBUTE
+        or type(field_obj).get_value is not fields.Field.get_value
+        or type(field_obj).serialize is not fields.Field.serialize
+    ):
+        return lambda obj: field_obj.serialize(attr_name, obj, accessor=schema.get_attribute)
+
+    get = _make_getter(attr_name if field_obj.attribute is None else field_obj.attribute)
+    format_value = _make_formatter(field_obj, attr_name)
+    dump_default = field_obj.dump_default
+
+    def serialize(obj):
+        value = get(obj)
+        if value is missing:
+            value = dump_default() if callable(dump_default) else dump_default
+            if value is missing:
+                return missing
+        return format_value(value, obj)
+    return serialize
+
+
+def compile_schema(schema):
+    """Return a function dumping an object like `schema`.dump(), without the
+    schema's own overrides of dump(). Return None if the schema can't be
+    compiled: its fields depend on the instance (only, exclude...) or it has
+    pre_dump or post_dump hooks."""
+    # Fields are bound to the schema instance, for example fields.Method
+    # calls a method of the instance
+    compiled = schema.__dict__.get('_compiled_dump', missing)
+    if compiled is not missing:
+        return compiled
+
+    if (
+        schema.only is not None or schema.exclude or schema.load_only
+        or schema.many
+        or schema._hooks[PRE_DUMP] or schema._hooks[POST_DUMP]
+        or type(schema).get_attribute is not Schema.get_attribute
+    ):
+        schema._compiled_dump = None
+        return None
+
+    dict_class = schema.dict_class
+    compiled_fields = [
+        (
+            field_obj.data_key if field_obj.data_key is not None else attr_name,
+            _compile_field(schema, attr_name, field_obj),
+        )
+        for attr_name, field_obj in schema.dump_fields.items()
+    ]
+
+    def dump(obj):
+        ret = dict_class()
+        for key, serialize in compiled_fields:
+            value = serialize(obj)
+            if value is not missing:
+                ret[key] = value
+        return ret
+
+    schema._compiled_dump = dump
+    return dump
+
+
+class CompiledDumpMixin:
+    """Dump the declared fields of the schema with compile_schema() instead
+    of the generic machinery of marshmallow. Schemas which override dump()
+    get the compiled result from super().dump()."""
+
+    # Set to False to use marshmallow, which is expected to return the same
+    compiled_dump = True
+
+    def dump(self, obj, *, many=None):
+        many = self.many if many is None else bool(many)
+        dump = compile_schema(self) if self.compiled_dump and not many else None
+        if dump is None:
+            return super().dump(obj, many=many)
+        return dump(obj)
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Encode the responses with orjson instead of the json module.
+
+    Dates are still formatted by DefaultJSONProvider.default(). Unlike the
+    json module, non-ASCII characters are not escaped but encoded in UTF-8.
+    Pretty-printed responses, and the objects orjson doesn't support (such as
+    integers larger than 64 bits) are encoded by DefaultJSONProvider.
+    """
+
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        try:
+            data = orjson.dumps(obj, default=self.default, option=options)
+        except TypeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(data + b'\n', mimetype=self.mimetype)
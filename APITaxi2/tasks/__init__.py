@@ -1,6 +1,7 @@
 from celery import shared_task
 
-from .clean import clean_geoindex_timestamps  # noqa
+from .clean import clean_geoindex_timestamps, expire_positions  # noqa
+from .hail_logs import archive_hail_logs  # noqa
 from .operators import handle_hail_timeout, send_request_operator  # noqa
 from .stats import store_active_taxis  # noqa
 from .. import clean_db
@@ -1,38 +1,111 @@
+import concurrent.futures
 import time
 
 from celery import shared_task
 from flask import current_app
 
+from .. import redis_backend
+
+
+# Locations older than this delay (in seconds) are removed from the geo indexes
+POSITION_MAX_AGE = 120
+
+# expire_positions removes this number of members per script call...
+EXPIRE_CHUNK_SIZE = 500
+# ... until there is nothing left to expire, or after this delay (in seconds).
+# The next run continues the work.
+EXPIRE_TIME_BUDGET = 1.0
+
+
+def _clean_geo_shard(client, max_time):
+    client.zremrangebyscore('timestamps', 0, max_time)
+    # Remove members of geoindex_2 not found in timestamps (just removed)
+    client.zinterstore('geoindex_2', {
+        'timestamps': 0,
+        'geoindex_2': 1
+    })
+    # Same for the geo indexes by INSEE code
+    for key in redis_backend.list_geoindex_insee_keys(client):
+        client.zinterstore(key, {
+            'timestamps': 0,
+            key: 1
+        })
+
+    client.zremrangebyscore('timestamps_id', 0, max_time)
+    # Remove members of geoindex not found in timestamps_id (just removed)
+    client.zinterstore('geoindex', {
+        'timestamps_id': 0,
+        'geoindex': 1
+    })
+
 
 @shared_task(name='clean_geoindex_timestamps')
 def clean_geoindex_timestamps():
     """Geotaxi stores locations in several Redis keys:
 
     - in the sorted sets "geoindex" and "timestamps_id", members are "taxi_id"
-    - in the sorted sets "geoindex_2" and "timestamps", members are "taxi_id:operator"
+    - in the sorted sets "geoindex_2", "geoindex_insee:<insee>" and "timestamps", members are "taxi_id:operator"
 
     A spatial index is a sorted set with the geohash as the score, so zremrangebyscore isn't an option.
     Instead we store location update time as a score in a separare "timestamps" sorted set,
     and every two minutes, we delete scores inferior to the threshold timestamp, and then we delete
     geoindex members not found in "timestamps" anymore.
 
-    This task removes data older than two minutes.
+    This task removes data older than two minutes. If the geo indexes are
+    sharded (see redis_backend.get_geo_shards), shards are cleaned in parallel.
+
+    As ZINTERSTORE rewrites the whole geo indexes, this task only runs once a
+    day to remove the members expire_positions is unable to find, for example
+    members left behind by an interrupted run. It can't remove the member of a
+    taxi from the index of its previous INSEE code while the taxi still
+    reports its location, as the member keeps a recent score in "timestamps":
+    update_taxi_positions removes it when the INSEE code changes.
 
     The taxi hash set (taxi:<taxi_id>) is not affected.
     """
-    max_time = int(time.time() - 120)
+    max_time = int(time.time() - POSITION_MAX_AGE)
     current_app.logger.info('Run task clean_geoindex_timestamps for data older than %s', max_time)
 
-    current_app.redis.zremrangebyscore('timestamps', 0, max_time)
-    # Remove members of geoindex_2 not found in timestamps (just removed)
-    current_app.redis.zinterstore('geoindex_2', {
-        'timestamps': 0,
-        'geoindex_2': 1
-    })
+    shards = redis_backend.get_geo_shards()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        # Iterate on results to raise exceptions
+        list(executor.map(_clean_geo_shard, shards, [max_time] * len(shards)))
+    return None
 
-    current_app.redis.zremrangebyscore('timestamps_id', 0, max_time)
-    # Remove members of geoindex not found in timestamps_id (just removed)
-    current_app.redis.zinterstore('geoindex', {
-        'timestamps_id': 0,
-        'geoindex': 1
-    })
+
+def _expire_geo_shard(app, shard, max_time, deadline):
+    removed = 0
+    with app.app_context():
+        while time.monotonic() < deadline:
+            chunk_removed = redis_backend.expire_positions(shard, max_time, EXPIRE_CHUNK_SIZE)
+            if not chunk_removed:
+                break
+            removed += chunk_removed
+    return removed
+
+
+@shared_task(name='expire_positions')
+def expire_positions():
+    """Remove locations older than two minutes from the geo indexes, a few
+    members at a time, within a time budget of EXPIRE_TIME_BUDGET seconds.
+
+    This task runs every few seconds, so expired taxis never inflate the
+    results of GEORADIUS for long.
+    """
+    start = time.monotonic()
+    max_time = int(time.time() - POSITION_MAX_AGE)
+    app = current_app._get_current_object()
+
+    shards = redis_backend.get_geo_shards()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        removed = sum(executor.map(
+            _expire_geo_shard,
+            [app] * len(shards),
+            shards,
+            [max_time] * len(shards),
+            [start + EXPIRE_TIME_BUDGET] * len(shards),
+        ))
+
+    duration = time.monotonic() - start
+    current_app.logger.info('Task expire_positions removed %s members in %.3f seconds', removed, duration)
+    return {'removed': removed, 'duration': duration}
@@ -0,0 +1,54 @@
+"""Archive the stream hail_log in PostgreSQL."""
+
+import json
+import time
+
+from celery import shared_task
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert
+
+from APITaxi_models2 import db, HailLog
+
+from .. import redis_backend
+
+
+# archive_hail_logs inserts this number of entries per transaction...
+ARCHIVE_BATCH_SIZE = 1000
+# ... until the stream is archived, or after this delay (in seconds). The next
+# run continues the work.
+ARCHIVE_TIME_BUDGET = 30.0
+
+ARCHIVER_CONSUMER = 'archive_hail_logs'
+
+
+@shared_task(name='archive_hail_logs')
+def archive_hail_logs():
+    """Move the entries of the stream hail_log to the table hail_log, by
+    batch.
+
+    Entries are only acknowledged once committed. If the task fails in
+    between, the entries are delivered again to the next run and inserted
+    once, as the stream ID is the primary key.
+    """
+    start = time.monotonic()
+    archived = 0
+
+    while time.monotonic() - start < ARCHIVE_TIME_BUDGET:
+        entries = redis_backend.read_hail_logs(ARCHIVER_CONSUMER, ARCHIVE_BATCH_SIZE)
+        if not entries:
+            break
+        db.session.execute(
+            insert(HailLog).values([{
+                'id': entry.id,
+                'time': entry.time,
+                'hail_id': entry.hail_id,
+                'data': json.loads(entry.data),
+            } for entry in entries]).on_conflict_do_nothing()
+        )
+        db.session.commit()
+        redis_backend.ack_hail_logs(entries)
+        archived += len(entries)
+
+    duration = time.monotonic() - start
+    current_app.logger.info('Task archive_hail_logs archived %s entries in %.3f seconds', archived, duration)
+    return {'archived': archived, 'duration': duration}
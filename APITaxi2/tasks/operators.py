@@ -24,7 +24,8 @@ def handle_hail_timeout(hail_id, operateur_id,
     res = db.session.query(
         Hail, VehicleDescription
     ).options(
-        joinedload(Hail.taxi)
+        joinedload(Hail.taxi),
+        joinedload(Hail.operateur)
     ).filter(
         Hail.taxi_id == Taxi.id,
         Taxi.vehicle_id == Vehicle.id,
@@ -67,8 +68,13 @@ def handle_hail_timeout(hail_id, operateur_id,
             task='handle_hail_timeout',
         )
 
+    taxi_id, operator_email = hail.taxi_id, hail.operateur.email
     db.session.commit()
 
+    # The search trusts the metadata in redis, only write it once committed
+    if new_taxi_status:
+        redis_backend.update_taxi_search_metadata(taxi_id, operator_email, status=new_taxi_status)
+
 
 @shared_task(name='send_request_operator')
 def send_request_operator(hail_id, endpoint, operator_header_name, operator_api_key):
@@ -101,6 +107,8 @@ def send_request_operator(hail_id, endpoint, operator_header_name, operator_api_
         return False
 
     hail, vehicle_description = res
+    # Read before the commits expire the objects
+    taxi_id, operator_email = hail.taxi_id, hail.operateur.email
 
     if hail.status != 'received':
         current_app.logger.warning('Task send_request_operator called for hail %s, but status is %s. Ignore.',
@@ -126,6 +134,7 @@ def send_request_operator(hail_id, endpoint, operator_header_name, operator_api_
             task='send_request_operator',
         )
         db.session.commit()
+        redis_backend.update_taxi_search_metadata(taxi_id, operator_email, status=new_taxi_status)
         return False
 
     schema = schemas.DataHailSchema()
@@ -152,7 +161,7 @@ def send_request_operator(hail_id, endpoint, operator_header_name, operator_api_
         redis_backend.log_hail(
             hail_id=hail.id,
             http_method='POST to operator',
-            request_payload=json.dumps(payload, indent=2),
+            request_payload=payload,
             hail_initial_status=hail.status,
             hail_final_status='failure',
             request_user=None,
@@ -170,18 +179,19 @@ def send_request_operator(hail_id, endpoint, operator_header_name, operator_api_
             task='send_request_operator',
         )
         db.session.commit()
+        redis_backend.update_taxi_search_metadata(taxi_id, operator_email, status=new_taxi_status)
         return False
 
     # Operator's API should return a JSON response. If it doesn't, log an
     # error, set hail as failure and abort.
     try:
-        response_payload = json.dumps(resp.json(), indent=2)
+        response_payload = resp.json()
     except json.decoder.JSONDecodeError as exc:
         current_app.logger.warning('Operator API of %s did not return a JSON response' % hail.operateur.email)
         redis_backend.log_hail(
             hail_id=hail.id,
             http_method='POST to operator',
-            request_payload=json.dumps(payload, indent=2),
+            request_payload=payload,
             hail_initial_status=hail.status,
             hail_final_status='failure',
             request_user=None,
@@ -199,6 +209,7 @@ def send_request_operator(hail_id, endpoint, operator_header_name, operator_api_
             task='send_request_operator',
         )
         db.session.commit()
+        redis_backend.update_taxi_search_metadata(taxi_id, operator_email, status=new_taxi_status)
         return False
 
     # If the operator's API isn't successful, log the response, set hail as
@@ -210,7 +221,7 @@ def send_request_operator(hail_id, endpoint, operator_header_name, operator_api_
         redis_backend.log_hail(
             hail_id=hail.id,
             http_method='POST to operator',
-            request_payload=json.dumps(payload, indent=2),
+            request_payload=payload,
             hail_initial_status=hail.status,
             hail_final_status='failure',
             request_user=None,
@@ -228,6 +239,7 @@ def send_request_operator(hail_id, endpoint, operator_header_name, operator_api_
             task='send_request_operator',
         )
         db.session.commit()
+        redis_backend.update_taxi_search_metadata(taxi_id, operator_email, status=new_taxi_status)
         return False
 
     # Log this successful request
@@ -235,7 +247,7 @@ def send_request_operator(hail_id, endpoint, operator_header_name, operator_api_
     redis_backend.log_hail(
         hail_id=hail.id,
         http_method='POST to operator',
-        request_payload=json.dumps(payload, indent=2),
+        request_payload=payload,
         hail_initial_status=hail.status,
         hail_final_status='received_by_operator',
         request_user=None,
@@ -131,10 +131,10 @@ def store_active_taxis(last_update):
         end_time, datetime.fromtimestamp(end_time)
     )
 
-    # The asynchronous task clean_geoindex_timestamps removes entries from the
+    # The asynchronous task expire_positions removes entries from the
     # ZSET "timestamps" that are older than 2 minutes.
-    # To generate the statistics for data older than 2 minutes, use the slow
-    # path with list_taxis().
+    # To generate the statistics for data older than 2 minutes, use the zset
+    # "last_seen" with list_taxis().
     if last_update <= 2:
         updates = redis_backend.get_timestamps_entries_between(start_time, end_time)
     else:
@@ -13,17 +13,19 @@ from APITaxi_models2.unittest.factories import (
     UserFactory
 )
 
-# We have to import postgresql, postgresql_empty and redis_server even if they
-# are unused because otherwise they cannot be used as dependencies by fixtures
-# below.
+# We have to import postgresql, postgresql_empty, redis_server and
+# redis_shard_servers even if they are unused because otherwise they cannot be
+# used as dependencies by fixtures below.
 from APITaxi_models2.unittest.conftest import (
     postgresql,
     postgresql_empty,
     redis_server,
+    redis_shard_servers,
     SQLAlchemyQueriesTracker,
 )
 
 import APITaxi2
+from APITaxi2 import redis_backend
 
 
 @pytest.fixture
@@ -38,6 +40,7 @@ DEBUG = True
 TESTING = True
 CONSOLE_URL = 'http://console'
 NEUTRAL_OPERATOR = True
+LOCATION_STORE_SYNC = True
 ''' % {
         'database': postgresql.sqlalchemy_url(),
         'redis': 'unix://%s' % redis_server,
@@ -90,6 +93,19 @@ def no_roles(app):
     return _create_client(app, [])
 
 
+@pytest.fixture
+def geo_shards(app, redis_shard_servers):
+    """Shard the geo indexes on two other redis servers. Yield the redis
+    clients of the shards."""
+    app.config['REDIS_GEO_SHARDS'] = ['unix://%s' % socket_file for socket_file in redis_shard_servers]
+    shards = redis_backend.get_geo_shards()
+
+    yield shards
+
+    for shard in shards:
+        shard.flushall()
+
+
 @pytest.fixture
 def anonymous(app):
     return _create_client(app, None)
@@ -28,6 +28,9 @@ class TestBlurGeoTaxi:
             '%s 48.86 2.35 free phone 2' % int(below_two_months.timestamp())
         )
 
+        # Index the locations above
+        redis_backend.backfill_last_seen()
+
         assert clean_db.blur_geotaxi() == 1
 
         taxi1 = redis_backend.get_taxi('taxi1', 'taxis_bleus')
@@ -35,6 +38,23 @@ class TestBlurGeoTaxi:
         taxi2 = redis_backend.get_taxi('taxi2', 'taxis_verts')
         assert (taxi2.lon, taxi2.lat) == (2.35, 48.86)
 
+    def test_buckets(self, app):
+        over_two_months = datetime.datetime.now() - datetime.timedelta(days=60)
+        app.redis.hset(
+            'taxi:taxi1',
+            "taxis_bleus",
+            '%s 48.86 2.35 free phone 2' % int(over_two_months.timestamp())
+        )
+        redis_backend.backfill_last_seen()
+
+        # Not moved to the buckets yet
+        app.config['GEOTAXI_BUCKETS'] = 16
+        assert clean_db.blur_geotaxi() == 1
+
+        taxi1 = redis_backend.get_taxi('taxi1', 'taxis_bleus')
+        assert (taxi1.lon, taxi1.lat) == (0.0, 0.0)
+        assert not app.redis.hexists('taxi:taxi1', 'taxis_bleus')
+
 
 class TestBlurHails:
     def test_ok(self, app):
@@ -165,6 +185,9 @@ class TestDeleteOldTaxis:
             '%s 48.86 2.35 free phone 2' % int(over_a_year.timestamp())
         )
 
+        # Index the locations above
+        redis_backend.backfill_last_seen()
+
         # old_not_in_redis and old_orphan_taxi deleted
         assert clean_db.delete_old_taxis() == 2
 
@@ -0,0 +1,44 @@
+import pytest
+
+from APITaxi2 import exclusions
+from APITaxi2.exclusions import ExclusionHelper
+from APITaxi_models2.unittest.factories import ExclusionFactory
+
+
+@pytest.fixture
+def helper(app):
+    ExclusionFactory()
+    # Triangle, its bounding box is a square
+    ExclusionFactory(
+        id='way/1',
+        name='Triangle',
+        shape='MULTIPOLYGON(((2.3 48.8,2.4 48.8,2.3 48.9,2.3 48.8)))',
+    )
+    helper = ExclusionHelper()
+    helper.reset()
+    yield helper
+    # Don't leak the zones to other tests
+    exclusions._load_exclusion_tree.cache_clear()
+
+
+class TestExclusionHelper:
+    POINTS = [
+        # EuroAirport Bâle-Mulhouse-Fribourg
+        ((7.52637979704597, 47.5973205076925), True),
+        # Within the triangle
+        ((2.32, 48.82), True),
+        # Within the bounding box of the triangle, not the triangle itself
+        ((2.38, 48.88), False),
+        ((2.35, 47.86), False),
+        ((0.0, 0.0), False),
+    ]
+
+    def test_is_at_excluded_zone(self, helper):
+        for (lon, lat), expected in self.POINTS:
+            assert bool(helper.is_at_excluded_zone(lon, lat)) is expected, (lon, lat)
+
+    def test_are_at_excluded_zones(self, helper):
+        lons = [lon for (lon, _), _ in self.POINTS]
+        lats = [lat for (_, lat), _ in self.POINTS]
+        assert helper.are_at_excluded_zones(lons, lats).tolist() == [expected for _, expected in self.POINTS]
+        assert helper.are_at_excluded_zones([], []).tolist() == []
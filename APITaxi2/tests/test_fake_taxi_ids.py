@@ -0,0 +1,28 @@
+from unittest import mock
+
+from APITaxi2 import fake_taxi_ids
+
+
+def test_encode_decode(app, moteur, operateur):
+    fake_taxi_id = fake_taxi_ids.encode(moteur.user, 'taxi_id')
+    assert 'taxi_id' not in fake_taxi_id
+    assert fake_taxi_ids.decode(moteur.user, fake_taxi_id) == 'taxi_id'
+    # A new ID for each search
+    assert fake_taxi_ids.encode(moteur.user, 'taxi_id') != fake_taxi_id
+
+    # Can only be decoded for the user it was issued to
+    assert fake_taxi_ids.decode(operateur.user, fake_taxi_id) is None
+
+    # Tampered
+    tampered = fake_taxi_id[:-2] + ('AA' if fake_taxi_id[-2:] != 'AA' else 'BB')
+    assert fake_taxi_ids.decode(moteur.user, tampered) is None
+
+    # Real taxi IDs, or fake IDs issued before they were signed
+    assert fake_taxi_ids.decode(moteur.user, 'taxi_id') is None
+    assert fake_taxi_ids.decode(moteur.user, 'abc!') is None
+
+
+def test_expired(app, moteur):
+    fake_taxi_id = fake_taxi_ids.encode(moteur.user, 'taxi_id')
+    with mock.patch('time.time', return_value=fake_taxi_ids.time.time() + fake_taxi_ids.FAKE_TAXI_ID_TTL + 120):
+        assert fake_taxi_ids.decode(moteur.user, fake_taxi_id) is None
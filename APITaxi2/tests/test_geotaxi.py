@@ -1,3 +1,5 @@
+import json
+
 from APITaxi_models2.unittest import factories
 
 from APITaxi2 import redis_backend
@@ -36,10 +38,14 @@ class TestPostPositions:
                 }]
             })
             assert response.status_code == 200
-            # SELECT permissions, SELECT taxi (writing is done in Redis)
-            assert qtracker.count == 2
+            # SELECT permissions, SELECT taxi, SELECT INSEE code of the ADS
+            # (writing is done in Redis)
+            assert qtracker.count == 3
 
-        # There should be five keys stored (after the IP index was dropped)
+        # There should be five keys stored (after the IP index was dropped),
+        # plus last_seen, the geo index by INSEE code and the INSEE code of
+        # its members, and the caches of taxis owned by the operator and of
+        # INSEE codes
         taxi_key = taxi.id.encode()
         operator_key = operateur.user.email.encode()
         taxi_operator_key = b'%s:%s' % (taxi_key, operator_key)
@@ -49,6 +55,11 @@ class TestPostPositions:
             b'geoindex_2',
             b'timestamps',
             b'timestamps_id',
+            b'last_seen',
+            b'operator_taxis:%s' % operator_key,
+            b'taxi_insee',
+            b'geoindex_insee:%s' % taxi.ads.insee.encode(),
+            b'geoindex_insee_members',
         }
 
         assert operator_key in app.redis.hgetall(b'taxi:%s' % taxi_key)
@@ -56,6 +67,7 @@ class TestPostPositions:
         assert app.redis.geohash(b'geoindex_2', taxi_operator_key) == ['u09tvqxnnu0']
         assert app.redis.zrange(b'timestamps', 0, -1) == [taxi_operator_key]
         assert app.redis.zrange(b'timestamps_id', 0, -1) == [taxi_key]
+        assert app.redis.zrange(b'geoindex_insee:%s' % taxi.ads.insee.encode(), 0, -1) == [taxi_operator_key]
 
         # High-level API
         redis_taxi = redis_backend.get_taxi(taxi.id, operateur.user.email)
@@ -159,5 +171,89 @@ class TestPostPositions:
                 }]
             })
             assert response.status_code == 200
-            # SELECT permissions, SELECT taxi (writing is done in Redis)
-            assert qtracker.count == 2
+            # SELECT permissions, SELECT taxi, SELECT INSEE code of the ADS
+            # (writing is done in Redis)
+            assert qtracker.count == 3
+
+    def test_owned_taxis_cache(self, app, operateur, QueriesTracker):
+        taxi = factories.TaxiFactory(added_by=operateur.user)
+        payload = {
+            'data': [{
+                'positions': [{'taxi_id': taxi.id, 'lon': 2.35, 'lat': 48.86}]
+            }]
+        }
+        response = operateur.client.post('/geotaxi', json=payload)
+        assert response.status_code == 200
+        assert app.redis.smembers('operator_taxis:%s' % operateur.user.email) == {taxi.id.encode()}
+
+        # The taxis of the operator are cached
+        with QueriesTracker() as qtracker:
+            response = operateur.client.post('/geotaxi', json=payload)
+            assert response.status_code == 200
+            # SELECT permissions
+            assert qtracker.count == 1
+
+        # The cache is outdated, the new taxi is confirmed by the database
+        new_taxi = factories.TaxiFactory(added_by=operateur.user)
+        response = operateur.client.post('/geotaxi', json={
+            'data': [{
+                'positions': [{'taxi_id': new_taxi.id, 'lon': 2.35, 'lat': 48.86}]
+            }]
+        })
+        assert response.status_code == 200
+        assert app.redis.smembers('operator_taxis:%s' % operateur.user.email) == {
+            taxi.id.encode(), new_taxi.id.encode()
+        }
+
+
+class TestPostBulkPositions:
+    def test_invalid(self, anonymous, operateur, moteur):
+        response = anonymous.client.post('/geotaxi/bulk', data='', content_type='application/x-ndjson')
+        assert response.status_code == 401
+
+        response = moteur.client.post('/geotaxi/bulk', data='', content_type='application/x-ndjson')
+        assert response.status_code == 403
+
+        response = operateur.client.post('/geotaxi/bulk', json={'data': []})
+        assert response.status_code == 400
+
+    def test_ok(self, operateur):
+        taxis = factories.TaxiFactory.create_batch(3, added_by=operateur.user)
+        other_taxi = factories.TaxiFactory()
+        lines = [
+            json.dumps({'taxi_id': taxis[0].id, 'lon': 2.35, 'lat': 48.86}),
+            '',
+            json.dumps({'taxi_id': taxis[1].id, 'lon': 612.35, 'lat': 48.86}),
+            '{not json',
+            json.dumps({'taxi_id': other_taxi.id, 'lon': 2.35, 'lat': 48.86}),
+            json.dumps({'taxi_id': taxis[2].id, 'lon': 2.36, 'lat': 48.87}),
+        ]
+        response = operateur.client.post(
+            '/geotaxi/bulk', data='\n'.join(lines), content_type='application/x-ndjson'
+        )
+        assert response.status_code == 200
+        result = response.json['data'][0]
+        assert result['received'] == 5
+        assert result['stored'] == 2
+        assert list(result['errors']['3']) == ['lon']
+        assert result['errors']['4'] == {'': ['Not valid JSON.']}
+        assert result['errors']['5'] == {'taxi_id': ['Identifiant de taxi inconnu']}
+
+        # Valid positions are stored despite the errors
+        redis_taxi = redis_backend.get_taxi(taxis[2].id, operateur.user.email)
+        assert redis_taxi.lon == 2.36 and redis_taxi.lat == 48.87
+        assert redis_backend.get_taxi(taxis[1].id, operateur.user.email) is None
+        assert redis_backend.get_taxi(other_taxi.id, operateur.user.email) is None
+
+    def test_too_many(self, app, operateur):
+        app.config['GEOTAXI_BULK_MAX_POSITIONS'] = 2
+        taxi = factories.TaxiFactory(added_by=operateur.user)
+        line = json.dumps({'taxi_id': taxi.id, 'lon': 2.35, 'lat': 48.86})
+        response = operateur.client.post(
+            '/geotaxi/bulk', data='\n'.join([line] * 3), content_type='application/x-ndjson'
+        )
+        assert response.status_code == 200
+        result = response.json['data'][0]
+        assert result['received'] == 2
+        assert result['stored'] == 2
+        assert list(result['errors']) == ['3']
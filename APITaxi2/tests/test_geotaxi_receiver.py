@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+from APITaxi_models2.unittest import factories
+
+from APITaxi2 import geotaxi_receiver, redis_backend
+
+
+def _message(operator, taxi_id, lon=2.35, lat=48.86, apikey=None):
+    message = {
+        'timestamp': 1430076493,
+        'operator': operator.email,
+        'taxi': taxi_id,
+        'lat': lat,
+        'lon': lon,
+        'device': 'phone',
+        'status': 'free',
+        'version': '2',
+    }
+    message['hash'] = geotaxi_receiver.compute_hash(message, apikey or operator.apikey)
+    return json.dumps(message).encode('utf8')
+
+
+def test_load_operators(app, operateur, moteur):
+    operators = geotaxi_receiver.load_operators()
+    assert list(operators) == [operateur.user.email]
+    assert operators[operateur.user.email].apikey == operateur.user.apikey
+
+
+def test_receiver(app, operateur):
+    taxi = factories.TaxiFactory(added_by=operateur.user)
+    other_taxi = factories.TaxiFactory()
+
+    receiver = geotaxi_receiver.GeotaxiReceiver(app, load_operators_func=geotaxi_receiver.load_operators)
+
+    async def run():
+        await receiver.refresh_operators()
+        receiver.handle_datagram(b'not json')
+        receiver.handle_datagram(_message(operateur.user, taxi.id, apikey='invalid'))
+        receiver.handle_datagram(_message(operateur.user, taxi.id, lon=612.35))
+        receiver.handle_datagram(_message(operateur.user, other_taxi.id))
+        receiver.handle_datagram(_message(operateur.user, taxi.id, lon=2.34))
+        # Only the last position of a taxi is stored
+        receiver.handle_datagram(_message(operateur.user, taxi.id))
+        await receiver.drain()
+
+    asyncio.run(run())
+
+    assert receiver.stats == {
+        'received': 6,
+        'invalid': 2,
+        'unauthorized': 1,
+        'unknown_taxi': 1,
+        'stored': 1,
+    }
+    redis_taxi = redis_backend.get_taxi(taxi.id, operateur.user.email)
+    assert (redis_taxi.lon, redis_taxi.lat) == (2.35, 48.86)
+    assert redis_backend.get_taxi(other_taxi.id, operateur.user.email) is None
@@ -7,7 +7,7 @@ import uuid
 import requests
 import sqlalchemy
 
-from APITaxi2 import tasks, utils
+from APITaxi2 import fake_taxi_ids, redis_backend, tasks, utils
 from APITaxi_models2 import Hail, Taxi, Vehicle, VehicleDescription
 from APITaxi_models2.unittest.factories import (
     CustomerFactory,
@@ -180,7 +180,7 @@ class TestEditHail:
         assert resp.json['data'][0]['taxi_phone_number'] == '0600000000'  # Obsfucated
 
         # Make sure request is logged
-        assert len(app.redis.zrange('hail:%s' % hail.id, 0, -1)) == 1
+        assert len(redis_backend.list_hail_logs(hail.id)) == 1
 
         # Check transition log
         hail = Hail.query.filter(Hail.id == hail.id).one()
@@ -221,7 +221,7 @@ class TestEditHail:
         ).one().status == 'oncoming'
 
         # Make sure request is logged
-        assert len(app.redis.zrange('hail:%s' % hail.id, 0, -1)) == 1
+        assert len(redis_backend.list_hail_logs(hail.id)) == 1
 
         # Check transition log
         hail = Hail.query.filter(Hail.id == hail.id).one()
@@ -572,17 +572,22 @@ class TestGetHailList:
 class TestCreateHail:
 
     @staticmethod
-    def _create_hail(app, operateur, moteur, customer_id='some user', session_id=None, customer_address='23 avenue de Ségur, 75007 Paris'):
+    def _create_hail(app, operateur, moteur, customer_id='some user', session_id=None, customer_address='23 avenue de Ségur, 75007 Paris',
+                     legacy_fake_taxi_id=False):
         taxi = TaxiFactory(added_by=operateur.user)
         taxi_id = taxi.id
 
         # Simulate search before hailing
         if app.config.get('FAKE_TAXI_ID'):
-            taxi_id = utils.get_short_uuid()
-            app.redis.hset(
-                f'fake_taxi_id:{moteur.user.email}',
-                mapping={taxi_id: taxi.id}
-            )
+            if legacy_fake_taxi_id:
+                # Mapping stored in redis before fake IDs were signed
+                taxi_id = utils.get_short_uuid()
+                app.redis.hset(
+                    f'fake_taxi_id:{moteur.user.email}',
+                    mapping={taxi_id: taxi.id}
+                )
+            else:
+                taxi_id = fake_taxi_ids.encode(moteur.user, taxi.id)
 
         # Report recent location in redis
         app.redis.hset(
@@ -691,7 +696,7 @@ class TestCreateHail:
 
         # Hail is logged to redis
         hail_id = resp.json['data'][0]['id']
-        assert len(app.redis.zrange('hail:%s' % hail_id, 0, -1)) == 1
+        assert len(redis_backend.list_hail_logs(hail_id)) == 1
 
         # Check transition log
         hail = Hail.query.one()
@@ -700,6 +705,32 @@ class TestCreateHail:
         assert hail.transition_log[-1]['to_status'] == 'received'
         assert hail.transition_log[-1]['user'] == moteur.user.id
 
+    def test_coalesced_position(self, app, moteur, operateur):
+        app.config['GEOTAXI_MOVE_THRESHOLD'] = 20
+        taxi = TaxiFactory(added_by=operateur.user)
+
+        # The taxi stopped reporting its position 40 seconds ago, after
+        # positions coalesced for 60 seconds: the hash is older than the
+        # last position received.
+        now = int(time.time())
+        app.redis.hset('taxi:%s' % taxi.id, operateur.user.email, '%s 48.84 2.35 free phone 2' % (now - 100))
+        app.redis.zadd('last_seen', {'%s:%s' % (taxi.id, operateur.user.email): now - 40})
+
+        with mock.patch.object(tasks.send_request_operator, 'apply_async'):
+            resp = moteur.client.post('/hails', json={
+                'data': [{
+                    'customer_address': '23 avenue de Ségur, 75007 Paris',
+                    'customer_id': 'customer_ok',
+                    'customer_lon': 2.3098,
+                    'customer_lat': 48.851,
+                    'customer_phone_number': '+336868686',
+                    'taxi_id': taxi.id,
+                    'operateur': 'chauffeur professionnel',
+                }]
+            })
+        assert resp.status_code == 201
+        assert resp.json['data'][0]['taxi']['last_update'] == now - 40
+
     def test_automatic_session_id(self, app, moteur, operateur):
         hail = HailFactory(
             operateur=operateur.user, added_by=moteur.user,
@@ -792,6 +823,14 @@ class TestCreateHail:
         assert resp.json['data'][0]['taxi']['id'] != hail.taxi_id
         assert resp.json['data'][0]['taxi']['id'] == hail.fake_taxi_id
 
+    def test_fake_taxi_id_legacy(self, app, moteur, operateur):
+        app.config['FAKE_TAXI_ID'] = True
+        resp = self._create_hail(app, operateur, moteur, legacy_fake_taxi_id=True)
+        assert resp.status_code == 201
+        hail = Hail.query.one()
+        assert resp.json['data'][0]['taxi']['id'] == hail.fake_taxi_id
+        assert hail.fake_taxi_id != hail.taxi_id
+
     def test_fake_taxi_id_moteur_and_operateur(self, app, moteur_and_operateur):
         app.config['FAKE_TAXI_ID'] = True
         resp = self._create_hail(app, moteur_and_operateur, moteur_and_operateur)
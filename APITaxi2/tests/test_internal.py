@@ -1,3 +1,8 @@
+import pytest
+
+from APITaxi2 import redis_backend, redis_clients, search_cache
+
+
 class TestInternalAuth:
     def test_invalid(self, anonymous, moteur):
         resp = anonymous.client.post('/internal/auth', json={'data': [{}]})
@@ -50,3 +55,73 @@ class TestInternalAuth:
             'apikey': moteur.user.apikey,
         }]})
         assert resp.status_code == 200
+
+
+class TestRedisPools:
+    def test_ok(self, app, admin, moteur):
+        resp = moteur.client.get('/internal/redis/pools')
+        assert resp.status_code == 403
+
+        # Not configured: the default client is used
+        resp = admin.client.get('/internal/redis/pools')
+        assert resp.status_code == 200
+        assert resp.json['data'] == []
+        assert redis_clients.get('geo_read') is app.redis
+
+        app.config['REDIS_GEO_READ_MAX_CONNECTIONS'] = 2
+        redis_clients.init_app(app)
+        assert redis_clients.get('geo_read') is not app.redis
+        assert redis_clients.get('geo_write') is app.redis
+
+        # The search reads the geo indexes with geo_read
+        redis_backend.taxis_locations_by_operator(2.35, 48.86, 500)
+
+        resp = admin.client.get('/internal/redis/pools')
+        assert resp.status_code == 200
+        assert len(resp.json['data']) == 1
+        stats = resp.json['data'][0]
+        assert stats['name'] == 'geo_read'
+        assert stats['max_connections'] == 2
+        assert stats['acquired'] >= 1
+        assert stats['in_use'] == 0
+
+    def test_geo_write_url(self, app):
+        # Positions written by geo_write are read with the default client
+        app.config['REDIS_GEO_WRITE_URL'] = 'redis://replica:6379/0'
+        with pytest.raises(ValueError):
+            redis_clients.init_app(app)
+
+        app.config['REDIS_GEO_WRITE_URL'] = app.config['REDIS_URL']
+        redis_clients.init_app(app)
+        assert redis_clients.get('geo_write') is not app.redis
+
+
+class TestSearchCache:
+    def test_ok(self, app, admin, moteur):
+        resp = moteur.client.get('/internal/search_cache')
+        assert resp.status_code == 403
+
+        # Disabled
+        resp = admin.client.get('/internal/search_cache')
+        assert resp.status_code == 200
+        assert resp.json['data'] == []
+
+        app.config['SEARCH_CACHE_TTL'] = 2
+        cache = search_cache.get_search_cache()
+        cache.get('key')
+        resp = admin.client.get('/internal/search_cache')
+        assert resp.status_code == 200
+        assert resp.json['data'] == [{
+            'ttl': 2,
+            'grid': search_cache.DEFAULT_GRID,
+            'entries': 0,
+            'hits': 0,
+            'misses': 1,
+            'hit_ratio': 0.0,
+            'all_processes': {
+                'minutes': 5,
+                'hits': 0,
+                'misses': 1,
+                'hit_ratio': 0.0,
+            },
+        }]
@@ -0,0 +1,162 @@
+import random
+import time
+
+import pytest
+
+from APITaxi2 import location_store, redis_backend
+
+
+@pytest.fixture(params=['redis', 'memory'])
+def store_name(app, request):
+    app.config['LOCATION_STORE'] = request.param
+    return request.param
+
+
+def _search(*args, **kwargs):
+    # The in-memory store reads the stream of positions when it is returned
+    # with the setting LOCATION_STORE_SYNC, get it again after positions are
+    # written.
+    return location_store.get_location_store().search(*args, **kwargs)
+
+
+class TestLocationStore:
+    """Both implementations must pass these tests."""
+
+    def test_search(self, store_name):
+        now = int(time.time())
+        redis_backend.update_taxi_positions([
+            {'taxi_id': 'taxi1', 'lon': 2.35000, 'lat': 48.86000},
+            {'taxi_id': 'taxi2', 'lon': 2.35002, 'lat': 48.86002},
+            # Outside of range
+            {'taxi_id': 'taxi3', 'lon': 2.3, 'lat': 47},
+        ], 'operator1')
+        redis_backend.update_taxi_positions([
+            {'taxi_id': 'taxi1', 'lon': 2.35001, 'lat': 48.86001},
+        ], 'operator2')
+
+        res = _search(2.35, 48.86, 500)
+        assert set(res) == {'taxi1', 'taxi2'}
+        assert set(res['taxi1']) == {'operator1', 'operator2'}
+        assert res['taxi1']['operator1'].distance < res['taxi1']['operator2'].distance < res['taxi2']['operator1'].distance
+        assert res['taxi2']['operator1'].lon == pytest.approx(2.35002, abs=1e-5)
+        assert res['taxi2']['operator1'].lat == pytest.approx(48.86002, abs=1e-5)
+        assert res['taxi2']['operator1'].distance == pytest.approx(2.66, abs=1)
+        assert abs(res['taxi2']['operator1'].update_date.timestamp() - now) <= 1
+
+        assert _search(2.35, 48.86, 500, count=10) == res
+        assert not location_store.get_location_store().is_truncated(res, 10)
+
+        # Closest locations only
+        res = _search(2.35, 48.86, 500, count=2)
+        assert {taxi_id: set(operators) for taxi_id, operators in res.items()} == {'taxi1': {'operator1', 'operator2'}}
+        assert location_store.get_location_store().is_truncated(res, 2)
+
+    def test_insee_codes(self, store_name):
+        redis_backend.update_taxi_positions([
+            {'taxi_id': 'taxi1', 'lon': 2.35, 'lat': 48.86},
+            {'taxi_id': 'taxi2', 'lon': 2.351, 'lat': 48.861},
+            # INSEE code unknown
+            {'taxi_id': 'taxi3', 'lon': 2.352, 'lat': 48.862},
+        ], 'operator', taxis_insee={'taxi1': '75056', 'taxi2': '92012'})
+
+        assert set(_search(2.35, 48.86, 1000)) == {'taxi1', 'taxi2', 'taxi3'}
+        assert set(_search(2.35, 48.86, 1000, insee_codes={'75056'})) == {'taxi1'}
+        assert set(_search(2.35, 48.86, 1000, insee_codes={'75056', '92012'})) == {'taxi1', 'taxi2'}
+        assert _search(2.35, 48.86, 1000, insee_codes={'93001'}) == {}
+
+    def test_move(self, store_name):
+        redis_backend.update_taxi_positions([{'taxi_id': 'taxi1', 'lon': 2.35, 'lat': 48.86}], 'operator')
+        assert set(_search(2.35, 48.86, 500)) == {'taxi1'}
+
+        # Several kilometers away, in another cell of the in-memory index
+        redis_backend.update_taxi_positions([{'taxi_id': 'taxi1', 'lon': 2.40, 'lat': 48.90}], 'operator')
+        assert _search(2.35, 48.86, 500) == {}
+        assert set(_search(2.40, 48.90, 500)) == {'taxi1'}
+
+    def test_random(self, app, store_name):
+        """Compare the results with the geo indexes of redis, which are always
+        written."""
+        rand = random.Random(42)
+        for operator in ('operator1', 'operator2'):
+            redis_backend.update_taxi_positions([
+                {'taxi_id': f'taxi{i}', 'lon': rand.uniform(2.2, 2.5), 'lat': rand.uniform(48.8, 48.9)}
+                for i in range(500)
+            ], operator)
+
+        expected_store = location_store.RedisLocationStore()
+        for _ in range(20):
+            lon, lat, distance = rand.uniform(2.2, 2.5), rand.uniform(48.8, 48.9), rand.choice((500, 1000, 3000))
+            expected = expected_store.search(lon, lat, distance)
+            res = _search(lon, lat, distance)
+
+            # Redis stores coordinates as geohashes, with an error below one
+            # meter: ignore locations at the edge of the radius.
+            def members(locations):
+                return {
+                    (taxi_id, operator)
+                    for taxi_id, operators in locations.items()
+                    for operator, location in operators.items()
+                    if location.distance < distance - 1
+                }
+            assert members(res) == members(expected)
+            for taxi_id, operator in members(res):
+                assert res[taxi_id][operator].distance == pytest.approx(expected[taxi_id][operator].distance, abs=1)
+
+
+class TestMemoryLocationStore:
+    def test_load(self, app):
+        """Positions written before the store is created are loaded from the
+        geo indexes of redis."""
+        redis_backend.update_taxi_positions([
+            {'taxi_id': 'taxi1', 'lon': 2.35, 'lat': 48.86},
+            {'taxi_id': 'taxi2', 'lon': 2.351, 'lat': 48.861},
+        ], 'operator', taxis_insee={'taxi1': '75056'})
+
+        app.config['LOCATION_STORE'] = 'memory'
+        store = location_store.get_location_store()
+        assert isinstance(store, location_store.MemoryLocationStore)
+        assert len(store) == 2
+        assert set(store.search(2.35, 48.86, 500, insee_codes={'75056'})) == {'taxi1'}
+
+        redis_backend.update_taxi_positions([{'taxi_id': 'taxi3', 'lon': 2.352, 'lat': 48.862}], 'operator')
+        assert location_store.get_location_store() is store
+        assert set(store.search(2.35, 48.86, 500)) == {'taxi1', 'taxi2', 'taxi3'}
+
+    def test_subscriber(self, app):
+        app.config['LOCATION_STORE'] = 'memory'
+        store = location_store.MemoryLocationStore()
+        subscriber = location_store.MemoryLocationStoreSubscriber(app, store)
+        subscriber.start()
+        try:
+            redis_backend.update_taxi_positions([{'taxi_id': 'taxi1', 'lon': 2.35, 'lat': 48.86}], 'operator')
+            deadline = time.monotonic() + 5
+            while not len(store) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert set(store.search(2.35, 48.86, 500)) == {'taxi1'}
+        finally:
+            subscriber.stop()
+            subscriber.join()
+
+    def test_expire(self, app):
+        now = int(time.time())
+        store = location_store.MemoryLocationStore(capacity=1)
+        store.update([{'taxi_id': 'taxi1', 'lon': 2.35, 'lat': 48.86}], 'operator', now - 300)
+        store.update([
+            {'taxi_id': 'taxi2', 'lon': 2.351, 'lat': 48.861},
+            {'taxi_id': 'taxi3', 'lon': 2.352, 'lat': 48.862},
+        ], 'operator', now)
+        # Older positions are ignored
+        store.update([{'taxi_id': 'taxi2', 'lon': 3, 'lat': 49}], 'operator', now - 10)
+
+        assert store.expire(now - 120) == 1
+        assert len(store) == 2
+        assert set(store.search(2.35, 48.86, 500)) == {'taxi2', 'taxi3'}
+
+        # The slot of the expired location is reused
+        store.update([{'taxi_id': 'taxi4', 'lon': 2.35, 'lat': 48.86}], 'operator', now)
+        assert set(store.search(2.35, 48.86, 500)) == {'taxi2', 'taxi3', 'taxi4'}
+
+    def test_invalid_setting(self, app):
+        app.config['LOCATION_STORE'] = 'postgresql'
+        with pytest.raises(ValueError):
+            location_store.get_location_store()
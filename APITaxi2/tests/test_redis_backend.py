@@ -1,5 +1,8 @@
+from datetime import datetime, timedelta
+import json
 import time
 
+import pytest
 
 from APITaxi2 import redis_backend
 
@@ -21,6 +24,219 @@ def test_get_taxi(app):
     assert ret.version == 2
 
 
+def test_get_taxi_packed(app):
+    now = int(time.time())
+    app.redis.hset('taxi:taxi_id', 'operator', redis_backend.pack_taxi_position(now, 48.86, -2.35))
+    assert len(app.redis.hget('taxi:taxi_id', 'operator')) == 13
+
+    ret = redis_backend.get_taxi('taxi_id', 'operator')
+    assert (ret.timestamp, ret.lat, ret.lon) == (now, 48.86, -2.35)
+    assert (ret.status, ret.device, ret.version) == ('free', 'phone', 2)
+
+
+def test_pack_taxi_positions(app):
+    now = int(time.time())
+    app.redis.hset('taxi:taxi1', 'operator1', f'{now} 48.86 2.35 free phone 2')
+    app.redis.hset('taxi:taxi1', 'operator2', redis_backend.pack_taxi_position(now, 48.87, 2.36))
+    app.redis.hset('taxi:taxi2', 'operator1', f'{now} -21.1151 55.5364 free phone 2')
+
+    assert redis_backend.pack_taxi_positions([b'taxi:taxi1', b'taxi:taxi2']) == 2
+    assert redis_backend.pack_taxi_positions([b'taxi:taxi1', b'taxi:taxi2']) == 0
+    for taxi_id, operator, lat, lon in (
+        ('taxi1', 'operator1', 48.86, 2.35),
+        ('taxi1', 'operator2', 48.87, 2.36),
+        ('taxi2', 'operator1', -21.1151, 55.5364),
+    ):
+        assert app.redis.hget(f'taxi:{taxi_id}', operator) == redis_backend.pack_taxi_position(now, lat, lon)
+
+
+def test_update_taxi_positions(app):
+    assert redis_backend.update_taxi_positions([], 'operator') == 0
+    assert app.redis.keys() == []
+
+    assert redis_backend.update_taxi_positions([
+        {'taxi_id': 'taxi1', 'lon': 2.35, 'lat': 48.86},
+        {'taxi_id': 'taxi2', 'lon': 2.36, 'lat': 48.87},
+    ], 'operator') == 2
+
+    # Same key layout as the geotaxi worker
+    assert set(app.redis.keys()) == {
+        b'taxi:taxi1',
+        b'taxi:taxi2',
+        b'geoindex',
+        b'geoindex_2',
+        b'timestamps',
+        b'timestamps_id',
+        b'last_seen',
+    }
+    ret = redis_backend.get_taxi('taxi2', 'operator')
+    assert (ret.lon, ret.lat) == (2.36, 48.87)
+    assert (ret.status, ret.device, ret.version) == ('free', 'phone', 2)
+    assert app.redis.geohash('geoindex', 'taxi1') == ['u09tvqxnnu0']
+    assert app.redis.geohash('geoindex_2', 'taxi1:operator') == ['u09tvqxnnu0']
+    assert set(app.redis.zrange('timestamps', 0, -1)) == {b'taxi1:operator', b'taxi2:operator'}
+    assert set(app.redis.zrange('timestamps_id', 0, -1)) == {b'taxi1', b'taxi2'}
+    assert set(app.redis.zrange('last_seen', 0, -1)) == {b'taxi1:operator', b'taxi2:operator'}
+
+    res = redis_backend.taxis_locations_by_operator(2.35, 48.86, 500)
+    assert list(res) == ['taxi1']
+    assert res['taxi1']['operator'].update_date
+
+
+def test_update_taxi_positions_packed(app):
+    app.config['GEOTAXI_PACKED_POSITIONS'] = True
+    app.config['GEOTAXI_MOVE_THRESHOLD'] = 20
+
+    redis_backend.update_taxi_positions([{'taxi_id': 'taxi1', 'lon': -61.5341, 'lat': 16.2411}], 'operator')
+    value = app.redis.hget('taxi:taxi1', 'operator')
+    assert len(value) == 13
+    ret = redis_backend.get_taxi('taxi1', 'operator')
+    assert (ret.lon, ret.lat) == (-61.5341, 16.2411)
+
+    # Previous packed position is read to coalesce updates
+    redis_backend.update_taxi_positions([{'taxi_id': 'taxi1', 'lon': -61.53411, 'lat': 16.2411}], 'operator')
+    assert redis_backend.get_coalesced_positions() == {'operator': 1}
+
+
+def test_update_taxi_positions_buckets(app):
+    app.config['GEOTAXI_BUCKETS'] = 16
+    app.config['GEOTAXI_MOVE_THRESHOLD'] = 20
+
+    redis_backend.update_taxi_positions([
+        {'taxi_id': 'taxi1', 'lon': 2.35, 'lat': 48.86},
+        {'taxi_id': 'taxi2', 'lon': 2.36, 'lat': 48.87},
+    ], 'operator')
+    assert not app.redis.exists('taxi:taxi1', 'taxi:taxi2')
+    key, field = redis_backend.get_taxi_position_key('taxi1', 'operator')
+    assert key.startswith('taxis:')
+    assert field == 'taxi1:operator'
+    assert app.redis.hexists(key, field)
+
+    ret = redis_backend.get_taxi('taxi2', 'operator')
+    assert (ret.lon, ret.lat) == (2.36, 48.87)
+
+    # Previous position is read from the bucket to coalesce updates
+    redis_backend.update_taxi_positions([{'taxi_id': 'taxi1', 'lon': 2.35001, 'lat': 48.86}], 'operator')
+    assert redis_backend.get_coalesced_positions() == {'operator': 1}
+
+
+def test_move_taxi_positions_to_buckets(app):
+    app.redis.hset('taxi:taxi1', 'operator', '1589567716 48.86 2.35 free phone 2')
+    app.redis.hset('taxi:taxi1', 'other', '1589567716 48.85 2.34 free phone 2')
+    app.redis.hset('taxi:taxi2', 'operator', '1589567716 48.87 2.36 free phone 2')
+
+    app.config['GEOTAXI_BUCKETS'] = 16
+    # Positions not moved yet are still readable
+    assert redis_backend.get_taxi('taxi1', 'other').lat == 48.85
+    # A more recent position was received in the meantime
+    redis_backend.update_taxi_positions([{'taxi_id': 'taxi2', 'lon': 2.37, 'lat': 48.88}], 'operator')
+
+    assert redis_backend.move_taxi_positions_to_buckets([b'taxi:taxi1', b'taxi:taxi2']) == 2
+    assert not app.redis.exists('taxi:taxi1', 'taxi:taxi2')
+    assert redis_backend.get_taxi('taxi1', 'operator').lat == 48.86
+    assert redis_backend.get_taxi('taxi1', 'other').lat == 48.85
+    assert redis_backend.get_taxi('taxi2', 'operator').lat == 48.88
+
+    pipeline = app.redis.pipeline()
+    redis_backend.delete_taxi_positions(pipeline, ['taxi1'], [('taxi1', 'operator'), ('taxi1', 'other')])
+    pipeline.execute()
+    assert redis_backend.get_taxi('taxi1', 'operator') is None
+    assert redis_backend.get_taxi('taxi1', 'other') is None
+    assert redis_backend.get_taxi('taxi2', 'operator') is not None
+
+
+def test_update_taxi_positions_insee(app):
+    redis_backend.update_taxi_positions([
+        {'taxi_id': 'taxi1', 'lon': 2.35, 'lat': 48.86},
+        {'taxi_id': 'taxi2', 'lon': 2.3501, 'lat': 48.8601},
+        # INSEE code unknown, only stored in geoindex_2
+        {'taxi_id': 'taxi3', 'lon': 2.3502, 'lat': 48.8602},
+    ], 'operator', taxis_insee={'taxi1': '75056', 'taxi2': '92012'})
+
+    assert app.redis.zrange('geoindex_insee:75056', 0, -1) == [b'taxi1:operator']
+    assert app.redis.zrange('geoindex_insee:92012', 0, -1) == [b'taxi2:operator']
+    assert not app.redis.exists('geoindex_insee:')
+
+    res = redis_backend.taxis_locations_by_operator(2.35, 48.86, 500)
+    assert set(res) == {'taxi1', 'taxi2', 'taxi3'}
+    res = redis_backend.taxis_locations_by_operator(2.35, 48.86, 500, insee_codes={'75056'})
+    assert set(res) == {'taxi1'}
+    res = redis_backend.taxis_locations_by_operator(2.35, 48.86, 500, insee_codes={'75056', '92012', '33063'})
+    assert set(res) == {'taxi1', 'taxi2'}
+    assert res['taxi2']['operator'].update_date
+
+    # The INSEE code of taxi1 changed, it is removed from the previous index
+    # even if it didn't move
+    app.config['GEOTAXI_MOVE_THRESHOLD'] = 20
+    redis_backend.update_taxi_positions([
+        {'taxi_id': 'taxi1', 'lon': 2.35, 'lat': 48.86},
+    ], 'operator', taxis_insee={'taxi1': '92012'})
+    assert app.redis.zrange('geoindex_insee:75056', 0, -1) == []
+    assert app.redis.zrange('geoindex_insee:92012', 0, -1) == [b'taxi1:operator', b'taxi2:operator']
+    assert app.redis.hgetall(redis_backend.GEOINDEX_INSEE_MEMBERS_KEY) == {
+        b'taxi1:operator': b'92012', b'taxi2:operator': b'92012',
+    }
+
+    redis_backend.delete_geoindex_insee_members([('taxi1', 'operator')])
+    assert app.redis.hgetall(redis_backend.GEOINDEX_INSEE_MEMBERS_KEY) == {b'taxi2:operator': b'92012'}
+
+
+def test_taxis_insee(app):
+    assert redis_backend.get_taxis_insee([]) == {}
+    redis_backend.set_taxis_insee({'taxi1': '75056', 'taxi2': '92012'})
+    assert redis_backend.get_taxis_insee(['taxi1', 'taxi3']) == {'taxi1': '75056'}
+    redis_backend.clear_taxis_insee()
+    assert redis_backend.get_taxis_insee(['taxi1']) == {}
+
+
+def test_update_taxi_positions_coalesced(app):
+    app.config['GEOTAXI_MOVE_THRESHOLD'] = 20
+    now = int(time.time())
+
+    redis_backend.update_taxi_positions([{'taxi_id': 'taxi1', 'lon': 2.35, 'lat': 48.86}], 'operator')
+    app.redis.zadd('timestamps', {'taxi1:operator': now - 30})
+
+    # Moved less than 20 meters: only timestamps are refreshed
+    redis_backend.update_taxi_positions([{'taxi_id': 'taxi1', 'lon': 2.35005, 'lat': 48.86005}], 'operator')
+    ret = redis_backend.get_taxi('taxi1', 'operator')
+    assert (ret.lon, ret.lat) == (2.35, 48.86)
+    assert app.redis.zscore('timestamps', 'taxi1:operator') >= now
+    # The timestamp is the one of the last position received
+    app.redis.hset('taxi:taxi1', 'operator', f'{now - 30} 48.86 2.35 free phone 2')
+    assert redis_backend.get_taxi('taxi1', 'operator').timestamp >= now
+    assert redis_backend.get_coalesced_positions() == {'operator': 1}
+
+    # Moved more than 20 meters
+    redis_backend.update_taxi_positions([{'taxi_id': 'taxi1', 'lon': 2.351, 'lat': 48.86}], 'operator')
+    ret = redis_backend.get_taxi('taxi1', 'operator')
+    assert (ret.lon, ret.lat) == (2.351, 48.86)
+    assert redis_backend.get_coalesced_positions() == {'operator': 1}
+
+    # Didn't move, but the last position is too old to be kept
+    app.redis.hset('taxi:taxi1', 'operator', f'{now - redis_backend.COALESCE_MAX_AGE} 48.86 2.351 free phone 2')
+    redis_backend.update_taxi_positions([{'taxi_id': 'taxi1', 'lon': 2.351, 'lat': 48.86}], 'operator')
+    assert redis_backend.get_taxi('taxi1', 'operator').timestamp >= now
+    assert redis_backend.get_coalesced_positions() == {'operator': 1}
+
+
+def test_owned_taxi_ids(app):
+    # Not loaded yet
+    assert redis_backend.filter_owned_taxi_ids('operator', ['taxi1']) is None
+    # Not created if not loaded
+    assert redis_backend.add_owned_taxi_ids('operator', ['taxi1']) == 0
+    assert redis_backend.filter_owned_taxi_ids('operator', ['taxi1']) is None
+
+    redis_backend.set_owned_taxi_ids('operator', {'taxi1', 'taxi2'})
+    assert redis_backend.filter_owned_taxi_ids('operator', ['taxi1', 'taxi3']) == {'taxi1'}
+    assert app.redis.ttl('operator_taxis:operator') > 0
+
+    redis_backend.add_owned_taxi_ids('operator', ['taxi3'])
+    assert redis_backend.filter_owned_taxi_ids('operator', ['taxi1', 'taxi3']) == {'taxi1', 'taxi3'}
+
+    redis_backend.clear_owned_taxi_ids()
+    assert redis_backend.filter_owned_taxi_ids('operator', ['taxi1']) is None
+
+
 def test_get_timestamps_entries_between(app):
     now = int(time.time())
     app.redis.zadd('timestamps', {'taxi:operator': now})
@@ -36,16 +252,50 @@ def test_get_timestamps_entries_between(app):
 
 def test_list_taxis(app):
     now = int(time.time())
-    app.redis.hset('taxi:taxi1', 'operator1', f'{now} 48.86 2.35 free phone 2')
-    app.redis.hset('taxi:taxi2', 'operator2', f'{now - 50} 48.86 2.35 free phone 2')
-    app.redis.hset('taxi:taxi3', 'operator3', f'{now + 50} 48.86 2.35 free phone 2')
-    app.redis.hset('taxi:taxi4', 'operator4', f'{now - 500} 48.86 2.35 free phone 2')
-    app.redis.hset('taxi:taxi5', 'operator5', f'{now + 500} 48.86 2.35 free phone 2')
+    app.redis.zadd('last_seen', {
+        'taxi1:operator1': now,
+        'taxi2:operator2': now - 50,
+        'taxi3:operator3': now + 50,
+        'taxi4:operator4': now - 500,
+        'taxi5:operator5': now + 500,
+    })
 
     res = redis_backend.list_taxis(now - 100, now + 100)
     assert len(res) == 3
     assert {r.taxi_id for r in res} == {'taxi1', 'taxi2', 'taxi3'}
 
+    assert set(redis_backend.list_taxi_ids()) == {'taxi1', 'taxi2', 'taxi3', 'taxi4', 'taxi5'}
+
+    # Positions stored before last_seen existed, not backfilled yet
+    app.redis.hset('taxi:taxi6', 'operator6', f'{now} 48.86 2.35 free phone 2')
+    app.redis.hset('taxis:1', 'taxi7:operator7', f'{now} 48.86 2.35 free phone 2')
+    assert set(redis_backend.list_taxi_ids()) == {'taxi1', 'taxi2', 'taxi3', 'taxi4', 'taxi5', 'taxi6', 'taxi7'}
+
+    redis_backend.backfill_last_seen()
+    app.redis.zrem('last_seen', 'taxi6:operator6')
+    assert set(redis_backend.list_taxi_ids()) == {'taxi1', 'taxi2', 'taxi3', 'taxi4', 'taxi5', 'taxi7'}
+
+
+def test_backfill_last_seen(app):
+    now = int(time.time())
+    app.redis.hset('taxi:taxi1', 'operator1', f'{now - 500} 48.86 2.35 free phone 2')
+    app.redis.hset('taxi:taxi1', 'operator2', f'{now - 50} 48.86 2.35 free phone 2')
+    app.redis.hset('taxi:taxi2', 'operator1', f'{now - 500} 48.86 2.35 free phone 2')
+    # Moved to a bucket by geotaxi migrate-buckets
+    app.redis.hset('taxis:3', 'taxi3:operator1', f'{now - 100} 48.86 2.35 free phone 2')
+    # Location received after the hash was read, must not be overwritten
+    app.redis.zadd('last_seen', {'taxi2:operator1': now})
+
+    assert not app.redis.exists(redis_backend.LAST_SEEN_BACKFILLED_KEY)
+    assert redis_backend.backfill_last_seen(batch_size=1) == 4
+    assert app.redis.zrange('last_seen', 0, -1, withscores=True) == [
+        (b'taxi1:operator1', now - 500),
+        (b'taxi3:operator1', now - 100),
+        (b'taxi1:operator2', now - 50),
+        (b'taxi2:operator1', now),
+    ]
+    assert app.redis.exists(redis_backend.LAST_SEEN_BACKFILLED_KEY)
+
 
 def test_set_taxi_availability(app):
     # Not available, must be in ZSET not_available
@@ -72,10 +322,91 @@ def test_taxis_locations_by_operator(app):
     app.redis.geoadd('geoindex_2', [2.3, 47, 'taxi3:operator4'])
     app.redis.zadd('timestamps', {'taxi3:operator4': now})
 
+    # No timestamp
+    app.redis.geoadd('geoindex_2', [2.35003, 48.86003, 'taxi5:operator5'])
+
     res = redis_backend.taxis_locations_by_operator(2.35, 48.86, 500)
-    assert len(res) == 2
+    assert len(res) == 3
     assert len(res['taxi1']) == 2
     assert len(res['taxi2']) == 1
+    assert res['taxi1']['operator1'].update_date == datetime.fromtimestamp(now)
+    assert res['taxi1']['operator1'].distance < res['taxi2']['operator3'].distance
+    assert res['taxi2']['operator3'].lon == pytest.approx(2.35002, abs=1e-5)
+    assert res['taxi5']['operator5'].update_date is None
+    assert not redis_backend.is_truncated(res, None)
+
+    # Closest members only
+    res = redis_backend.taxis_locations_by_operator(2.35, 48.86, 500, count=2)
+    assert res == {'taxi1': {'operator1': res['taxi1']['operator1'], 'operator2': res['taxi1']['operator2']}}
+    assert redis_backend.is_truncated(res, 2)
+    res = redis_backend.taxis_locations_by_operator(2.35, 48.86, 500, count=10)
+    assert len(res) == 3
+    assert not redis_backend.is_truncated(res, 10)
+
+
+def test_geo_shards(app, geo_shards):
+    # Cells (2, 48) and (3, 48) are stored on different shards
+    first, second = geo_shards
+    assert redis_backend.get_geo_shard(2.35, 48.86) is second
+    assert redis_backend.get_geo_shard(3.05, 48.86) is first
+    assert redis_backend.get_geo_shards_within(2.5, 48.5, 500) == [second]
+    assert redis_backend.get_geo_shards_within(3, 48.5, 500) == [first, second]
+
+    now = int(time.time())
+    redis_backend.update_taxi_positions([
+        # On both sides of the border between the two cells
+        {'taxi_id': 'taxi1', 'lon': 2.999, 'lat': 48.5},
+        {'taxi_id': 'taxi2', 'lon': 3.001, 'lat': 48.5},
+    ], 'operator')
+
+    # The geo indexes are only stored on the shards
+    assert set(app.redis.keys()) == {b'taxi:taxi1', b'taxi:taxi2', b'last_seen'}
+    assert second.zrange('geoindex_2', 0, -1) == [b'taxi1:operator']
+    assert second.zrange('timestamps_id', 0, -1) == [b'taxi1']
+    assert first.zrange('geoindex_2', 0, -1) == [b'taxi2:operator']
+    assert first.zrange('timestamps_id', 0, -1) == [b'taxi2']
+
+    res = redis_backend.taxis_locations_by_operator(3, 48.5, 500)
+    assert set(res) == {'taxi1', 'taxi2'}
+
+    # taxi1 crosses the border, its previous location is still in the second shard
+    second.zadd('timestamps', {'taxi1:operator': now - 10})
+    redis_backend.update_taxi_positions([{'taxi_id': 'taxi1', 'lon': 3.002, 'lat': 48.5}], 'operator')
+    assert second.zrange('geoindex_2', 0, -1) == [b'taxi1:operator']
+    res = redis_backend.taxis_locations_by_operator(3, 48.5, 500)
+    assert res['taxi1']['operator'].lon == pytest.approx(3.002, abs=1e-5)
+
+    # Each taxi is returned once
+    updates = redis_backend.get_timestamps_entries_between(0, now + 10)
+    assert sorted(u.taxi_id for u in updates) == ['taxi1', 'taxi2']
+    assert len(redis_backend.list_taxi_positions(['taxi1', 'taxi2'])) == 4
+
+    # The INSEE code of taxi2 changed, it is removed from the previous index
+    for insee in ('75056', '92012'):
+        redis_backend.update_taxi_positions(
+            [{'taxi_id': 'taxi2', 'lon': 3.001, 'lat': 48.5}], 'operator', taxis_insee={'taxi2': insee}
+        )
+    assert first.zrange('geoindex_insee:75056', 0, -1) == []
+    assert first.zrange('geoindex_insee:92012', 0, -1) == [b'taxi2:operator']
+    assert first.hgetall(redis_backend.GEOINDEX_INSEE_MEMBERS_KEY) == {b'taxi2:operator': b'92012'}
+
+
+def test_expire_positions(app):
+    now = int(time.time())
+    redis_backend.update_taxi_positions([
+        {'taxi_id': 'taxi1', 'lon': 2.35, 'lat': 48.86},
+        {'taxi_id': 'taxi2', 'lon': 2.35, 'lat': 48.86},
+    ], 'operator', taxis_insee={'taxi1': '75056', 'taxi2': '75056'})
+    app.redis.zadd('timestamps', {'taxi1:operator': now - 300, 'taxi2:operator': now - 200})
+    app.redis.zadd('timestamps_id', {'taxi1': now - 300, 'taxi2': now - 200})
+    # The INSEE code of the index is not read from the cache taxi_insee
+    redis_backend.clear_taxis_insee()
+
+    assert redis_backend.expire_positions(app.redis, now - 250, chunk_size=10) == 2
+    assert redis_backend.expire_positions(app.redis, now - 250, chunk_size=10) == 0
+    assert app.redis.zrange('geoindex_insee:75056', 0, -1) == [b'taxi2:operator']
+    assert app.redis.zrange('geoindex', 0, -1) == [b'taxi2']
+    assert app.redis.hgetall(redis_backend.GEOINDEX_INSEE_MEMBERS_KEY) == {b'taxi2:operator': b'75056'}
 
 
 def test_log_hail(app, moteur):
@@ -84,11 +415,153 @@ def test_log_hail(app, moteur):
         request_user=moteur.user, response_payload={},
         response_status_code=200, hail_final_status='failure'
     )
-    assert len(app.redis.zrange('hail:hail_id', 0, -1, withscores=True)) == 1
+    logs = redis_backend.list_hail_logs('hail_id')
+    assert len(logs) == 1
+    assert json.loads(logs[0].data)['user'] == moteur.user.email
+    # Compact JSON
+    assert ': ' not in logs[0].data
+
+    entries = redis_backend.read_hail_logs('consumer', 10)
+    assert [entry.id for entry in entries] == [logs[0].id]
+    # Delivered again until acknowledged
+    assert len(redis_backend.read_hail_logs('consumer', 10)) == 1
+    redis_backend.ack_hail_logs(entries)
+    assert redis_backend.read_hail_logs('consumer', 10) == []
 
 
 def test_fake_taxi_ids(app, moteur):
-    fake_taxi_ids = {'123': 'abc', '456': 'def'}
-    redis_backend.set_fake_taxi_ids(moteur.user, fake_taxi_ids)
+    # Mapping written by searches before fake IDs were signed
+    app.redis.hset(f'fake_taxi_id:{moteur.user.email}', mapping={'123': 'abc', '456': 'def'})
     assert redis_backend.get_real_taxi_id(moteur.user, '123') == 'abc'
     assert redis_backend.get_real_taxi_id(moteur.user, 'abc') == 'abc'
+
+
+def test_taxis_search_metadata(app):
+    now = datetime.now().replace(microsecond=0)
+    record = redis_backend.TaxiSearchMetadata(
+        taxi_id='taxi1',
+        operator='operator',
+        status='free',
+        radius=500,
+        insee='75056',
+        last_update_at=now,
+        licence_plate='AB-123-CD',
+        model='C4 PICASSO',
+        nb_seats=4,
+        characteristics=['wifi', 'baby_seat'],
+    )
+    assert redis_backend.get_taxis_search_metadata([('taxi1', 'operator')]) == {}
+
+    redis_backend.set_taxis_search_metadata([record])
+    assert app.redis.ttl('taxi_search:taxi1:operator') > 0
+    assert redis_backend.get_taxis_search_metadata([('taxi1', 'operator'), ('taxi1', 'other')]) == {
+        ('taxi1', 'operator'): record
+    }
+
+    # Only existing records are updated
+    assert redis_backend.update_taxi_search_metadata('taxi1', 'other', status='off') == 0
+    redis_backend.update_taxi_search_metadata('taxi1', 'operator', status='off', radius=None, characteristics=[])
+    assert redis_backend.get_taxis_search_metadata([('taxi1', 'operator'), ('taxi1', 'other')]) == {
+        ('taxi1', 'operator'): redis_backend.TaxiSearchMetadata(
+            taxi_id='taxi1',
+            operator='operator',
+            status='off',
+            insee='75056',
+            last_update_at=now,
+            licence_plate='AB-123-CD',
+            model='C4 PICASSO',
+            nb_seats=4,
+        )
+    }
+
+    redis_backend.clear_taxis_search_metadata()
+    assert redis_backend.get_taxis_search_metadata([('taxi1', 'operator')]) == {}
+
+
+def test_search_available_taxis(app):
+    now = datetime.now().replace(microsecond=0)
+    lon, lat = 2.35, 48.86
+    for taxi_id, operator, delta_lon in (
+        ('taxi1', 'operator', 0.001),
+        ('taxi2', 'operator', 0.002),  # Out of its reach
+        ('taxi3', 'operator', 0.003),  # Not free
+        ('taxi4', 'operator', 0.004),  # No metadata
+        ('taxi5', 'operator', 0.005),  # Not available, but free
+        ('taxi6', 'operator', 0.006),
+        ('taxi6', 'other', 0.007),  # Updated last
+        ('taxi7', 'other', 0.008),  # Other town
+    ):
+        redis_backend.update_taxi_positions(
+            [{'taxi_id': taxi_id, 'lon': lon + delta_lon, 'lat': lat}], operator,
+            taxis_insee={taxi_id: '94018' if taxi_id == 'taxi7' else '75056'}
+        )
+    redis_backend.set_taxis_search_metadata([
+        redis_backend.TaxiSearchMetadata('taxi1', 'operator', status='free', insee='75056', model='C4'),
+        redis_backend.TaxiSearchMetadata('taxi2', 'operator', status='free', insee='75056', radius=100),
+        redis_backend.TaxiSearchMetadata('taxi3', 'operator', status='off', insee='75056'),
+        redis_backend.TaxiSearchMetadata('taxi5', 'operator', status='free', insee='75056'),
+        redis_backend.TaxiSearchMetadata(
+            'taxi6', 'operator', status='free', insee='75056', last_update_at=now - timedelta(hours=1)
+        ),
+        redis_backend.TaxiSearchMetadata('taxi6', 'other', status='free', insee='75056', last_update_at=now),
+        redis_backend.TaxiSearchMetadata('taxi7', 'other', status='free', insee='94018'),
+    ])
+    redis_backend.set_taxi_availability('taxi5', 'operator', False)
+
+    def search(**kwargs):
+        return redis_backend.search_available_taxis(
+            lon, lat, 2000, {'75056'}, now - timedelta(seconds=120), 1000, **kwargs
+        )
+
+    result = search()
+    # The status of the metadata is checked, not the zset not_available
+    assert [(taxi_id, metadata.operator) for taxi_id, (metadata, _) in result.taxis.items()] == [
+        ('taxi1', 'operator'), ('taxi5', 'operator'), ('taxi6', 'other')
+    ]
+    metadata, location = result.taxis['taxi1']
+    assert metadata.model == 'C4'
+    assert location.lon == pytest.approx(lon + 0.001, abs=1e-5)
+    assert location.distance == pytest.approx(73, abs=1)
+    assert list(result.unresolved) == ['taxi4']
+    assert result.found == 4
+    assert result.closest == location.distance
+
+    result = search(operator='other')
+    assert list(result.taxis) == ['taxi6']
+    assert result.unresolved == {}
+
+    # Locations too old
+    result = redis_backend.search_available_taxis(lon, lat, 2000, {'75056'}, now + timedelta(seconds=10), 1000)
+    assert result.taxis == {}
+    assert result.found == 0
+    assert result.closest is None
+
+    # Several searches in a pipeline
+    searches = [
+        (lon, lat, 2000, {'75056'}, None),
+        (lon + 0.008, lat, 100, {'94018'}, None),
+        (lon, lat, 2000, {'75056'}, 2),
+    ]
+    results = redis_backend.search_available_taxis_many(searches, now - timedelta(seconds=120), 1000)
+    assert [list(result.taxis) for result in results] == [['taxi1', 'taxi5', 'taxi6'], ['taxi7'], ['taxi1']]
+    assert results[0] == search()
+    assert results[2] == search(count=2)
+    assert redis_backend.search_available_taxis_many([], now, 1000) == []
+
+    # Only the closest locations are read
+    result = search(count=2)
+    assert list(result.taxis) == ['taxi1']
+    assert result.truncated
+    result = search(count=100)
+    assert list(result.taxis) == ['taxi1', 'taxi5', 'taxi6']
+    assert not result.truncated
+    assert not search().truncated
+
+    # Location left in the geo index of the previous ADS of the taxi
+    app.redis.geoadd('geoindex_insee:75056', [lon + 0.0005, lat, 'taxi7:other'])
+    assert list(search().taxis) == ['taxi1', 'taxi5', 'taxi6']
+    result = redis_backend.search_available_taxis(
+        lon, lat, 2000, {'75056', '94018'}, now - timedelta(seconds=120), 1000
+    )
+    assert list(result.taxis) == ['taxi1', 'taxi5', 'taxi6', 'taxi7']
+    assert result.taxis['taxi7'][1].lon == pytest.approx(lon + 0.008, abs=1e-5)
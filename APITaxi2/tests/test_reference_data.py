@@ -0,0 +1,59 @@
+import json
+import time
+
+import pytest
+
+from APITaxi2 import exclusions, reference_data, town_index
+from APITaxi2.views import stats as stats_views, zupc as zupc_views
+from APITaxi_models2.unittest.factories import TownFactory
+
+
+@pytest.fixture
+def clear_caches(app):
+    """The caches of the reference data are global, don't leak them to other
+    tests."""
+    yield
+    exclusions._load_exclusion_tree.cache_clear()
+    zupc_views._dump_towns.cache_clear()
+    stats_views._get_groups.cache_clear()
+    stats_views._get_managers.cache_clear()
+
+
+class TestReferenceData:
+    def test_load_reset(self, app, clear_caches):
+        TownFactory()
+        reference_data.reset()
+        index = town_index.get_town_index()
+        assert len(zupc_views._dump_towns(None)['data']) == 1
+        assert json.loads(reference_data.get_swagger_json(app))['info']['title']
+
+        TownFactory(bordeaux=True)
+        reference_data.reset()
+        assert town_index.get_town_index() is not index
+        assert len(zupc_views._dump_towns(None)['data']) == 2
+
+    def test_publish_reload(self, app):
+        pubsub = app.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(reference_data.RELOAD_CHANNEL)
+        reference_data.publish_reload()
+        message = pubsub.get_message(timeout=1)
+        assert message['channel'] == reference_data.RELOAD_CHANNEL.encode('utf8')
+        pubsub.close()
+
+    def test_subscribe(self, app, clear_caches):
+        thread = reference_data._subscribe(app)
+        try:
+            # Wait for the subscription
+            time.sleep(0.5)
+
+            reference_data.load()
+            index = town_index.get_town_index()
+            reference_data.publish_reload()
+            for _ in range(20):
+                if town_index.get_town_index() is not index:
+                    break
+                time.sleep(0.1)
+            assert town_index.get_town_index() is not index
+        finally:
+            thread.stop()
+            thread.join()
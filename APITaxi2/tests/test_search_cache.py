@@ -0,0 +1,82 @@
+from unittest import mock
+
+from APITaxi2 import search_cache
+from APITaxi2.search_cache import get_search_cache, SearchCache
+
+
+class TestSearchCache:
+    def test_get_set(self):
+        cache = SearchCache(ttl=2, grid=0.001)
+        key = cache.make_key('moteur@le.taxi', False, '75056', 2.35, 48.86, None)
+        # Same cell of the grid
+        assert cache.make_key('moteur@le.taxi', False, '75056', 2.3502, 48.8598, None) == key
+        assert cache.make_key('moteur@le.taxi', False, '75056', 2.352, 48.86, None) != key
+        assert cache.make_key('moteur@le.taxi', True, '75056', 2.35, 48.86, None) != key
+        assert cache.make_key('moteur@le.taxi', False, '75056', 2.35, 48.86, 10) != key
+
+        with mock.patch.object(search_cache, 'time', **{'monotonic.return_value': 1000}):
+            assert cache.get(key) is None
+            cache.set(key, 'value')
+            assert cache.get(key) == 'value'
+        with mock.patch.object(search_cache, 'time', **{'monotonic.return_value': 1002}):
+            assert cache.get(key) is None
+
+        stats = cache.get_stats()
+        assert stats['entries'] == 1
+        assert stats['hits'] == 1
+        assert stats['misses'] == 2
+        assert stats['hit_ratio'] == 1 / 3
+
+    def test_max_entries(self):
+        cache = SearchCache(ttl=2, grid=0.001)
+        with mock.patch.object(search_cache, 'MAX_ENTRIES', 2), \
+                mock.patch.object(search_cache, 'time') as mocked_time:
+            mocked_time.monotonic.return_value = 1000
+            cache.set('a', 1)
+            mocked_time.monotonic.return_value = 1001
+            cache.set('b', 2)
+            # The first entry has expired
+            mocked_time.monotonic.return_value = 1002
+            cache.set('c', 3)
+            assert cache.get_stats()['entries'] == 2
+            assert cache.get('b') == 2
+            # All the entries are fresh, the oldest one is removed
+            cache.set('d', 4)
+            assert cache.get_stats()['entries'] == 2
+            assert cache.get('b') is None
+            assert cache.get('c') == 3
+
+    def test_get_search_cache(self, app):
+        assert get_search_cache() is None
+
+        app.config['SEARCH_CACHE_TTL'] = 2
+        cache = get_search_cache()
+        assert cache.grid == search_cache.DEFAULT_GRID
+        assert get_search_cache() is cache
+
+        app.config['SEARCH_CACHE_GRID'] = 0.01
+        assert get_search_cache().grid == 0.01
+
+    def test_flush_stats(self, app):
+        app.config['SEARCH_CACHE_TTL'] = 2
+        cache = get_search_cache()
+        other = SearchCache(ttl=2, grid=0.001)
+        cache.get('key')
+        other.get('key')
+        other.set('key', 'value')
+        other.get('key')
+
+        # Flushed every STATS_FLUSH_INTERVAL seconds
+        cache.flush_stats(app.redis)
+        assert search_cache.get_global_stats(app.redis)['misses'] == 0
+
+        cache.flush_stats(app.redis, force=True)
+        other.flush_stats(app.redis, force=True)
+        # Only the counts since the last flush are added
+        other.flush_stats(app.redis, force=True)
+        assert search_cache.get_global_stats(app.redis) == {
+            'minutes': 5,
+            'hits': 1,
+            'misses': 2,
+            'hit_ratio': 1 / 3,
+        }
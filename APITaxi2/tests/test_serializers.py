@@ -0,0 +1,191 @@
+from datetime import datetime
+import json
+from unittest import mock
+
+from flask import jsonify
+from marshmallow import fields, post_dump, Schema
+
+from APITaxi2 import redis_backend, schemas
+from APITaxi2.serializers import compile_schema, CompiledDumpMixin
+from APITaxi_models2.unittest.factories import HailFactory, TaxiFactory
+
+
+def marshmallow_dump():
+    """Dump the schemas with the generic machinery of marshmallow."""
+    return mock.patch.object(CompiledDumpMixin, 'compiled_dump', False)
+
+
+def assert_same_json(compiled, generic):
+    """Byte-for-byte, the keys are not sorted to compare their order."""
+    assert json.dumps(compiled) == json.dumps(generic)
+
+
+class NestedSchema(Schema):
+    name = fields.String()
+    count = fields.Integer()
+
+
+class SampleSchema(Schema):
+    id = fields.String()
+    renamed = fields.String(data_key='other_name')
+    email = fields.String(attribute='user.email')
+    count = fields.Integer()
+    ratio = fields.Float()
+    flag = fields.Bool()
+    date = fields.DateTime()
+    default = fields.String(dump_default='default')
+    callable_default = fields.List(fields.String, dump_default=list)
+    constant = fields.Constant('constant')
+    nested = fields.Nested(NestedSchema)
+    children = fields.List(fields.Nested(NestedSchema))
+    method = fields.Method('get_method')
+    # Read from the method dict.copy() if the key is missing
+    copy = fields.String()
+
+    def get_method(self, obj):
+        return 'method'
+
+
+class TestCompileSchema:
+    OBJECTS = [
+        {},
+        {
+            'id': 'xxx',
+            'renamed': 'renamed',
+            'user': {'email': 'user@example.com'},
+            'count': 3,
+            'ratio': 1.5,
+            'flag': True,
+            'date': datetime(2024, 1, 2, 3, 4, 5),
+            'default': None,
+            'callable_default': ['a', 'b'],
+            'nested': {'name': 'nested', 'count': 1},
+            'children': [{'name': 'first'}, {'count': 2}],
+        },
+        # Values formatted by the fields
+        {
+            'id': 12,
+            'user': {},
+            'count': '3',
+            'ratio': 1,
+            'flag': 0,
+            'nested': None,
+            'children': None,
+        },
+    ]
+
+    def test_dump(self):
+        schema = SampleSchema()
+        dump = compile_schema(schema)
+        for obj in self.OBJECTS:
+            assert_same_json(dump(obj), schema.dump(obj))
+
+        # Objects are read by attribute
+        obj = mock.Mock(spec=['id', 'user', 'nested'], id='xxx', nested=None)
+        obj.user.email = 'user@example.com'
+        assert_same_json(dump(obj), schema.dump(obj))
+
+    def test_not_compiled(self):
+        class PostDumpSchema(Schema):
+            id = fields.String()
+
+            @post_dump
+            def add_field(self, data, **kwargs):
+                data['added'] = True
+                return data
+
+        assert compile_schema(SampleSchema(only=['id'])) is None
+        assert compile_schema(SampleSchema(exclude=['id'])) is None
+        assert compile_schema(SampleSchema(many=True)) is None
+        assert compile_schema(PostDumpSchema()) is None
+
+    def test_mixin(self):
+        class CompiledSchema(CompiledDumpMixin, SampleSchema):
+            pass
+
+        schema = CompiledSchema()
+        obj = self.OBJECTS[1]
+        assert_same_json(schema.dump(obj), SampleSchema().dump(obj))
+        # Compiled once per instance
+        assert compile_schema(schema) is compile_schema(schema)
+        # many=True is not compiled
+        assert_same_json(schema.dump([obj], many=True), SampleSchema().dump([obj], many=True))
+
+
+class TestSchemasEquivalence:
+    def test_search_taxi(self, app):
+        metadata = redis_backend.TaxiSearchMetadata(
+            taxi_id='taxi_id',
+            operator='operator@example.com',
+            status='free',
+            radius=150,
+            insee='75056',
+            last_update_at=datetime(2024, 1, 2, 3, 4, 5),
+            licence_plate='AB-123-CD',
+            model='Model',
+            constructor='Constructor',
+            nb_seats=4,
+            engine='Électrique',
+            characteristics=['pet_accepted', 'baby_seat'],
+        )
+        location = redis_backend.Location(lon=2.35, lat=48.86, distance=123.4, update_date=datetime.now())
+        other = redis_backend.TaxiSearchMetadata(taxi_id='other', operator='operator@example.com')
+        obj = {'data': [(metadata, location), (other, None)]}
+
+        with app.test_request_context():
+            compiled = schemas.DataSearchTaxiSchema().dump(obj)
+            with marshmallow_dump():
+                generic = schemas.DataSearchTaxiSchema().dump(obj)
+        assert_same_json(compiled, generic)
+
+    def test_taxi(self, app, operateur):
+        taxi = TaxiFactory(added_by=operateur.user)
+        app.redis.hset(
+            'taxi:%s' % taxi.id,
+            operateur.user.email,
+            '1589567716 48.84 2.35 free phone 2'
+        )
+        resp = operateur.client.get('/taxis/%s' % taxi.id)
+        assert resp.status_code == 200
+        with marshmallow_dump():
+            generic = operateur.client.get('/taxis/%s' % taxi.id)
+        assert resp.data == generic.data
+
+    def test_hail(self, app, admin, operateur, moteur):
+        for status in ('received', 'accepted_by_customer', 'finished'):
+            hail = HailFactory(status=status, added_by=moteur.user, operateur=operateur.user)
+            app.redis.hset(
+                'taxi:%s' % hail.taxi.id,
+                operateur.user.email,
+                '1589567716 48.84 2.35 free phone 2'
+            )
+            for user in (admin, operateur, moteur):
+                resp = user.client.get('/hails/%s' % hail.id)
+                assert resp.status_code == 200
+                with marshmallow_dump():
+                    generic = user.client.get('/hails/%s' % hail.id)
+                assert resp.data == generic.data
+
+
+class TestJSONProvider:
+    def test_response(self, app):
+        obj = {
+            'b': 'Électrique',
+            'a': [1, 1.5, None, True],
+            'date': datetime(2024, 1, 2, 3, 4, 5),
+            # Larger than 64 bits, not supported by orjson
+            'big': 2 ** 64,
+        }
+        # Responses are pretty-printed by the json module in debug mode
+        app.json.compact = True
+        with app.test_request_context():
+            resp = jsonify(obj)
+            del obj['big']
+            fast = jsonify(obj)
+
+        # Encoded by the json module
+        assert resp.json == {**obj, 'big': 2 ** 64, 'date': 'Tue, 02 Jan 2024 03:04:05 GMT'}
+        # Compact, sorted, dates formatted by Flask, UTF-8
+        assert fast.data == (
+            '{"a":[1,1.5,null,true],"b":"Électrique","date":"Tue, 02 Jan 2024 03:04:05 GMT"}\n'
+        ).encode('utf8')
@@ -6,7 +6,7 @@ from unittest import mock
 
 from sqlalchemy.orm import joinedload
 
-from APITaxi_models2 import db, Hail, Taxi, VehicleDescription, ZUPC
+from APITaxi_models2 import db, Hail, HailLog, Taxi, VehicleDescription, ZUPC
 from APITaxi_models2.unittest.factories import (
     HailFactory,
     TaxiFactory,
@@ -17,6 +17,7 @@ from APITaxi_models2.unittest.factories import (
 )
 
 from .. import tasks
+from .. import redis_backend
 from .. import stats_backend
 
 
@@ -30,12 +31,14 @@ class TestCleanGeoindexTimestamps:
         app.redis.geoadd('geoindex', [2.22, 48.88, 'FRESH_TAXI_ID'])
         app.redis.zadd('timestamps', {'FRESH_TAXI_ID:OPERATOR': now})
         app.redis.geoadd('geoindex_2', [2.22, 48.88, 'FRESH_TAXI_ID:OPERATOR'])
+        app.redis.geoadd('geoindex_insee:75056', [2.22, 48.88, 'FRESH_TAXI_ID:OPERATOR'])
 
         # Store expired locations
         app.redis.zadd('timestamps_id', {'EXPIRED_TAXI_ID': expired})
         app.redis.geoadd('geoindex', [2.22, 48.88, 'EXPIRED_TAXI_ID'])
         app.redis.zadd('timestamps', {'EXPIRED_TAXI_ID:OPERATOR': expired})
         app.redis.geoadd('geoindex_2', [2.22, 48.88, 'EXPIRED_TAXI_ID:OPERATOR'])
+        app.redis.geoadd('geoindex_insee:75056', [2.22, 48.88, 'EXPIRED_TAXI_ID:OPERATOR'])
 
         with mock.patch.object(tasks.operators.current_app.logger, 'info') as mocked_logger:
             tasks.clean_geoindex_timestamps()
@@ -46,6 +49,72 @@ class TestCleanGeoindexTimestamps:
         assert len(app.redis.zrange('geoindex', 0, -1)) == 1
         assert len(app.redis.zrange('timestamps', 0, -1)) == 1
         assert len(app.redis.zrange('geoindex_2', 0, -1)) == 1
+        assert len(app.redis.zrange('geoindex_insee:75056', 0, -1)) == 1
+
+    def test_geo_shards(self, app, geo_shards):
+        now = time.time()
+        expired = now - 300
+
+        for shard, timestamp in zip(geo_shards, (now, expired)):
+            shard.zadd('timestamps_id', {'TAXI_ID': timestamp})
+            shard.geoadd('geoindex', [2.22, 48.88, 'TAXI_ID'])
+            shard.zadd('timestamps', {'TAXI_ID:OPERATOR': timestamp})
+            shard.geoadd('geoindex_2', [2.22, 48.88, 'TAXI_ID:OPERATOR'])
+
+        tasks.clean_geoindex_timestamps()
+
+        # Only the expired location of the second shard has been removed
+        fresh, expired = geo_shards
+        assert fresh.zrange('geoindex_2', 0, -1) == [b'TAXI_ID:OPERATOR']
+        assert fresh.zrange('geoindex', 0, -1) == [b'TAXI_ID']
+        assert expired.keys() == []
+
+
+class TestExpirePositions:
+    def test_expired(self, app):
+        now = time.time()
+        expired = now - 300
+        app.redis.hset(redis_backend.GEOINDEX_INSEE_MEMBERS_KEY, mapping={
+            'FRESH_TAXI_ID:OPERATOR': '75056',
+            'EXPIRED_TAXI_ID:OPERATOR': '75056',
+        })
+
+        for taxi_id, timestamp in (('FRESH_TAXI_ID', now), ('EXPIRED_TAXI_ID', expired)):
+            app.redis.zadd('timestamps_id', {taxi_id: timestamp})
+            app.redis.geoadd('geoindex', [2.22, 48.88, taxi_id])
+            app.redis.zadd('timestamps', {f'{taxi_id}:OPERATOR': timestamp})
+            app.redis.geoadd('geoindex_2', [2.22, 48.88, f'{taxi_id}:OPERATOR'])
+            app.redis.geoadd('geoindex_insee:75056', [2.22, 48.88, f'{taxi_id}:OPERATOR'])
+
+        with mock.patch.object(tasks.clean.current_app.logger, 'info') as mocked_logger:
+            ret = tasks.expire_positions()
+            assert mocked_logger.call_count == 1
+        assert ret['removed'] == 2
+
+        # Expired locations have been removed, fresh locations are still there
+        for key in ('timestamps_id', 'geoindex'):
+            assert app.redis.zrange(key, 0, -1) == [b'FRESH_TAXI_ID']
+        for key in ('timestamps', 'geoindex_2', 'geoindex_insee:75056'):
+            assert app.redis.zrange(key, 0, -1) == [b'FRESH_TAXI_ID:OPERATOR']
+
+    def test_chunks(self, app):
+        expired = time.time() - 300
+        for i in range(25):
+            app.redis.zadd('timestamps', {f'TAXI_{i}:OPERATOR': expired})
+            app.redis.geoadd('geoindex_2', [2.22, 48.88, f'TAXI_{i}:OPERATOR'])
+
+        with mock.patch.object(tasks.clean, 'EXPIRE_CHUNK_SIZE', 10):
+            assert tasks.expire_positions()['removed'] == 25
+        assert app.redis.zcard('geoindex_2') == 0
+
+        # Time budget exceeded, the next run continues
+        for i in range(25):
+            app.redis.zadd('timestamps', {f'TAXI_{i}:OPERATOR': expired})
+            app.redis.geoadd('geoindex_2', [2.22, 48.88, f'TAXI_{i}:OPERATOR'])
+        with mock.patch.object(tasks.clean, 'EXPIRE_CHUNK_SIZE', 10), \
+                mock.patch.object(tasks.clean, 'EXPIRE_TIME_BUDGET', 0):
+            assert tasks.expire_positions()['removed'] == 0
+        assert app.redis.zcard('geoindex_2') == 25
 
 
 class TestHandleHailTimeout:
@@ -215,7 +284,7 @@ class TestSendRequestOperator:
         assert hail.status == 'received_by_operator'
         assert hail.taxi_phone_number == taxi_phone_number
         # Make sure hail request is logged.
-        assert len(app.redis.zrange('hail:%s' % hail.id, 0, -1)) == 1
+        assert len(redis_backend.list_hail_logs(hail.id)) == 1
 
         # Check transition log
         assert hail.transition_log[-1]['from_status'] == 'received'
@@ -253,7 +322,7 @@ class TestSendRequestOperator:
         assert vehicle_description.status == 'free'
 
         # Check that failure is logged
-        assert len(app.redis.zrange('hail:%s' % hail_id, 0, -1)) == 1
+        assert len(redis_backend.list_hail_logs(hail_id)) == 1
 
         # Check transition log
         assert hail.transition_log[-1]['from_status'] == 'received'
@@ -293,7 +362,7 @@ class TestSendRequestOperator:
         assert vehicle_description.status == 'free'
 
         # Check that failure is logged
-        assert len(app.redis.zrange('hail:%s' % hail_id, 0, -1)) == 1
+        assert len(redis_backend.list_hail_logs(hail_id)) == 1
 
         # Check transition log
         assert hail.transition_log[-1]['from_status'] == 'received'
@@ -334,7 +403,7 @@ class TestSendRequestOperator:
         assert vehicle_description.status == 'free'
 
         # Check that failure is logged
-        assert len(app.redis.zrange('hail:%s' % hail_id, 0, -1)) == 1
+        assert len(redis_backend.list_hail_logs(hail_id)) == 1
 
         # Check transition log
         assert hail.transition_log[-1]['from_status'] == 'received'
@@ -343,6 +412,35 @@ class TestSendRequestOperator:
         assert hail.transition_log[-1]['user'] is None
 
 
+class TestArchiveHailLogs:
+    def test_ok(self, app):
+        redis_backend.log_hail('hail1', 'POST', {'data': 'xxx'}, None, hail_final_status='received')
+        redis_backend.log_hail('hail2', 'POST', {'data': 'yyy'}, None, hail_final_status='received')
+        redis_backend.log_hail('hail1', 'PUT', {'data': 'zzz'}, 'received', hail_final_status='failure')
+
+        ret = tasks.archive_hail_logs()
+        assert ret['archived'] == 3
+
+        logs = HailLog.query.filter(HailLog.hail_id == 'hail1').order_by(HailLog.time, HailLog.id).all()
+        assert [log.data['method'] for log in logs] == ['POST', 'PUT']
+        assert logs[1].data['payload'] == {'data': 'zzz'}
+
+        # Nothing left to archive
+        assert tasks.archive_hail_logs()['archived'] == 0
+
+    def test_not_acknowledged(self, app):
+        redis_backend.log_hail('hail1', 'POST', {'data': 'xxx'}, None)
+        # Delivered but the archiver crashed before acknowledging
+        entries = redis_backend.read_hail_logs(tasks.hail_logs.ARCHIVER_CONSUMER, 10)
+        assert len(entries) == 1
+        db.session.add(HailLog(id=entries[0].id, time=entries[0].time, hail_id='hail1', data={}))
+        db.session.commit()
+
+        # Delivered again, and inserted once
+        assert tasks.archive_hail_logs()['archived'] == 1
+        assert HailLog.query.count() == 1
+
+
 class TestStoreActiveTaxis:
     @staticmethod
     def _add_taxi(app, insee, lon, lat, operator):
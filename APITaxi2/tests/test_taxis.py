@@ -1,15 +1,20 @@
 from datetime import datetime, timedelta
 import time
+from unittest import mock
 
+import pytest
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import lazyload
 
+from APITaxi2 import fake_taxi_ids, location_store, redis_backend, schemas, search_cache, tasks
 from APITaxi2.exclusions import ExclusionHelper
-from APITaxi_models2 import Taxi, VehicleDescription
+from APITaxi_models2 import db, Taxi, VehicleDescription
 from APITaxi_models2.stats import StatsSearches
 from APITaxi_models2.unittest.factories import (
     ADSFactory,
     ExclusionFactory,
     DriverFactory,
+    HailFactory,
     TaxiFactory,
     TownFactory,
     VehicleFactory,
@@ -394,16 +399,24 @@ class TestTaxiPost:
 
 class TestTaxiSearch:
 
+    @pytest.fixture(params=[True, False], ids=['script', 'python'])
+    def search_script(self, request):
+        """Search with the script run by redis, or with the filters in
+        Python used when the geo indexes are sharded."""
+        with mock.patch.object(redis_backend, 'can_search_available_taxis', return_value=request.param):
+            yield request.param
+
     @staticmethod
     def _post_geotaxi(app, lon, lat, taxi, vehicle_description):
-        app.redis.geoadd(
-            'geoindex_2',
-            [
-                lon,
-                lat,
-                '%s:%s' % (taxi.id, vehicle_description.added_by.email)
-            ]
-        )
+        for key in ('geoindex_2', 'geoindex_insee:%s' % taxi.ads.insee):
+            app.redis.geoadd(
+                key,
+                [
+                    lon,
+                    lat,
+                    '%s:%s' % (taxi.id, vehicle_description.added_by.email)
+                ]
+            )
         app.redis.zadd(
             'timestamps', {
                 '%s:%s' % (taxi.id, vehicle_description.added_by.email): int(time.time()),
@@ -415,7 +428,7 @@ class TestTaxiSearch:
         resp = anonymous.client.get('/taxis')
         assert resp.status_code == 401
 
-    def test_ok(self, app, moteur, QueriesTracker):
+    def test_ok(self, app, moteur, QueriesTracker, search_script):
         ZUPCFactory()
         now = datetime.now()
 
@@ -458,8 +471,9 @@ class TestTaxiSearch:
 
         with QueriesTracker() as qtracker:
             resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
-            # SELECT permissions, SELECT TOWN, SELECT ZUPC, SELECT taxi, INSERT STATS
-            assert qtracker.count == 5
+            # SELECT permissions, SELECT taxi, INSERT STATS
+            # Towns and ZUPC are read from the index built by the first request
+            assert qtracker.count == 3
 
         assert resp.status_code == 200
         assert len(resp.json['data']) == 2
@@ -486,12 +500,16 @@ class TestTaxiSearch:
         # taxi_2 reports location with two operators. The default is "off", but
         # the non-default one returns a valid location.
         taxi_2_vehicle_descriptions_1.status = 'off'
+        # Changed behind the back of the API, forget the metadata read by the
+        # previous searches
+        redis_backend.clear_taxis_search_metadata()
         resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
         assert resp.status_code == 200
         assert len(resp.json['data']) == 2
 
         # Both operators are not free.
         taxi_2_vehicle_descriptions_2.status = 'occupied'
+        redis_backend.clear_taxis_search_metadata()
         resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
         assert resp.status_code == 200
         assert len(resp.json['data']) == 1
@@ -511,7 +529,41 @@ class TestTaxiSearch:
         # You can count seven client.get() above indeed
         assert StatsSearches.query.count() == 7
 
-    def test_ok_taxi_two_operators(self, app, moteur):
+    def test_limit(self, app, moteur, search_script):
+        app.config['TAXIS_SEARCH_OVER_FETCH'] = 1
+        ZUPCFactory()
+        lon, lat = 2.35, 48.86
+
+        taxis, descriptions = [], []
+        for i in range(3):
+            taxi = TaxiFactory()
+            description = VehicleDescription.query.filter_by(vehicle_id=taxi.vehicle_id).one()
+            self._post_geotaxi(app, lon + 0.0001 * (i + 1), lat, taxi, description)
+            taxis.append(taxi)
+            descriptions.append(description)
+
+        resp = moteur.client.get('/taxis?lon=%s&lat=%s&limit=2' % (lon, lat))
+        assert resp.status_code == 200
+        assert [taxi['id'] for taxi in resp.json['data']] == [taxis[0].id, taxis[1].id]
+
+        # The closest taxi is filtered out after the first search, search again
+        descriptions[0].status = 'off'
+        redis_backend.clear_taxis_search_metadata()
+        with mock.patch.object(
+            redis_backend, 'search_available_taxis', wraps=redis_backend.search_available_taxis
+        ) as search_available_taxis:
+            resp = moteur.client.get('/taxis?lon=%s&lat=%s&limit=2' % (lon, lat))
+        assert resp.status_code == 200
+        assert [taxi['id'] for taxi in resp.json['data']] == [taxis[1].id, taxis[2].id]
+        # The script only reads the closest locations too
+        if search_script:
+            assert [call.kwargs['count'] for call in search_available_taxis.call_args_list] == [2, 4]
+
+        resp = moteur.client.get('/taxis?lon=%s&lat=%s&limit=0' % (lon, lat))
+        assert resp.status_code == 400
+        assert 'limit' in resp.json['errors']
+
+    def test_ok_taxi_two_operators(self, app, moteur, search_script):
         """Taxi is registered with two operators, but reports its location with
         only one.
         """
@@ -564,7 +616,7 @@ class TestTaxiSearch:
         # No taxi should be returned.
         assert len(resp.json['data']) == 0
 
-    def test_ok_operateur(self, app, operateur):
+    def test_ok_operateur(self, app, operateur, search_script):
         app.config['FAKE_TAXI_ID'] = False
         ZUPCFactory()  # Paris
         TaxiFactory()  # Competitor
@@ -606,11 +658,12 @@ class TestTaxiSearch:
         self._post_geotaxi(app, lon, lat, taxi, vehicle_description)
         # Operators can see their own taxis, but under an anonymous ID
         resp = operateur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
-        taxi = Taxi.query.one()  # refresh to access fake_taxi_id
         assert resp.status_code == 200
         assert len(resp.json['data']) == 1
         assert resp.json['data'][0]['id'] != taxi.id
-        assert resp.json['data'][0]['id'] == taxi.fake_taxi_id
+        assert fake_taxi_ids.decode(operateur.user, resp.json['data'][0]['id']) == taxi.id
+        # Nothing written to redis
+        assert not app.redis.exists(f'fake_taxi_id:{operateur.user.email}')
         assert resp.json['data'][0]['operator'] == 'chauffeur professionnel'  # No exception
 
     def test_ok_moteur_and_operateur_fake_taxi_id(self, app, moteur_and_operateur):
@@ -623,11 +676,10 @@ class TestTaxiSearch:
         self._post_geotaxi(app, lon, lat, taxi, vehicle_description)
         # Operators also moteurs can see their own taxis, but under an anonymous ID
         resp = moteur_and_operateur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
-        taxi = Taxi.query.one()  # refresh to access fake_taxi_id
         assert resp.status_code == 200
         assert len(resp.json['data']) == 1
         assert resp.json['data'][0]['id'] != taxi.id
-        assert resp.json['data'][0]['id'] == taxi.fake_taxi_id
+        assert fake_taxi_ids.decode(moteur_and_operateur.user, resp.json['data'][0]['id']) == taxi.id
         assert resp.json['data'][0]['operator'] == 'chauffeur professionnel'  # No exception
 
     def test_ok_admin(self, app, admin):
@@ -650,7 +702,81 @@ class TestTaxiSearch:
         assert resp.json['data'][0]['id'] == taxi.id
         assert resp.json['data'][0]['operator'] == operateur
 
-    def test_radius(self, app, moteur):
+    def test_search_metadata(self, app, moteur, operateur, QueriesTracker, search_script):
+        app.config['FAKE_TAXI_ID'] = False
+        ZUPCFactory()
+        vehicle = VehicleFactory(descriptions=[])
+        vehicle_description = VehicleDescriptionFactory(vehicle=vehicle, added_by=operateur.user)
+        taxi = TaxiFactory(vehicle=vehicle, added_by=operateur.user)
+
+        lon, lat = 2.35, 48.86
+        self._post_geotaxi(app, lon, lat, taxi, vehicle_description)
+
+        # Read from the database the first time...
+        resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
+        assert resp.status_code == 200
+        assert [t['id'] for t in resp.json['data']] == [taxi.id]
+
+        # ... then from redis
+        with QueriesTracker() as qtracker:
+            resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
+            # SELECT permissions, INSERT STATS
+            assert qtracker.count == 2
+        assert [t['id'] for t in resp.json['data']] == [taxi.id]
+        assert resp.json['data'][0]['vehicle']['model'] == vehicle_description.model
+
+        # Changes made through the API are written to redis
+        resp = operateur.client.post('/vehicles', json={'data': [{
+            'licence_plate': vehicle.licence_plate,
+            'model': 'Zoe',
+        }]})
+        assert resp.status_code == 200
+        resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
+        assert resp.json['data'][0]['vehicle']['model'] == 'Zoe'
+
+        resp = operateur.client.put('/taxis/%s' % taxi.id, json={'data': [{'status': 'off'}]})
+        assert resp.status_code == 200
+        resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
+        assert resp.status_code == 200
+        assert resp.json['data'] == []
+
+        # Nothing is written to redis if the transaction fails
+        with mock.patch.object(db.session, 'commit', side_effect=SQLAlchemyError):
+            with pytest.raises(SQLAlchemyError):
+                operateur.client.put('/taxis/%s' % taxi.id, json={'data': [{'status': 'free'}]})
+        db.session.rollback()
+        resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
+        assert resp.status_code == 200
+        assert resp.json['data'] == []
+
+    def test_freed_by_hail(self, app, moteur, operateur, search_script):
+        app.config['FAKE_TAXI_ID'] = False
+        ZUPCFactory()
+        vehicle = VehicleFactory(descriptions=[])
+        vehicle_description = VehicleDescriptionFactory(vehicle=vehicle, added_by=operateur.user)
+        taxi = TaxiFactory(vehicle=vehicle, added_by=operateur.user)
+
+        lon, lat = 2.35, 48.86
+        self._post_geotaxi(app, lon, lat, taxi, vehicle_description)
+
+        resp = operateur.client.put('/taxis/%s' % taxi.id, json={'data': [{'status': 'occupied'}]})
+        assert resp.status_code == 200
+        resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
+        assert resp.status_code == 200
+        assert resp.json['data'] == []
+
+        # The end of the ride frees the taxi without PUT /taxis
+        hail = HailFactory(taxi=taxi, added_by=moteur.user, operateur=operateur.user, status='customer_on_board')
+        with mock.patch.object(tasks.handle_hail_timeout, 'apply_async'):
+            resp = operateur.client.put('/hails/%s' % hail.id, json={'data': [{'status': 'finished'}]})
+        assert resp.status_code == 200
+        assert VehicleDescription.query.get(vehicle_description.id).status == 'free'
+
+        resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
+        assert resp.status_code == 200
+        assert [t['id'] for t in resp.json['data']] == [taxi.id]
+
+    def test_radius(self, app, moteur, search_script):
         app.config['FAKE_TAXI_ID'] = False
         ZUPCFactory()
         now = datetime.now()
@@ -696,6 +822,49 @@ class TestTaxiSearch:
         assert resp.status_code == 200
         assert len(resp.json['data']) == 0
 
+    def test_cache(self, app, moteur, operateur, QueriesTracker, search_script):
+        app.config['FAKE_TAXI_ID'] = True
+        app.config['SEARCH_CACHE_TTL'] = 2
+        ZUPCFactory()
+        vehicle = VehicleFactory(descriptions=[])
+        vehicle_description = VehicleDescriptionFactory(vehicle=vehicle, added_by=operateur.user)
+        taxi = TaxiFactory(vehicle=vehicle)
+        lon, lat = 2.35, 48.86
+        self._post_geotaxi(app, lon, lat, taxi, vehicle_description)
+
+        resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
+        assert resp.status_code == 200
+        assert len(resp.json['data']) == 1
+
+        # The taxi left, but the search is answered from the cache, within the
+        # same cell of the grid
+        app.redis.delete('geoindex_2', 'geoindex_insee:%s' % taxi.ads.insee)
+        with mock.patch.object(location_store, 'get_location_store') as get_location_store, \
+                QueriesTracker() as qtracker:
+            resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon + 0.0001, lat))
+            assert not get_location_store.called
+            # SELECT permissions, INSERT stats
+            assert qtracker.count == 2
+        assert resp.status_code == 200
+        assert len(resp.json['data']) == 1
+        # Fake IDs are still computed for each request
+        assert fake_taxi_ids.decode(moteur.user, resp.json['data'][0]['id']) == taxi.id
+        assert StatsSearches.query.count() == 2
+
+        # Not for other users, nor other cells
+        resp = operateur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
+        assert resp.status_code == 200
+        assert len(resp.json['data']) == 0
+        resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon + 0.002, lat))
+        assert resp.status_code == 200
+        assert len(resp.json['data']) == 0
+
+        # Entries expire
+        with mock.patch.object(search_cache, 'time', **{'monotonic.return_value': time.monotonic() + 2}):
+            resp = moteur.client.get('/taxis?lon=%s&lat=%s' % (lon, lat))
+        assert resp.status_code == 200
+        assert len(resp.json['data']) == 0
+
     def test_exclusion(self, app, moteur, QueriesTracker):
         TownFactory(mulhouse=True)
         vehicle = VehicleFactory(descriptions=[])
@@ -723,6 +892,81 @@ class TestTaxiSearch:
         # No taxi should be returned.
         assert 'url' in resp.json['errors'], resp.json
 
+    def test_batch_invalid(self, anonymous, moteur):
+        resp = anonymous.client.post('/taxis/search', json={'data': [{'points': []}]})
+        assert resp.status_code == 401
+
+        resp = moteur.client.post('/taxis/search', json={'data': [{}]})
+        assert resp.status_code == 400
+        assert 'points' in resp.json['errors']['data']['0']
+
+        resp = moteur.client.post('/taxis/search', json={'data': [{
+            'points': [{'lon': 2.35, 'lat': 48.86}] * (schemas.TAXIS_SEARCH_BATCH_MAX_POINTS + 1),
+        }]})
+        assert resp.status_code == 400
+        assert 'points' in resp.json['errors']['data']['0']
+
+    def test_batch(self, app, moteur, QueriesTracker, search_script):
+        app.config['FAKE_TAXI_ID'] = False
+        ZUPCFactory()  # Paris
+        TownFactory(bordeaux=True)
+        TownFactory(mulhouse=True)
+        ExclusionFactory()
+        ExclusionHelper().reset()
+
+        paris = [(2.35, 48.86), (2.3505, 48.8602), (2.36, 48.87)]
+        for lon, lat in paris:
+            vehicle = VehicleFactory(descriptions=[])
+            vehicle_description = VehicleDescriptionFactory(vehicle=vehicle, last_update_at=datetime.now())
+            taxi = TaxiFactory(vehicle=vehicle)
+            self._post_geotaxi(app, lon, lat, taxi, vehicle_description)
+        bordeaux = (-0.57, 44.84)
+        vehicle = VehicleFactory(descriptions=[])
+        vehicle_description = VehicleDescriptionFactory(vehicle=vehicle)
+        taxi = TaxiFactory(ads__insee='33063', vehicle=vehicle)
+        self._post_geotaxi(app, *bordeaux, taxi, vehicle_description)
+
+        points = [
+            *paris,
+            bordeaux,
+            # EuroAirport Bâle-Mulhouse-Fribourg
+            (7.52637979704597, 47.5973205076925),
+            # Middle of the Atlantic ocean
+            (-30, 45),
+        ]
+        for limit in (None, 1):
+            body = {'points': [{'lon': lon, 'lat': lat} for lon, lat in points]}
+            if limit:
+                body['limit'] = limit
+            with QueriesTracker() as qtracker:
+                resp = moteur.client.post('/taxis/search', json={'data': [body]})
+                # SELECT permissions, SELECT the taxis missing from redis at
+                # once for all the points
+                if search_script:
+                    assert qtracker.count == (2 if limit is None else 1)
+            assert resp.status_code == 200
+            results = resp.json['data'][0]['points']
+            assert len(results) == len(points)
+
+            for (lon, lat), result in zip(points, results):
+                assert (result['lon'], result['lat']) == (lon, lat)
+                url = '/taxis?lon=%s&lat=%s' % (lon, lat)
+                if limit:
+                    url += '&limit=%s' % limit
+                expected = moteur.client.get(url)
+                if expected.status_code == 404:
+                    assert result['errors'] == expected.json['errors']
+                    assert 'data' not in result
+                else:
+                    assert result['data'] == expected.json['data']
+
+            assert [len(result.get('data', [])) for result in results] == (
+                [2, 2, 1, 1, 0, 0] if limit is None else [1, 1, 1, 1, 0, 0]
+            )
+
+        # Only the searches of GET /taxis which found a town are recorded
+        assert StatsSearches.query.count() == 8
+
 
 class TestTaxiList:
 
@@ -0,0 +1,50 @@
+from APITaxi2 import town_index
+from APITaxi_models2.unittest.factories import TownFactory, ZUPCFactory
+
+
+class TestTownIndex:
+    def test_get_towns_at(self, app):
+        TownFactory()
+        TownFactory(bordeaux=True)
+
+        index = town_index.get_town_index()
+        towns = index.get_towns_at(2.35, 48.86)
+        assert [(town.insee, town.name) for town in towns] == [('75056', 'Paris')]
+        assert index.get_zupcs(towns[0]) == []
+        assert index.get_allowed_insee_codes(towns[0]) == {'75056'}
+
+        # Middle of the Atlantic ocean
+        assert index.get_towns_at(-30, 45) == []
+
+        # Bordeaux, Paris and the ocean at once
+        towns = index.get_towns_at_points([-0.57, 2.35, -30], [44.84, 48.86, 45])
+        assert [[town.insee for town in point_towns] for point_towns in towns] == [['33063'], ['75056'], []]
+        assert index.get_towns_at_points([], []) == []
+
+    def test_zupc(self, app):
+        zupc = ZUPCFactory()
+        ZUPCFactory(bordeaux=True)
+
+        index = town_index.get_town_index()
+        town, = index.get_towns_at(2.35, 48.86)
+        assert [(z.id, z.zupc_id, z.nom) for z in index.get_zupcs(town)] == [(zupc.id, zupc.zupc_id, 'Paris')]
+        assert index.get_allowed_insee_codes(town) == {'75056', '94018'}
+
+    def test_reload(self, app):
+        TownFactory()
+        index = town_index.get_town_index()
+        assert town_index.get_town_index() is index
+
+        # Changes of the current process are seen immediately
+        ZUPCFactory()
+        index = town_index.get_town_index()
+        town, = index.get_towns_at(2.35, 48.86)
+        assert index.get_allowed_insee_codes(town) == {'75056', '94018'}
+
+        # Changes of other processes are seen once the version is increased
+        # and checked again
+        town_index.bump_version()
+        assert town_index.get_town_index() is index
+        app.extensions['town_index']['checked_at'] -= town_index.VERSION_CHECK_INTERVAL
+        assert town_index.get_town_index() is not index
+
@@ -1,3 +1,4 @@
+from APITaxi2 import town_index
 from APITaxi_models2.unittest.factories import (
     TownFactory,
     ZUPCFactory,
@@ -32,11 +33,13 @@ class TestZUPCList:
 
         zupc = ZUPCFactory()
         ZUPCFactory(bordeaux=True)  # Shouldn't appear in the results
+        # The index of the towns was reset by the new ZUPC, build it again
+        town_index.get_town_index()
 
         with QueriesTracker() as qtracker:
             resp = moteur.client.get('zupc?lon=2.35&lat=48.86')
-            # SELECT permissions, SELECT town, SELECT ZUPC
-            assert qtracker.count == 3
+            # SELECT permissions, SELECT ZUPC
+            assert qtracker.count == 2
 
         assert resp.status_code == 200
         assert resp.json['data'] == [{
@@ -0,0 +1,149 @@
+"""Index of the towns and ZUPC, to find the town at a location and the INSEE
+codes of the ADS allowed there without querying PostGIS.
+
+The index is built once per process, in the style of
+exclusions._load_exclusion_tree(), and built again when the commands
+importing towns and ZUPC increase the version stored in redis, see
+bump_version().
+"""
+
+from dataclasses import dataclass, field
+import time
+
+from flask import current_app, has_app_context
+from geoalchemy2.shape import to_shape
+import shapely
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from shapely.strtree import STRtree
+
+from APITaxi_models2 import db, Town, ZUPC
+from APITaxi_models2.zupc import town_zupc
+
+
+# Version of the towns and ZUPC, increased by the import commands
+VERSION_KEY = 'town_index_version'
+# The version in redis is read at most every VERSION_CHECK_INTERVAL seconds,
+# so an import is seen by all the processes after this delay.
+VERSION_CHECK_INTERVAL = 10
+
+
+@dataclass(frozen=True)
+class TownInfo:
+    id: int
+    insee: str
+    name: str
+
+
+@dataclass(frozen=True)
+class ZUPCInfo:
+    id: int
+    zupc_id: str
+    nom: str
+
+
+@dataclass
+class TownIndex:
+    """STRtree of the shapes of the towns, with the ZUPC of each town."""
+    towns: list
+    shapes: list
+    # {INSEE code: list of ZUPCInfo the town is part of}
+    zupcs: dict = field(default_factory=dict)
+    # {INSEE code: frozenset of the INSEE codes of the ADS allowed in the town}
+    allowed_insee_codes: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        # Prepared geometries make the intersection tests of the query faster
+        shapely.prepare(self.shapes)
+        self.tree = STRtree(self.shapes)
+
+    def get_towns_at(self, lon, lat):
+        """Return the list of TownInfo intersecting (lon, lat), usually one
+        unless the shapes of OSM overlap."""
+        indices = self.tree.query(shapely.Point(lon, lat), predicate='intersects')
+        return [self.towns[index] for index in sorted(indices)]
+
+    def get_towns_at_points(self, lons, lats):
+        """Vectorized get_towns_at(): return the list of TownInfo at each
+        point of the lists `lons` and `lats`."""
+        towns = [[] for _ in range(len(lons))]
+        # A single query of the tree for all the points returns the pairs
+        # (index of the point, index of the town) which intersect
+        point_indices, town_indices = self.tree.query(shapely.points(lons, lats), predicate='intersects')
+        for point_index, town_index in sorted(zip(point_indices.tolist(), town_indices.tolist())):
+            towns[point_index].append(self.towns[town_index])
+        return towns
+
+    def get_zupcs(self, town):
+        """Return the list of ZUPCInfo `town` is part of."""
+        return self.zupcs.get(town.insee, [])
+
+    def get_allowed_insee_codes(self, town):
+        """Return the INSEE codes of the ADS allowed in `town`: its own, plus
+        the ones of the towns of its ZUPC."""
+        return self.allowed_insee_codes.get(town.insee, frozenset((town.insee,)))
+
+
+def _load_town_index():
+    towns = []
+    shapes = []
+    for town_id, insee, name, shape in db.session.query(Town.id, Town.insee, Town.name, Town.shape).order_by(Town.id):
+        towns.append(TownInfo(id=town_id, insee=insee, name=name))
+        shapes.append(to_shape(shape))
+
+    zupcs = {}
+    members = {}
+    query = db.session.query(ZUPC.id, ZUPC.zupc_id, ZUPC.nom, Town.insee).join(
+        town_zupc, town_zupc.c.zupc_id == ZUPC.id
+    ).join(
+        Town, Town.id == town_zupc.c.town_id
+    ).order_by(ZUPC.id)
+    for zupc_pk, zupc_id, nom, insee in query:
+        zupc = ZUPCInfo(id=zupc_pk, zupc_id=str(zupc_id), nom=nom)
+        zupcs.setdefault(insee, []).append(zupc)
+        members.setdefault(zupc, set()).add(insee)
+
+    allowed_insee_codes = {
+        insee: frozenset((insee, *(member for zupc in town_zupcs for member in members[zupc])))
+        for insee, town_zupcs in zupcs.items()
+    }
+    return TownIndex(towns=towns, shapes=shapes, zupcs=zupcs, allowed_insee_codes=allowed_insee_codes)
+
+
+def _get_version():
+    version = current_app.redis.get(VERSION_KEY)
+    return int(version) if version else 0
+
+
+def get_town_index():
+    """Return the index of the current process, built again if the version in
+    redis changed."""
+    cached = current_app.extensions.get('town_index')
+    now = time.monotonic()
+    if cached and now - cached['checked_at'] < VERSION_CHECK_INTERVAL:
+        return cached['index']
+
+    version = _get_version()
+    if cached and cached['version'] == version:
+        cached['checked_at'] = now
+        return cached['index']
+
+    index = _load_town_index()
+    current_app.extensions['town_index'] = {'index': index, 'version': version, 'checked_at': now}
+    return index
+
+
+def bump_version():
+    """Called after towns or ZUPC are changed, so all the processes build their
+    index again."""
+    current_app.redis.incr(VERSION_KEY)
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_town_index(session, flush_context):
+    """The process writing towns or ZUPC sees its changes immediately, such as
+    the factories in tests. Other processes wait for bump_version()."""
+    if not has_app_context() or 'town_index' not in current_app.extensions:
+        return
+    if any(isinstance(obj, (Town, ZUPC)) for obj in (*session.new, *session.dirty, *session.deleted)):
+        del current_app.extensions['town_index']
@@ -1,12 +1,8 @@
-import socket
-import time
+import json
 
 from flask import Blueprint, current_app, request
-import redis
 
-from APITaxi_models2 import db, Taxi, Vehicle, VehicleDescription
-
-from .. import schemas
+from .. import processes, redis_backend, schemas
 from ..security import auth, current_user
 from ..validators import (
     make_error_json_response,
@@ -16,78 +12,8 @@ from ..validators import (
 
 blueprint = Blueprint('geotaxi', __name__)
 
-
-def _run_redis_action(pipe, action, *params):
-    action = getattr(pipe, action.lower())
-
-    # Run action
-    try:
-        action(*params)
-    except socket.error:
-        current_app.logger.error(
-            'Error while running redis action %s %s',
-            action.__name__.upper(),
-            ' '.join([str(param) for param in params])
-        )
-    except redis.RedisError as e:
-        current_app.logger.error(
-            'Error while running redis action %s %s %s',
-            action.__name__.upper(),
-            ' '.join([str(param) for param in params]),
-            e
-        )
-
-
-def _update_redis(pipe, data, operator):
-    now = int(time.time())
-    taxi_id = data['taxi_id']
-    # Hardcoded for backwards compatibility with the geotaxi worker
-    timestamp = now
-    # These fields are unused, fill them with whatever is expected
-    status = 'free'  # light status, the actual status is read from VehicleDescription
-    device = 'phone'
-    version = 2
-
-    # HSET taxi:<id>
-    _run_redis_action(
-        pipe,
-        'HSET',
-        f"taxi:{taxi_id}",
-        operator,
-        f"{timestamp} {data['lat']} {data['lon']} {status} {device} {version}",
-    )
-    # GEOADD geoindex (expired after two minutes by clean_geoindex_timestamps)
-    _run_redis_action(
-        pipe,
-        'GEOADD',
-        'geoindex',
-        [data['lon'], data['lat'], taxi_id],
-    )
-    # GEOADD geoindex_2 (expired after two minutes by clean_geoindex_timestamps)
-    _run_redis_action(
-        pipe,
-        'GEOADD',
-        'geoindex_2',
-        [data['lon'], data['lat'], f"{taxi_id}:{operator}"],
-    )
-    #
-    # We have to clean geoindex(_2) after two minutes, so we use the timestamp as a score
-    # but in another sorted set.
-    #
-    # ZADD timestamps (expired after two minutes by clean_geoindex_timestamps)
-    _run_redis_action(
-        pipe,
-        'ZADD',
-        'timestamps',
-        {f"{taxi_id}:{operator}": now},
-    )
-    # ZADD timestamps_id (expired after two minutes by clean_geoindex_timestamps)
-    _run_redis_action(
-        pipe,
-        'ZADD',
-        'timestamps_id',
-        {taxi_id: now},
-    )
+# POST /geotaxi/bulk stores positions by chunks of this size
+BULK_CHUNK_SIZE = 500
 
 
 @blueprint.route('/geotaxi/', methods=['POST'])
@@ -142,15 +68,8 @@ def geotaxi_batch():
     positions = data['positions']
     requested_taxi_ids = dict((position['taxi_id'], position) for position in positions)
 
-    valid_taxi_ids = {id_ for id_, in db.session.query(Taxi.id).join(Vehicle).join(VehicleDescription).filter(
-        Taxi.id.in_(requested_taxi_ids),
-        # For taxis registered with several operators, filter on the description,
-        # not the Taxi.added_by
-        VehicleDescription.added_by == current_user
-    ).all()}
-
     # Check all taxis are declared to us and belong to this operator
-    unknown_taxi_ids = set(requested_taxi_ids) - valid_taxi_ids
+    unknown_taxi_ids = processes.get_unknown_taxi_ids(current_user, requested_taxi_ids)
     if unknown_taxi_ids:
         validation_errors = {}
         for i, position in enumerate(positions):
@@ -161,9 +80,110 @@ def geotaxi_batch():
 
     # Record the new position
     # (we rejected the query on the slightest error, so the dict only contains valid data)
-    pipe = current_app.redis.pipeline()
-    for position in requested_taxi_ids.values():
-        _update_redis(pipe, position, current_user.email)
-    pipe.execute()
+    redis_backend.update_taxi_positions(
+        requested_taxi_ids.values(), current_user.email,
+        taxis_insee=processes.get_taxis_insee(requested_taxi_ids)
+    )
 
     return '', 200
+
+
+def _store_bulk_chunk(chunk, errors):
+    """`chunk` is a list of (line number, position). Store the positions of
+    the taxis owned by current_user, and report the others in `errors`.
+    Return the number of positions stored."""
+    unknown_taxi_ids = processes.get_unknown_taxi_ids(current_user, {position['taxi_id'] for _, position in chunk})
+    positions = []
+    for line_number, position in chunk:
+        if position['taxi_id'] in unknown_taxi_ids:
+            errors[line_number] = {'taxi_id': ["Identifiant de taxi inconnu"]}
+        else:
+            positions.append(position)
+    redis_backend.update_taxi_positions(
+        positions, current_user.email,
+        taxis_insee=processes.get_taxis_insee(position['taxi_id'] for position in positions)
+    )
+    return len(positions)
+
+
+@blueprint.route('/geotaxi/bulk', methods=['POST'])
+@auth.login_required(role=['admin', 'operateur'])
+def geotaxi_bulk():
+    """
+    ---
+    post:
+        tags:
+            - operator
+        summary: Update the position of thousands of taxis at once.
+        description: |
+            The body is newline-delimited JSON (Content-Type application/x-ndjson),
+            one position per line.
+
+            Unlike POST /geotaxi, invalid lines don't reject the whole request:
+            valid positions are stored, and errors are reported by line number.
+
+            Positions are in the WGS 84 or EPSG:3857 standard (the same as GPS).
+            Beware not to invert latitude (Y) and longitude (X)!
+        requestBody:
+            content:
+                application/x-ndjson:
+                    schema: GeotaxiPositionSchema
+                    example: |
+                        {"taxi_id": "cZQHY5q", "lat": 48.85998, "lon": 2.34998}
+                        {"taxi_id": "kF9XkQ2", "lat": 49.4396, "lon": 1.0945}
+        security:
+            - ApiKeyAuth: []
+        responses:
+            200:
+                description: Number of positions received and stored, and errors by line number.
+                content:
+                    application/json:
+                        schema: DataGeotaxiBulkSchema
+    """
+    if request.mimetype != 'application/x-ndjson':
+        return make_error_json_response({
+            '': ['Content-Type should be application/x-ndjson']
+        })
+
+    max_positions = current_app.config.get('GEOTAXI_BULK_MAX_POSITIONS', 10000)
+    position_schema = schemas.GeotaxiPositionSchema()
+    received = 0
+    stored = 0
+    errors = {}
+    chunk = []
+
+    # Positions are validated and stored by chunks while reading the request
+    for line_number, line in enumerate(request.stream, 1):
+        if not line.strip():
+            continue
+
+        received += 1
+        if received > max_positions:
+            errors[line_number] = {'': [f'Up to {max_positions} positions are accepted']}
+            break
+
+        try:
+            data = json.loads(line)
+        except ValueError:
+            errors[line_number] = {'': ['Not valid JSON.']}
+            continue
+
+        position, position_errors = validate_schema(position_schema, data)
+        if position_errors:
+            errors[line_number] = position_errors
+            continue
+
+        chunk.append((line_number, position))
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            stored += _store_bulk_chunk(chunk, errors)
+            chunk = []
+
+    if chunk:
+        stored += _store_bulk_chunk(chunk, errors)
+
+    schema = schemas.DataGeotaxiBulkSchema()
+    return schema.dump({'data': [{
+        'received': min(received, max_positions),
+        'stored': stored,
+        'errors': errors,
+    }]})
@@ -1,5 +1,4 @@
 from datetime import datetime, timedelta
-import json
 import time
 import uuid
 
@@ -11,7 +10,7 @@ from sqlalchemy.orm import aliased, joinedload
 from APITaxi_models2 import Customer, db, Hail, Taxi, User, Vehicle, VehicleDescription
 from APITaxi_models2.hail import HAIL_TERMINAL_STATUS
 
-from .. import activity_logs, redis_backend, schemas, tasks, processes, utils
+from .. import activity_logs, fake_taxi_ids, redis_backend, schemas, tasks, processes, utils
 from ..security import auth, current_user
 from ..validators import (
     make_error_json_response,
@@ -447,6 +446,7 @@ def hails_details(hail_id):
     args = params.get('data', [{}])[0]
 
     hail_initial_status = hail.status
+    taxi_initial_status = vehicle_description.status
 
     try:
         status_changed = _set_hail_status(
@@ -512,20 +512,27 @@ def hails_details(hail_id):
     ret = schema.dump({'data': [(hail, taxi_position, vehicle_description)]})
 
     vehicle_description_added_by_id = vehicle_description.added_by_id
+    taxi_id = hail.taxi_id
+    operator_email = hail.operateur.email
+    taxi_status = vehicle_description.status
 
     db.session.commit()
 
+    # The search trusts the metadata in redis, only write it once committed
+    if taxi_status != taxi_initial_status:
+        redis_backend.update_taxi_search_metadata(taxi_id, operator_email, status=taxi_status)
+
     # If the PUT request changed any field of the object, log the request. Do
     # nothing if the object didn't change.
     if status_changed or operateur_changes or moteur_changes:
         redis_backend.log_hail(
             hail_id=hail.id,
             http_method='PUT',
-            request_payload=json.dumps(request.json, indent=2),
+            request_payload=request.json,
             hail_initial_status=hail_initial_status,
             hail_final_status=hail.status,
             request_user=current_user,
-            response_payload=json.dumps(ret, indent=2),
+            response_payload=ret,
             response_status_code=200
         )
 
@@ -733,7 +740,10 @@ def hails_create():
     args = params['data'][0]
 
     if current_app.config.get('FAKE_TAXI_ID'):
-        real_taxi_id = redis_backend.get_real_taxi_id(current_user, args['taxi_id'])
+        real_taxi_id = fake_taxi_ids.decode(current_user, args['taxi_id'])
+        if real_taxi_id is None:
+            # Fake ID issued before they were signed, or real taxi ID
+            real_taxi_id = redis_backend.get_real_taxi_id(current_user, args['taxi_id'])
     else:
         real_taxi_id = args['taxi_id']
 
@@ -802,7 +812,8 @@ def hails_create():
             }
         }, status_code=400)
 
-    # Return error if location data is too old, more than 120 seconds.
+    # Return error if location data is too old, more than 120 seconds. The
+    # timestamp is the last one reported, even if the position was coalesced.
     if time.time() - taxi_position.timestamp > 120:
         return make_error_json_response({
             'data': {
@@ -888,11 +899,15 @@ def hails_create():
     hail_endpoint_production = hail.operateur.hail_endpoint_production
     operator_header_name = hail.operateur.operator_header_name
     operator_api_key = hail.operateur.operator_api_key
+    taxi_id = taxi.id
+    operator_email = vehicle_description.added_by.email
 
     activity_logs.log_customer_hail(customer.id, taxi.id, hail.id)
 
     db.session.commit()
 
+    redis_backend.update_taxi_search_metadata(taxi_id, operator_email, status='answering')
+
     tasks.send_request_operator.apply_async(args=[
         hail.id,
         hail_endpoint_production,
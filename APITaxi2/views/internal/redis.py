@@ -0,0 +1,21 @@
+from flask import Blueprint
+
+from APITaxi2 import auth
+from APITaxi2 import redis_clients
+
+
+blueprint = Blueprint('internal_redis', __name__)
+
+
+@blueprint.route('/internal/redis/pools', methods=['GET'])
+@auth.login_required(role=['admin'])
+def redis_pools():
+    """Connections in use and time spent waiting for a connection, for each
+    named redis client configured (see redis_clients). Stats are those of the
+    worker process answering the request."""
+    return {
+        'data': [
+            {'name': name, **stats}
+            for name, stats in sorted(redis_clients.get_stats().items())
+        ]
+    }
@@ -0,0 +1,30 @@
+from flask import Blueprint, current_app
+
+from APITaxi2 import auth
+from APITaxi2 import search_cache
+
+
+blueprint = Blueprint('internal_search_cache', __name__)
+
+
+@blueprint.route('/internal/search_cache', methods=['GET'])
+@auth.login_required(role=['admin'])
+def search_cache_stats():
+    """Hits and misses of the cache of GET /taxis (see search_cache), empty if
+    the cache is disabled.
+
+    The stats at the top level are those of the worker process answering the
+    request, and differ from one call to the next. "all_processes" adds up
+    the hits and misses of all the processes during the last minutes, flushed
+    to redis every few seconds: export this one as metrics.
+    """
+    cache = search_cache.get_search_cache()
+    if not cache:
+        return {'data': []}
+    cache.flush_stats(current_app.redis, force=True)
+    return {
+        'data': [{
+            **cache.get_stats(),
+            'all_processes': search_cache.get_global_stats(current_app.redis),
+        }]
+    }
@@ -1,4 +1,5 @@
 import collections
+import dataclasses
 from datetime import datetime, timedelta
 from functools import reduce
 import re
@@ -14,14 +15,14 @@ from APITaxi_models2 import (
     Departement,
     Driver,
     Taxi,
-    Town,
     Vehicle,
     VehicleDescription,
-    ZUPC,
 )
 from APITaxi_models2.stats import StatsSearches
 
-from .. import activity_logs, debug, redis_backend, schemas
+from .. import (
+    activity_logs, debug, fake_taxi_ids, location_store, redis_backend, schemas, search_cache, town_index,
+)
 from ..exclusions import ExclusionHelper
 from ..security import auth, current_user
 from ..utils import get_short_uuid
@@ -33,6 +34,9 @@ from ..validators import (
 
 blueprint = Blueprint('taxis', __name__)
 
+# With ?limit, GET /taxis reads this number of locations per taxi requested
+TAXIS_SEARCH_OVER_FETCH = 4
+
 LICENCE_PLATE_PATTERN = re.compile(r'^([a-z]+)?\ ?\-?([0-9]+)?\ ?\-?([a-z]+)?$', flags=re.IGNORECASE)
 
 
@@ -193,8 +197,19 @@ def taxis_create():
 
     ret = schema.dump({'data': [(taxi, vehicle_description)]})
 
+    # Every operator with a description of the vehicle can report the location
+    # of the new taxi
+    owners = [description.added_by.email for description in vehicle.descriptions] if status_code == 201 else []
+    taxi_id = taxi.id
+    # Built before the commit expires the objects
+    search_metadata = redis_backend.TaxiSearchMetadata.from_models(taxi, vehicle_description)
+
     db.session.commit()
 
+    for operator_email in owners:
+        redis_backend.add_owned_taxi_ids(operator_email, [taxi_id])
+    redis_backend.set_taxis_search_metadata([search_metadata])
+
     return ret, status_code
 
 
@@ -334,6 +349,9 @@ def taxis_details(taxi_id):
 
     args = params.get('data', [{}])[0]
 
+    # Written to redis once committed, the search trusts it
+    search_metadata = {}
+
     # For now it is only possible to update the taxi's status...
     if 'status' in args and args['status'] != vehicle_description.status:
         taxi.last_update_at = func.now()
@@ -345,24 +363,310 @@ def taxis_details(taxi_id):
         activity_logs.log_taxi_status(taxi_id, old_taxi_status, args['status'])
         db.session.flush()
 
-        redis_backend.set_taxi_availability(
-            taxi_id,
-            vehicle_description.added_by.email,
-            vehicle_description.status == 'free'
-        )
+        search_metadata.update(status=vehicle_description.status, last_update_at=datetime.now())
 
     # ... and the radius where the taxi is visible
     if 'radius' in args and args['radius'] != vehicle_description.radius:
         vehicle_description.radius = args['radius']
         db.session.flush()
 
+        search_metadata['radius'] = vehicle_description.radius
+
     output = schema.dump({'data': [(taxi, vehicle_description, location)]})
+    operator_email = vehicle_description.added_by.email
 
     db.session.commit()
 
+    if 'status' in search_metadata:
+        redis_backend.set_taxi_availability(taxi_id, operator_email, search_metadata['status'] == 'free')
+    if search_metadata:
+        redis_backend.update_taxi_search_metadata(taxi_id, operator_email, **search_metadata)
+
     return output
 
 
+def _load_taxis_search_metadata(taxi_ids):
+    """Read the search metadata of the taxis `taxi_ids` from the database,
+    for all their operators, and store it in redis for the next searches.
+    Return the list of redis_backend.TaxiSearchMetadata."""
+    query = db.session.query(Taxi, VehicleDescription).options(
+        joinedload(Taxi.ads),
+        joinedload(Taxi.vehicle),
+        joinedload(VehicleDescription.added_by),
+    ).filter(
+        VehicleDescription.vehicle_id == Taxi.vehicle_id
+    ).filter(
+        Taxi.id.in_(taxi_ids)
+    )
+    records = [
+        redis_backend.TaxiSearchMetadata.from_models(taxi, vehicle_description)
+        for taxi, vehicle_description in query.all()
+    ]
+    redis_backend.set_taxis_search_metadata(records)
+    return records
+
+
+def _only_own_taxis():
+    """Users that are only operateur can't see but their own taxis. Users
+    that are both operateur and moteur can see all as expected."""
+    return not current_user.has_role('moteur') and not current_user.has_role('admin')
+
+
+def _get_taxis_operators(locations):
+    """Return the list of (<taxi_id>, <operator>) of `locations`."""
+    return [
+        (taxi_id, operator)
+        for taxi_id, operators in locations.items()
+        for operator in operators
+    ]
+
+
+def _get_taxis_search_metadata(taxis_operators):
+    """Return the metadata of the pairs (<taxi_id>, <operator>) of
+    `taxis_operators`, as a dictionary {(<taxi_id>, <operator>): <metadata>}.
+
+    The metadata is read from redis, and only the taxis missing from redis
+    are read from the database.
+    """
+    records = redis_backend.get_taxis_search_metadata(taxis_operators)
+    missing_taxi_ids = {taxi_id for taxi_id, operator in taxis_operators if (taxi_id, operator) not in records}
+    if missing_taxi_ids:
+        for record in _load_taxis_search_metadata(missing_taxi_ids):
+            records.setdefault((record.taxi_id, record.operator), record)
+    return records
+
+
+def _get_available_taxis(locations, allowed_insee_codes, records=None):
+    """Return the taxis of `locations` (see
+    location_store.LocationStore.search()) available for the current
+    user, as a dictionary {<taxi_id>: (<metadata>, <location>)} where
+    <metadata> is a redis_backend.TaxiSearchMetadata.
+
+    The metadata is read by _get_taxis_search_metadata(), unless `records`,
+    its result for these locations or more, is given.
+    """
+    taxis_operators = _get_taxis_operators(locations)
+    if records is None:
+        records = _get_taxis_search_metadata(taxis_operators)
+
+    only_own_taxis = _only_own_taxis()
+
+    # Create data as a dictionary such as:
+    #
+    # {
+    #   <taxi_id>: [(<metadata>, <location>), ...]
+    # }
+    #
+    # The metadata holds the link between the taxi and an operator.
+    data = collections.defaultdict(list)
+    now = datetime.now()
+    # If a taxi has two VehicleDescription but only reports its location
+    # with one operator, there is only the record of this operator.
+    for taxi_id, operator in taxis_operators:
+        metadata = records.get((taxi_id, operator))
+        if metadata is None:
+            continue
+
+        # Removes taxis with an ADS located in another ZUPC than the one where
+        # the request is made. For example, if a taxi from Bordeaux reports
+        # its location in Paris, we don't want it returned for a request in Paris.
+        if metadata.insee not in allowed_insee_codes:
+            continue
+
+        # For taxis registered with several operators, filter on the operator,
+        # not the Taxi.added_by
+        if only_own_taxis and operator != current_user.email:
+            continue
+
+        # Only keep if the taxi is available
+        if metadata.status != 'free':
+            continue
+
+        # For each location reported, only keep if the location has been reported
+        # less than 120 seconds ago
+        location = locations[taxi_id][operator]
+        if not location.update_date:
+            continue
+        if location.update_date + timedelta(seconds=120) < now:
+            continue
+
+        data[taxi_id].append((metadata, location))
+
+    # For each taxi, only keep the operator with the latest update date.
+    # If a taxi reports its location from 2 different operators, we will always
+    # return the data from the same operator.
+    data = {
+        taxi_id: reduce(
+            lambda a, b:
+                a if a[0].last_update_at
+                and b[0].last_update_at
+                and a[0].last_update_at >= b[0].last_update_at
+                else b,
+                data[taxi_id]
+        )
+        for taxi_id in data
+    }
+    return data
+
+
+def _is_in_reach(metadata, location):
+    """Filter out of reach taxis based on each driver's preference"""
+    return location.distance <= (metadata.radius or schemas.TAXI_MAX_RADIUS)
+
+
+def _get_search_count(params):
+    """Return the tuple (<count>, <factor>): the number of locations read
+    first from each geo index for ?limit of `params`, None if there is no
+    limit, and the factor to read more of them if needed. The count must grow
+    for the search to end, even if TAXIS_SEARCH_OVER_FETCH is 1."""
+    limit = params.get('limit')
+    over_fetch = current_app.config.get('TAXIS_SEARCH_OVER_FETCH') or TAXIS_SEARCH_OVER_FETCH
+    return (limit * over_fetch if limit else None), max(over_fetch, 2)
+
+
+def _should_search_again(params, truncated, in_reach, count, debug_ctx):
+    """Whether to search again with a higher count: some locations might
+    have been left out, and less than ?limit taxis in reach were found."""
+    if not truncated or in_reach >= params['limit']:
+        return False
+    debug_ctx.log(f'Only {in_reach} taxis in reach in the {count} closest locations, search again')
+    return True
+
+
+def _search_locations(store, params, allowed_insee_codes, debug_ctx):
+    """Search the locations of `store` around the location of `params`, and
+    filter them in Python.
+
+    Return a tuple (<data>, <taxis found>, <closest taxi>), where data is the
+    list of (<metadata>, <location>) of the taxis in reach, and the last two
+    elements are the number of taxis available, in reach or not, and the
+    distance of the closest one, for the stats.
+    """
+    # Locations is a dict containing taxis close from the location given as
+    # param. Each taxi can report its location from several operators.
+    #
+    # locations = {
+    #    <taxi_id>: {
+    #       <operator_id>: <location>,
+    #       <operator_id>: <location>,
+    #    }, ...
+    # }
+    #
+    # Only taxis allowed at this location are read from the geo indexes by
+    # INSEE code, of redis or of the memory of the process, see
+    # location_store.get_location_store().
+    #
+    # With ?limit, only the closest locations are read, a few times more than
+    # the limit as some taxis are filtered out below. If not enough taxis are
+    # left while more locations might be within the radius, search again with
+    # a higher count.
+    count, over_fetch = _get_search_count(params)
+    while True:
+        locations = store.search(
+            # Experiment a wider radius (taxis will still be filtered out following their preference later on)
+            params['lon'], params['lat'], schemas.TAXI_MAX_RADIUS * 2,
+            insee_codes=allowed_insee_codes,
+            count=count
+        )
+        debug_ctx.log_admin(
+            f'List of taxis around lon={params["lon"]} lat={params["lat"]}',
+            locations
+        )
+        data = _get_available_taxis(locations, allowed_insee_codes)
+        in_reach = sum(1 for metadata, location in data.values() if _is_in_reach(metadata, location))
+        if not _should_search_again(params, store.is_truncated(locations, count), in_reach, count, debug_ctx):
+            break
+        count *= over_fetch
+
+    # Stats: keep track of the number of available taxis, and the distance to the closest one
+    taxis_found = len(data)
+    if taxis_found:
+        closest_taxi = min(redis_location.distance for (_, redis_location) in data.values())
+    else:
+        closest_taxi = None
+
+    # Filter out taxis outside the legal radius, or outside their custom radius
+    # Plus schema.dump expects a list of tuples (metadata, location).
+    data = [
+        (metadata, redis_location)
+        for metadata, redis_location in data.values()
+        # Filter out of reach taxis based on each driver's preference
+        if _is_in_reach(metadata, redis_location)
+    ]
+    return data, taxis_found, closest_taxi
+
+
+def _search_available_taxis(params, allowed_insee_codes, debug_ctx, count=None):
+    """Same as _search_locations(), but the locations are filtered by a single
+    script run by redis, see redis_backend.search_available_taxis(). Only the
+    taxis whose metadata is not in redis yet are filtered in Python.
+
+    With ?limit, `count` locations are read first from each geo index, by
+    default the count of _get_search_count()."""
+    default_count, over_fetch = _get_search_count(params)
+    count = count or default_count
+    while True:
+        result = redis_backend.search_available_taxis(
+            # Experiment a wider radius (taxis will still be filtered out following their preference later on)
+            params['lon'], params['lat'], schemas.TAXI_MAX_RADIUS * 2,
+            allowed_insee_codes,
+            min_update_date=datetime.now() - timedelta(seconds=120),
+            default_radius=schemas.TAXI_MAX_RADIUS,
+            operator=current_user.email if _only_own_taxis() else None,
+            count=count,
+        )
+        data, taxis_found, closest_taxi = _add_unresolved_taxis(params, result, allowed_insee_codes, debug_ctx)
+        if not _should_search_again(params, result.truncated, len(data), count, debug_ctx):
+            break
+        count *= over_fetch
+    return data, taxis_found, closest_taxi
+
+
+def _add_unresolved_taxis(params, result, allowed_insee_codes, debug_ctx, records=None):
+    """Return the result of _search_available_taxis() from the
+    redis_backend.AvailableTaxis `result`, with the taxis whose metadata was
+    not in redis, see _get_available_taxis() for `records`."""
+    debug_ctx.log_admin(
+        f'List of taxis available around lon={params["lon"]} lat={params["lat"]}',
+        {taxi_id: location for taxi_id, (_, location) in result.taxis.items()}
+    )
+    data = list(result.taxis.values())
+    taxis_found = result.found
+    closest_taxi = result.closest
+
+    if result.unresolved:
+        debug_ctx.log_admin('List of taxis without metadata in redis', result.unresolved)
+        unresolved = _get_available_taxis(result.unresolved, allowed_insee_codes, records)
+        taxis_found += len(unresolved)
+        closest_taxi = min(
+            [distance for distance in [closest_taxi] if distance is not None]
+            + [redis_location.distance for _, redis_location in unresolved.values()],
+            default=None
+        )
+        data.extend(
+            (metadata, redis_location)
+            for metadata, redis_location in unresolved.values()
+            if _is_in_reach(metadata, redis_location)
+        )
+    return data, taxis_found, closest_taxi
+
+
+def _limit_search_results(data, limit):
+    """Return the `limit` first taxis of `data`, sorted by distance, to dump
+    with schemas.SearchTaxiSchema."""
+    if limit:
+        data = data[:limit]
+
+    # Replace real taxi ID by a temporary ID, decoded when the taxi is hailed.
+    # The metadata might be shared with other requests by the cache, copy it.
+    if current_app.config.get('FAKE_TAXI_ID'):
+        data = [
+            (dataclasses.replace(metadata, fake_taxi_id=fake_taxi_ids.encode(current_user, metadata.taxi_id)), location)
+            for metadata, location in data
+        ]
+    return data
+
+
 @blueprint.route('/taxis', methods=['GET'])
 @auth.login_required(role=['admin', 'moteur', 'operateur'])
 def taxis_search():
@@ -375,13 +679,20 @@ def taxis_search():
         To retrieve the longitude and latitude of taxis:
             - geoindex: HSET key = <taxi_id>
             - geoindex_2: HSET key = <taxi_id:operator_id>
+            - geoindex_insee:<insee>: HSET key = <taxi_id:operator_id>, only
+              for taxis with an ADS of the town <insee>
 
         To retrieve last time the update request has been received:
             - timestamps: HSET key = <taxi_id:operator_id>
             - timestamps_id: HSET key = <taxi_id>
 
     * when a taxi turns off with PUT /taxis { status: off }, the entry
-    "<taxi_id:operator_id>" is appended to the set not_available.
+    "<taxi_id:operator_id>" is appended to the set not_available. The search
+    doesn't read it: the status is read with the metadata below.
+
+    * the status, ADS and vehicle of each taxi are read from the hashes
+    taxi_search:<taxi_id>:<operator_id>, see
+    redis_backend.TaxiSearchMetadata, and from the database if missing.
     ---
     get:
       tags:
@@ -428,10 +739,9 @@ def taxis_search():
             'url': ['No cruising allowed in this area'],
         }, status_code=404)
 
-    # First ask in what town the customer is
-    towns = Town.query.filter(
-        func.ST_Intersects(Town.shape, 'POINT({lon} {lat})'.format(**params)),
-    ).all()  # Shouldn't happen but in case geometries overlap on OSM
+    # First ask in what town the customer is, from the index in memory
+    index = town_index.get_town_index()
+    towns = index.get_towns_at(params['lon'], params['lat'])  # Shouldn't happen but in case geometries overlap on OSM
     debug_ctx.log(f'Towns matching lon={params["lon"]} lat={params["lat"]}: {towns}')
 
     if not towns:
@@ -439,13 +749,9 @@ def taxis_search():
         return schema.dump({'data': []})
     town = towns[0]
 
-    # Now ask the potential ZUPCs the town is part of
+    # Now the potential ZUPCs the town is part of
     # There may be several: union of towns, airport, TGV station...
-    zupcs = ZUPC.query.options(
-        joinedload(ZUPC.allowed)
-    ).filter(
-        ZUPC.allowed.contains(town)
-    ).all()
+    zupcs = index.get_zupcs(town)
     debug_ctx.log(f'List of zupcs matching lon={params["lon"]} lat={params["lat"]}', [{
         'id': zupc.id,
         'nom': zupc.nom
@@ -453,114 +759,38 @@ def taxis_search():
 
     # Now we know the taxis allowed at this position are the ones from this town
     # plus the potential other taxis from the ZUPC
-    allowed_insee_codes = {town.insee, *(town.insee for zupc in zupcs for town in zupc.allowed)}
-
-    # Locations is a dict containing taxis close from the location given as
-    # param. Each taxi can report its location from several operators.
-    #
-    # locations = {
-    #    <taxi_id>: {
-    #       <operator_id>: <location>,
-    #       <operator_id>: <location>,
-    #    }, ...
-    # }
-    #
-    locations = redis_backend.taxis_locations_by_operator(
-        # Experiment a wider radius (taxis will still be filtered out following their preference later on)
-        params['lon'], params['lat'], schemas.TAXI_MAX_RADIUS * 2
-    )
-    debug_ctx.log_admin(
-        f'List of taxis around lon={params["lon"]} lat={params["lat"]}',
-        locations
-    )
-
-    # Fetch all Taxi and VehicleDescriptions objects related to "locations".
-    query = db.session.query(Taxi, VehicleDescription).join(
-        ADS
-    ).options(
-        joinedload(Taxi.vehicle).joinedload(Vehicle.descriptions).joinedload(VehicleDescription.added_by),
-        joinedload(Taxi.added_by),
-    ).filter(
-        VehicleDescription.vehicle_id == Taxi.vehicle_id
-    ).filter(
-        Taxi.id.in_(locations.keys()),
-        # Removes taxis with an ADS located in another ZUPC than the one where
-        # the request is made. For example, if a taxi from Bordeaux reports
-        # its location in Paris, we don't want it returned for a request in Paris.
-        ADS.insee.in_(allowed_insee_codes)
-    )
-
-    # Users that are only operateur can't see but their own taxis
-    # Users that are both operateur and moteur can see all as expected
-    if not current_user.has_role('moteur') and not current_user.has_role('admin'):
-        # For taxis registered with several operators, filter on the description,
-        # not the Taxi.added_by
-        query = query.filter(VehicleDescription.added_by == current_user)
-
-    # Create data as a dictionary such as:
-    #
-    # {
-    #   <taxi>: {
-    #     <vehicle_description>: <location>
-    #     ...
-    #   }
-    # }
-    #
-    # VehicleDescription holds the link between the taxi object and an operator.
-    data = collections.defaultdict(dict)
-    now = datetime.now()
-    for taxi, vehicle_description in query.all():
-        # If a taxi has two VehicleDescription but only reports its location
-        # with one operator, the query above will return 2 rows.
-        # Skip the VehicleDescription if we don't have location for it.
-        if vehicle_description.added_by.email not in locations[taxi.id]:
-            continue
-
-        # Only keep if the taxi is available
-        if vehicle_description.status != 'free':
-            continue
-
-        # For each location reported, only keep if the location has been reported
-        # less than 120 seconds ago
-        location = locations[taxi.id][vehicle_description.added_by.email]
-        if not location.update_date:
-            continue
-        if location.update_date + timedelta(seconds=120) < now:
-            continue
-
-        data[taxi][vehicle_description] = location
-
-    # For each taxi, only keep the VehicleDescription with the latest
-    # update date.
-    # If a taxi reports its location from 2 different operators, we will always
-    # return the data from the same operator.
-    data = {
-        taxi: reduce(
-            lambda a, b:
-                a if a[0].last_update_at
-                and b[0].last_update_at
-                and a[0].last_update_at >= b[0].last_update_at
-                else b,
-                data[taxi].items()
+    allowed_insee_codes = index.get_allowed_insee_codes(town)
+
+    # Repeated searches around the same location are answered from the
+    # cache, if enabled
+    cache = search_cache.get_search_cache()
+    cached = None
+    if cache:
+        cache_key = cache.make_key(
+            current_user.email, _only_own_taxis(), town.insee, params['lon'], params['lat'], params.get('limit')
         )
-        for taxi in data
-    }
+        cached = cache.get(cache_key)
 
-    # Stats: keep track of the number of available taxis, and the distance to the closest one
-    taxis_found = len(data)
-    if taxis_found:
-        closest_taxi = min(redis_location.distance for (_, redis_location) in data.values())
+    if cached is not None:
+        debug_ctx.log('Taxis found by a recent search of the cache')
+        data, taxis_found, closest_taxi = cached
     else:
-        closest_taxi = None
+        # Search the taxis available in reach. Only taxis allowed at this location
+        # are searched, from the geo indexes by INSEE code. If the locations are
+        # stored in redis, the whole search is made by redis.
+        store = location_store.get_location_store()
+        if isinstance(store, location_store.RedisLocationStore) and redis_backend.can_search_available_taxis():
+            data, taxis_found, closest_taxi = _search_available_taxis(params, allowed_insee_codes, debug_ctx)
+        else:
+            data, taxis_found, closest_taxi = _search_locations(store, params, allowed_insee_codes, debug_ctx)
 
-    # Filter out taxis outside the legal radius, or outside their custom radius
-    # Plus schema.dump expects a list of tuples (taxi, vehicle_description, location).
-    data = [
-        (taxi, vehicle_description, redis_location)
-        for taxi, (vehicle_description, redis_location) in data.items()
-        # Filter out of reach taxis based on each driver's preference
-        if redis_location.distance <= (vehicle_description.radius or schemas.TAXI_MAX_RADIUS)
-    ]
+        # Sort entries by distance.
+        data = sorted(
+            data,
+            key=lambda o: o[1].distance
+        )
+        if cache:
+            cache.set(cache_key, (data, taxis_found, closest_taxi))
 
     # Stats: store client search results
     stats_search = StatsSearches(
@@ -576,27 +806,146 @@ def taxis_search():
     )
     db.session.add(stats_search)
 
-    # Sort entries by distance.
-    data = sorted(
-        data,
-        key=lambda o: o[2].distance
-    )
-
-    # Replace real taxi ID by a temporary ID
-    if current_app.config.get('FAKE_TAXI_ID'):
-        fake_taxi_ids = {}
-        for taxi, _, _ in data:
-            taxi.fake_taxi_id = get_short_uuid()
-            fake_taxi_ids[taxi.fake_taxi_id] = taxi.id
-        if fake_taxi_ids:
-            # Use the current user as a key, blindly overwrite on subsequent searches
-            redis_backend.set_fake_taxi_ids(current_user, fake_taxi_ids)
+    data = _limit_search_results(data, params.get('limit'))
 
     response = debug_ctx.add_to_response(schema.dump({'data': data}))
     db.session.commit()
     return response
 
 
+def _search_available_taxis_many(searches, debug_ctx):
+    """Same as _search_available_taxis() or _search_locations() for each
+    (<params>, <allowed INSEE codes>) of `searches`. Return the list of the
+    results, in the same order.
+
+    If the whole search is made by redis, the scripts of all the searches are
+    sent in a single pipeline, and the metadata missing from redis is read at
+    once for all of them.
+    """
+    store = location_store.get_location_store()
+    if not isinstance(store, location_store.RedisLocationStore) or not redis_backend.can_search_available_taxis():
+        return [
+            _search_locations(store, params, allowed_insee_codes, debug_ctx)
+            for params, allowed_insee_codes in searches
+        ]
+
+    counts = [_get_search_count(params) for params, _ in searches]
+    results = redis_backend.search_available_taxis_many(
+        [
+            # Experiment a wider radius (taxis will still be filtered out following their preference later on)
+            (params['lon'], params['lat'], schemas.TAXI_MAX_RADIUS * 2, allowed_insee_codes, count)
+            for (params, allowed_insee_codes), (count, _) in zip(searches, counts)
+        ],
+        min_update_date=datetime.now() - timedelta(seconds=120),
+        default_radius=schemas.TAXI_MAX_RADIUS,
+        operator=current_user.email if _only_own_taxis() else None,
+    )
+    taxis_operators = list(dict.fromkeys(
+        taxi_operator
+        for result in results
+        for taxi_operator in _get_taxis_operators(result.unresolved)
+    ))
+    records = _get_taxis_search_metadata(taxis_operators) if taxis_operators else {}
+    ret = []
+    for (params, allowed_insee_codes), result, (count, over_fetch) in zip(searches, results, counts):
+        found = _add_unresolved_taxis(params, result, allowed_insee_codes, debug_ctx, records)
+        # Too few taxis in the closest locations, search this point again alone
+        if _should_search_again(params, result.truncated, len(found[0]), count, debug_ctx):
+            found = _search_available_taxis(params, allowed_insee_codes, debug_ctx, count=count * over_fetch)
+        ret.append(found)
+    return ret
+
+
+@blueprint.route('/taxis/search', methods=['POST'])
+@auth.login_required(role=['admin', 'moteur', 'operateur'])
+def taxis_search_batch():
+    """Get the taxis around several locations at once.
+
+    The result of each location is the same as GET /taxis, but the towns of
+    all the locations are found at once, the geo indexes are searched in a
+    single round-trip to redis, and the metadata missing from redis is read
+    with a single query. Searches are not recorded in StatsSearches, this
+    endpoint is meant to check the supply of taxis rather than by customers.
+    ---
+    post:
+      tags:
+        - both
+      summary: List available taxis around several locations.
+      description: |
+        Same as GET /taxis for up to 100 locations. For each location, either
+        "data" or "errors" is returned, as GET /taxis would at this location.
+      requestBody:
+        content:
+          application/json:
+            schema: DataSearchTaxisBatchSchema
+            example:
+              {
+                "data": [
+                  {
+                    "points": [
+                      {"lon": 2.3735, "lat": 48.8447},
+                      {"lon": 2.3554, "lat": 48.8809}
+                    ],
+                    "limit": 10
+                  }
+                ]
+              }
+      security:
+        - ApiKeyAuth: []
+      responses:
+        200:
+          description: List of available taxis around each location.
+          content:
+            application/json:
+              schema: DataSearchTaxisBatchResultSchema
+    """
+    debug_ctx = debug.DebugContext()
+
+    schema = schemas.DataSearchTaxisBatchSchema()
+    params, errors = validate_schema(schema, request.json)
+    if errors:
+        return make_error_json_response(errors)
+
+    args = params['data'][0]
+    points = args['points']
+    lons = [point['lon'] for point in points]
+    lats = [point['lat'] for point in points]
+
+    # Same as GET /taxis at each point, for all the points at once
+    excluded = ExclusionHelper().are_at_excluded_zones(lons, lats)
+    index = town_index.get_town_index()
+    towns = index.get_towns_at_points(lons, lats)
+
+    results = [{'lon': point['lon'], 'lat': point['lat'], 'data': []} for point in points]
+    searches = []
+    for result, point_excluded, point_towns in zip(results, excluded, towns):
+        if point_excluded:
+            del result['data']
+            result['errors'] = {'url': ['No cruising allowed in this area']}
+            continue
+        if not point_towns:
+            continue
+        point_params = {'lon': result['lon'], 'lat': result['lat']}
+        if args.get('limit'):
+            point_params['limit'] = args['limit']
+        searches.append((result, point_params, index.get_allowed_insee_codes(point_towns[0])))
+
+    found = _search_available_taxis_many(
+        [(point_params, allowed_insee_codes) for _, point_params, allowed_insee_codes in searches],
+        debug_ctx
+    )
+    for (result, point_params, _), (data, _, _) in zip(searches, found):
+        # Sort entries by distance.
+        data = sorted(
+            data,
+            key=lambda o: o[1].distance
+        )
+        result['data'] = _limit_search_results(data, point_params.get('limit'))
+
+    schema = schemas.DataSearchTaxisBatchResultSchema()
+    return debug_ctx.add_to_response(schema.dump({'data': [{'points': results}]}))
+
+
 @blueprint.route('/taxis/all', methods=['GET'])
 @auth.login_required(role=['operateur'])
 def taxis_list():
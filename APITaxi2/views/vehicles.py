@@ -4,11 +4,12 @@ from sqlalchemy import func
 
 from APITaxi_models2 import (
     db,
+    Taxi,
     Vehicle,
     VehicleDescription,
 )
 
-from .. import schemas
+from .. import redis_backend, schemas
 from ..security import auth, current_user
 from ..validators import (
     make_error_json_response,
@@ -139,8 +140,33 @@ def vehicle_create():
         if arg_name in args:
             setattr(vehicle_description, model_name, args[arg_name])
 
+    # Taxis already registered with this vehicle by other operators can now
+    # report their location with the current user.
+    owned_taxi_ids = set()
+    if http_code == 201 and vehicle.id is not None:
+        owned_taxi_ids = {id_ for id_, in db.session.query(Taxi.id).filter(Taxi.vehicle_id == vehicle.id)}
+    operator_email = current_user.email
+
+    # The search metadata of the taxis already registered with this vehicle
+    # needs to be updated.
+    updated_taxi_ids = set()
+    search_metadata = {}
+    if http_code == 200:
+        updated_taxi_ids = {id_ for id_, in db.session.query(Taxi.id).filter(Taxi.vehicle_id == vehicle.id)}
+        search_metadata = {
+            'model': vehicle_description.model,
+            'constructor': vehicle_description.constructor,
+            'nb_seats': vehicle_description.nb_seats,
+            'engine': vehicle_description.engine,
+            'characteristics': vehicle_description.characteristics,
+        }
+
     ret = schema.dump({'data': [(vehicle, vehicle_description)]})
 
     db.session.commit()
 
+    redis_backend.add_owned_taxi_ids(operator_email, owned_taxi_ids)
+    for taxi_id in updated_taxi_ids:
+        redis_backend.update_taxi_search_metadata(taxi_id, operator_email, **search_metadata)
+
     return ret, http_code
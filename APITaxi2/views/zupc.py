@@ -2,7 +2,7 @@ import functools
 import json
 
 from flask import Blueprint, request
-from sqlalchemy import cast, func, or_
+from sqlalchemy import cast, func
 
 from geoalchemy2 import Geometry
 
@@ -11,6 +11,7 @@ from APITaxi_models2.zupc import town_zupc
 
 from .. import stats_backend
 from .. import schemas
+from .. import town_index
 from ..security import auth, current_user
 from ..validators import (
     make_error_json_response,
@@ -58,23 +59,28 @@ def zupc_list():
 
     schema = schemas.DataZUPCSchema()
 
-    towns = Town.query.filter(
-        func.ST_Intersects(Town.shape, 'POINT({lon} {lat})'.format(**args)),
-    ).all()
+    index = town_index.get_town_index()
+    town_infos = index.get_towns_at(args['lon'], args['lat'])
 
-    if not towns:
+    if not town_infos:
         return schema.dump({'data': []})
 
+    zupc_ids = {zupc.id for town in town_infos for zupc in index.get_zupcs(town)}
     zupcs = ZUPC.query.filter(
-        or_(ZUPC.allowed.contains(town) for town in towns)
+        ZUPC.id.in_(zupc_ids)
     ).order_by(
         ZUPC.id
-    ).all()
+    ).all() if zupc_ids else []
 
     is_admin = current_user.has_role('admin')
     is_operator = current_user.has_role('operateur')
 
     if not zupcs:
+        towns = Town.query.filter(
+            Town.id.in_([town.id for town in town_infos])
+        ).order_by(
+            Town.id
+        ).all()
         ret = schema.dump({
             'data': [
                 (town, _get_zupc_stats('insee_code', town.insee, is_admin, is_operator))
@@ -33,7 +33,7 @@ from .ads import ADS  # noqa
 from .customer import Customer  # noqa
 from .departement import Departement  # noqa
 from .driver import Driver  # noqa
-from .hail import Hail  # noqa
+from .hail import Hail, HailLog  # noqa
 from .station import Station  # noqa
 from .stats import *  # noqa
 from .taxi import Taxi  # noqa
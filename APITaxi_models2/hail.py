@@ -105,3 +105,15 @@ class Hail(HistoryMixin, db.Model):
     customer = db.relationship('Customer', foreign_keys=[customer_id], lazy='raise')
     operateur = db.relationship('User', foreign_keys=[operateur_id], lazy='raise')
     taxi = db.relationship('Taxi', foreign_keys=[taxi_id], lazy='raise')
+
+
+class HailLog(db.Model):
+    """Requests creating or changing a hail, archived from the redis stream
+    hail_log, see APITaxi2.redis_backend.log_hail()."""
+    __tablename__ = 'hail_log'
+
+    # ID of the entry in the redis stream
+    id = db.Column(db.String, primary_key=True)
+    time = db.Column(db.DateTime, primary_key=True)
+    hail_id = db.Column(db.String, nullable=False, index=True)
+    data = db.Column(postgresql.JSONB, nullable=False)
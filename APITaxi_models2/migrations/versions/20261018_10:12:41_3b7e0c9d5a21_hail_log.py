@@ -0,0 +1,43 @@
+"""hail log
+
+Revision ID: 3b7e0c9d5a21
+Revises: 8d6592987ce1
+Create Date: 2026-10-18 10:12:41.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '3b7e0c9d5a21'
+down_revision = '8d6592987ce1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('hail_log',
+        sa.Column('id', sa.String(), nullable=False),
+        sa.Column('time', sa.DateTime(), nullable=False),
+        sa.Column('hail_id', sa.String(), nullable=False),
+        sa.Column('data', postgresql.JSONB(), nullable=False),
+        sa.PrimaryKeyConstraint('id', 'time'),
+    )
+    op.create_index('ix_hail_log_hail_id', 'hail_log', ['hail_id'])
+    op.execute("SELECT create_hypertable('hail_log', 'time')")
+    op.execute("""
+        ALTER TABLE hail_log SET (
+            timescaledb.compress,
+            timescaledb.compress_segmentby = 'hail_id',
+            timescaledb.compress_orderby = 'time DESC'
+        )
+    """)
+    op.execute("SELECT add_compression_policy('hail_log', INTERVAL '7 days')")
+    # Same retention as the former hail:<hail_id> keys in redis
+    op.execute("SELECT add_retention_policy('hail_log', INTERVAL '6 weeks')")
+
+
+def downgrade():
+    op.drop_table('hail_log')
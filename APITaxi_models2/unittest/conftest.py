@@ -1,3 +1,4 @@
+import contextlib
 import hashlib
 import os
 import random
@@ -194,8 +195,9 @@ class SQLAlchemyQueriesTracker:
         output.write('======== end of queries ========\n')
 
 
-@pytest.fixture(scope='session')
-def redis_server():
+@contextlib.contextmanager
+def _run_redis_server():
+    """Start a redis server listening on a unix socket, yield the socket path."""
     with tempfile.TemporaryDirectory() as tmpdir:
         redis_config_name = os.path.join(tmpdir, 'redis.conf')
         socket_file = os.path.join(tmpdir, 'redis.sock')
@@ -228,3 +230,16 @@ loglevel notice
                 time.sleep(.1)
 
         os.kill(pid, signal.SIGKILL)
+
+
+@pytest.fixture(scope='session')
+def redis_server():
+    with _run_redis_server() as socket_file:
+        yield socket_file
+
+
+@pytest.fixture(scope='session')
+def redis_shard_servers():
+    """Two more redis servers, to test the sharding of geo indexes."""
+    with _run_redis_server() as first, _run_redis_server() as second:
+        yield first, second